@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+"""
+IP地区分类工具的基准测试
+
+在本地启动一个模拟 api.ipapi.is 的服务（可配置延迟分布、错误率和429限流），
+用真实的 IPClassifier 处理 1k/100k/1M 个合成IP，分阶段计时（加载、查询、保存、国家文件），
+并以JSON格式输出吞吐量、p50/p99请求延迟（及按批量大小平摊到每个IP的延迟）和峰值内存，便于跟踪性能回归。
+
+用法:
+    python benchmark.py                          # 默认规模 1000,100000,1000000
+    python benchmark.py --sizes 1000,10000 --latency-ms 20 --error-rate 0.01 --throttle-rate 0.02
+    python benchmark.py --sizes 100000 --baseline old_benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import math
+import random
+import socket
+import struct
+import argparse
+import ipaddress
+import platform
+import tempfile
+import threading
+import subprocess
+import contextlib
+from array import array
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from typing import Dict, List, Optional
+
+import iptest
+
+# 模拟服务返回的国家分布
+MOCK_COUNTRIES = [
+    ('US', 'United States', 'NA', 'America/New_York'),
+    ('CN', 'China', 'AS', 'Asia/Shanghai'),
+    ('HK', 'Hong Kong', 'AS', 'Asia/Hong_Kong'),
+    ('JP', 'Japan', 'AS', 'Asia/Tokyo'),
+    ('DE', 'Germany', 'EU', 'Europe/Berlin'),
+    ('SG', 'Singapore', 'AS', 'Asia/Singapore'),
+    ('GB', 'United Kingdom', 'EU', 'Europe/London'),
+    ('KR', 'South Korea', 'AS', 'Asia/Seoul'),
+]
+
+def mock_record(ip: str) -> Dict:
+    """
+    根据IP确定性地生成一条与ipapi.is格式一致的查询结果
+    :param ip: IP地址
+    :return: 查询结果
+    """
+    key = iptest.ip_sort_key(ip)
+    is_v4 = key >> 128 == 4
+    network_key = key >> 8 if is_v4 else key >> 80
+    country_code, country, continent, timezone = MOCK_COUNTRIES[network_key % len(MOCK_COUNTRIES)]
+    asn = 10000 + network_key % 5000
+    if is_v4:
+        base = socket.inet_ntoa(struct.pack('!I', (key & 0xFFFFFFFF) & ~0xFF))
+        network = f"{base} - {base[:base.rfind('.')]}.255"
+        route = f"{base}/24"
+    else:
+        network = route = str(ipaddress.ip_network(f"{ip}/48", strict=False))
+    return {
+        'ip': ip,
+        'rir': 'ARIN',
+        'is_bogon': False,
+        'is_mobile': False,
+        'is_satellite': False,
+        'is_crawler': False,
+        'is_datacenter': key % 4 == 0,
+        'is_tor': False,
+        'is_proxy': key % 17 == 0,
+        'is_vpn': key % 13 == 0,
+        'is_abuser': key % 29 == 0,
+        'elapsed_ms': 0.3,
+        'company': {'name': f"Company {asn}", 'abuser_score': '0.0012 (Very Low)', 'domain': f"as{asn}.example",
+                    'type': 'hosting' if key % 4 == 0 else 'isp', 'network': network},
+        'abuse': {'name': f"Abuse {asn}", 'address': 'Example Street 1', 'email': f"abuse@as{asn}.example",
+                  'phone': '+1-000-000-0000'},
+        'asn': {'asn': asn, 'abuser_score': '0 (Very Low)', 'route': route, 'descr': f"AS{asn} Example",
+                'country': country_code.lower(), 'active': True, 'org': f"Org {asn}", 'domain': f"as{asn}.example",
+                'abuse': f"abuse@as{asn}.example", 'type': 'hosting', 'created': '2001-01-01',
+                'updated': '2024-01-01', 'rir': 'ARIN'},
+        'location': {'is_eu_member': continent == 'EU', 'calling_code': '1', 'currency_code': 'USD',
+                     'continent': continent, 'country': country, 'country_code': country_code,
+                     'state': 'State', 'city': 'City', 'latitude': 1.0, 'longitude': 2.0, 'zip': '00000',
+                     'timezone': timezone, 'local_time': '2024-01-01T00:00:00+00:00',
+                     'local_time_unix': 1704067200, 'is_dst': False},
+    }
+
+class MockIPAPIServer:
+    """
+    本地模拟的 api.ipapi.is 服务，支持 GET ?q=IP 单个查询和 POST {"ips": [...]} 批量查询
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency_ms: float = 0.0,
+                 latency_dist: str = 'fixed', latency_sigma: float = 0.5, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, limit_rps: float = 0.0, retry_after: float = 0.0,
+                 seed: Optional[int] = None):
+        """
+        :param host: 监听地址
+        :param port: 监听端口，0表示自动选择
+        :param latency_ms: 平均（lognormal为中位数）响应延迟（毫秒）
+        :param latency_dist: 延迟分布：fixed、uniform、exponential或lognormal
+        :param latency_sigma: lognormal分布的sigma
+        :param error_rate: 返回500错误的概率
+        :param throttle_rate: 随机返回429的概率
+        :param limit_rps: 服务端限速（次/秒），超过时返回429，0表示不限速
+        :param retry_after: 429响应中Retry-After头的秒数
+        :param seed: 随机种子
+        """
+        self.latency = latency_ms / 1000
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.limit_rps = limit_rps
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = limit_rps
+        self.last_refill = time.monotonic()
+        self.reset_stats()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                ips = query.get('q', [''])[:1]
+                server.handle(self, ips, batch=False)
+
+            def do_POST(self):
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    ips = list(body.get('ips') or [])
+                except (ValueError, AttributeError):
+                    ips = []
+                server.handle(self, ips, batch=True)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'ips': 0, 'errors': 0, 'throttled': 0}
+
+    def _sample_latency(self) -> float:
+        if self.latency <= 0:
+            return 0.0
+        with self.lock:
+            if self.latency_dist == 'uniform':
+                return self.random.uniform(0, 2 * self.latency)
+            if self.latency_dist == 'exponential':
+                return self.random.expovariate(1 / self.latency)
+            if self.latency_dist == 'lognormal':
+                return self.random.lognormvariate(math.log(self.latency), self.latency_sigma)
+        return self.latency
+
+    def _decide(self) -> int:
+        """
+        决定本次请求的状态码
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            if self.limit_rps > 0:
+                now = time.monotonic()
+                self.tokens = min(self.limit_rps, self.tokens + (now - self.last_refill) * self.limit_rps)
+                self.last_refill = now
+                if self.tokens < 1:
+                    self.stats['throttled'] += 1
+                    return 429
+                self.tokens -= 1
+            roll = self.random.random()
+            if roll < self.throttle_rate:
+                self.stats['throttled'] += 1
+                return 429
+            if roll < self.throttle_rate + self.error_rate:
+                self.stats['errors'] += 1
+                return 500
+        return 200
+
+    def handle(self, request: BaseHTTPRequestHandler, ips: List[str], batch: bool):
+        status = self._decide()
+        delay = self._sample_latency()
+        if delay:
+            time.sleep(delay)
+        headers = {}
+        if status == 429:
+            payload = {'error': 'Too Many Requests'}
+            headers['Retry-After'] = f"{self.retry_after:g}"
+        elif status == 500:
+            payload = {'error': 'Internal Server Error'}
+        elif not ips or not all(ips):
+            status, payload = 400, {'error': 'Invalid IP address'}
+        elif batch:
+            payload = {ip: mock_record(ip) for ip in ips}
+            payload['total_elapsed_ms'] = round(delay * 1000, 2)
+        else:
+            payload = mock_record(ips[0])
+        if status == 200:
+            with self.lock:
+                self.stats['ips'] += len(ips)
+
+        body = json.dumps(payload).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class TimedIPClassifier(iptest.IPClassifier):
+    """
+    记录每次API请求耗时（包括重试和退避）的IPClassifier；
+    批量请求同时按请求中的IP数平摊，得到每个IP的平均耗时
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 每次HTTP请求的耗时
+        self.latencies = array('d')
+        # 每个IP平摊到的耗时（请求耗时 / 请求中的IP数），每个IP一项
+        self.ip_latencies = array('d')
+
+    def _record(self, elapsed: float, kwargs: Dict):
+        count = len((kwargs.get('json') or {}).get('ips') or ()) or 1
+        self.latencies.append(elapsed)
+        self.ip_latencies.extend([elapsed / count] * count)
+
+    def _fetch_json(self, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super()._fetch_json(method, url, **kwargs)
+        finally:
+            self._record(time.perf_counter() - start, kwargs)
+
+    async def _fetch_json_async(self, http, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super()._fetch_json_async(http, method, url, **kwargs)
+        finally:
+            self._record(time.perf_counter() - start, kwargs)
+
+def generate_ip_file(file_path: str, size: int, seed: int = 0, ipv6_ratio: float = 0.1,
+                     duplicate_ratio: float = 0.01):
+    """
+    生成合成IP输入文件
+    :param file_path: 输出文件路径
+    :param size: IP数量（行数）
+    :param seed: 随机种子
+    :param ipv6_ratio: IPv6地址所占比例
+    :param duplicate_ratio: 重复行所占比例
+    """
+    rng = random.Random(seed)
+    recent = []
+    with open(file_path, 'w', encoding='utf-8') as f:
+        for _ in range(size):
+            roll = rng.random()
+            if recent and roll < duplicate_ratio:
+                ip = rng.choice(recent)
+            elif roll < duplicate_ratio + ipv6_ratio:
+                ip = socket.inet_ntop(socket.AF_INET6, b'\x20\x01' + rng.getrandbits(112).to_bytes(14, 'big'))
+            else:
+                # 避开0.0.0.0/8和保留地址段
+                ip = socket.inet_ntoa(struct.pack('!I', rng.randint(0x01000000, 0xDFFFFFFF)))
+            if len(recent) < 1000:
+                recent.append(ip)
+            f.write(ip + '\n')
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    """
+    计算百分位数（最近秩法）
+    :param sorted_values: 已排序的数值
+    :param pct: 百分位（0-100）
+    :return: 百分位数，没有数据时返回None
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    当前进程的峰值常驻内存（MB）
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux以KB为单位，macOS以字节为单位
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def latency_summary(latencies) -> Dict:
+    """
+    :param latencies: 已排序的耗时（秒）
+    :return: p50/p99/平均/最大值（毫秒），没有样本时为None
+    """
+    if not latencies:
+        return {'p50': None, 'p99': None, 'mean': None, 'max': None}
+    return {
+        'p50': round(percentile(latencies, 50) * 1000, 3),
+        'p99': round(percentile(latencies, 99) * 1000, 3),
+        'mean': round(sum(latencies) / len(latencies) * 1000, 3),
+        'max': round(latencies[-1] * 1000, 3),
+    }
+
+def run_benchmark(size: int, api_url: str, options: Dict, workdir: str) -> Dict:
+    """
+    用真实的IPClassifier完整处理一批合成IP，分阶段计时
+    :param size: IP数量
+    :param api_url: 模拟服务地址
+    :param options: 查询参数（engine、threads、concurrency、batch_size、rate、retries、seed、ipv6_ratio）
+    :param workdir: 临时工作目录
+    :return: 本次运行的结果
+    """
+    input_file = os.path.join(workdir, 'ips.txt')
+    output_file = os.path.join(workdir, 'iptest_results.json')
+    country_dir = os.path.join(workdir, 'country_files')
+    generate_ip_file(input_file, size, options['seed'], options['ipv6_ratio'])
+
+    rate_limiter = None
+    if options['rate'] > 0:
+        rate_limiter = iptest.AdaptiveRateLimiter(rate=options['rate'], max_rate=max(options['rate'], options['max_rate']))
+    classifier = TimedIPClassifier(api_base_url=api_url, timeout=options['timeout'],
+                                   rate_limiter=rate_limiter, max_retries=options['retries'])
+    stages = {}
+
+    # 基准测试中丢弃进度和摘要输出（写出本身的开销仍计入）
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        ip_list = iptest.load_ip_list(input_file)
+        stages['load'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if options['engine'] == 'async':
+            classified_ips, failed_ips = classifier.classify_ips_by_country_async(
+                ip_list, options['concurrency'], batch_size=options['batch_size'])
+        else:
+            classified_ips, failed_ips = classifier.classify_ips_by_country(
+                ip_list, options['threads'], batch_size=options['batch_size'])
+        stages['fetch'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        classifier.save_results(classified_ips, output_file)
+        stages['save'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        classifier.create_country_files(classified_ips, country_dir)
+        stages['country_files'] = time.perf_counter() - start
+
+    latencies = sorted(classifier.latencies)
+    ip_latencies = sorted(classifier.ip_latencies)
+    total = sum(stages.values())
+    return {
+        'size': size,
+        'unique_ips': len(ip_list),
+        'success': len(ip_list) - len(failed_ips),
+        'failed': len(failed_ips),
+        'stages_seconds': {name: round(value, 4) for name, value in stages.items()},
+        'total_seconds': round(total, 4),
+        'throughput_ips_per_second': round(len(ip_list) / stages['fetch'], 1) if stages['fetch'] else None,
+        'end_to_end_ips_per_second': round(len(ip_list) / total, 1) if total else None,
+        'requests': len(latencies),
+        'request_latency_ms': latency_summary(latencies),
+        'per_ip_latency_ms': latency_summary(ip_latencies),
+        'client_retries': rate_limiter.stats['retries'] if rate_limiter is not None else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def run_worker(args):
+    """
+    子进程入口：每个规模在独立进程中运行，峰值内存互不影响
+    """
+    options = json.loads(args.worker_options)
+    with tempfile.TemporaryDirectory(prefix='iptest-bench-') as workdir:
+        result = run_benchmark(args.worker_size, args.worker_url, options, workdir)
+    with open(args.worker_result, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+def compare_with_baseline(report: Dict, baseline_file: str):
+    """
+    与之前的基准测试结果比较并打印变化
+    :param report: 本次结果
+    :param baseline_file: 基准结果文件
+    """
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = {result['size']: result for result in json.load(f).get('results', [])}
+    print(f"\n与基准 {baseline_file} 比较:")
+    for result in report['results']:
+        old = baseline.get(result['size'])
+        if old is None:
+            continue
+        changes = []
+        for label, new_value, old_value in (
+            ('吞吐量', result['throughput_ips_per_second'], old.get('throughput_ips_per_second')),
+            ('总耗时', result['total_seconds'], old.get('total_seconds')),
+            # 旧版报告中的lookup_latency_ms即为每次请求的耗时
+            ('请求p99', result['request_latency_ms']['p99'],
+             (old.get('request_latency_ms') or old.get('lookup_latency_ms') or {}).get('p99')),
+            ('峰值内存', result['peak_rss_mb'], old.get('peak_rss_mb')),
+        ):
+            if new_value and old_value:
+                changes.append(f"{label} {(new_value - old_value) / old_value * 100:+.1f}%")
+        print(f"  {result['size']:>9}: {'，'.join(changes)}")
+
+def main():
+    parser = argparse.ArgumentParser(description='IP地区分类工具基准测试（使用本地模拟的ipapi.is服务）')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='合成IP数量，逗号分隔（默认: 1000,100000,1000000）')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='JSON报告文件（默认: benchmark_results.json）')
+    parser.add_argument('--baseline', help='与之前的JSON报告比较')
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread', help='查询引擎（默认: thread）')
+    parser.add_argument('-t', '--threads', type=int, default=10, help='线程数（默认: 10）')
+    parser.add_argument('--concurrency', type=int, default=200, help='异步引擎最大并发请求数（默认: 200）')
+    parser.add_argument('--batch-size', type=int, default=100, help='每次请求查询的IP数（默认: 100）')
+    parser.add_argument('--rate', type=float, default=0, help='客户端自适应限速初始速率（次/秒，默认: 0不限速）')
+    parser.add_argument('--max-rate', type=float, default=1000, help='客户端自适应限速最高速率（默认: 1000）')
+    parser.add_argument('--retries', type=int, default=3, help='客户端最大重试次数（默认: 3）')
+    parser.add_argument('--timeout', type=float, default=10, help='请求超时时间（秒，默认: 10）')
+    parser.add_argument('--latency-ms', type=float, default=5, help='模拟服务的平均响应延迟（毫秒，默认: 5）')
+    parser.add_argument('--latency-dist', choices=['fixed', 'uniform', 'exponential', 'lognormal'], default='lognormal',
+                        help='模拟服务的延迟分布（默认: lognormal，中位数为--latency-ms）')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='lognormal分布的sigma（默认: 0.5）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟服务返回500的概率（默认: 0）')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='模拟服务随机返回429的概率（默认: 0）')
+    parser.add_argument('--limit-rps', type=float, default=0, help='模拟服务的限速（次/秒），超过时返回429（默认: 0不限速）')
+    parser.add_argument('--retry-after', type=float, default=0, help='429响应的Retry-After秒数（默认: 0）')
+    parser.add_argument('--ipv6-ratio', type=float, default=0.1, help='合成IP中IPv6所占比例（默认: 0.1）')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子（默认: 42）')
+    # 内部参数：子进程运行单个规模
+    parser.add_argument('--worker-size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-url', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-options', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_size is not None:
+        run_worker(args)
+        return
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    except ValueError:
+        print(f"错误：无效的规模: {args.sizes}")
+        return
+
+    options = {
+        'engine': args.engine, 'threads': args.threads, 'concurrency': args.concurrency,
+        'batch_size': args.batch_size, 'rate': args.rate, 'max_rate': args.max_rate,
+        'retries': args.retries, 'timeout': args.timeout, 'seed': args.seed, 'ipv6_ratio': args.ipv6_ratio,
+    }
+    mock_config = {
+        'latency_ms': args.latency_ms, 'latency_dist': args.latency_dist, 'latency_sigma': args.latency_sigma,
+        'error_rate': args.error_rate, 'throttle_rate': args.throttle_rate, 'limit_rps': args.limit_rps,
+        'retry_after': args.retry_after,
+    }
+    server = MockIPAPIServer(seed=args.seed, **mock_config)
+    server.start()
+    print(f"模拟服务已启动: {server.url}")
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'aiohttp': iptest.aiohttp is not None,
+        },
+        'options': options,
+        'mock_server': mock_config,
+        'results': [],
+    }
+    try:
+        for size in sizes:
+            print(f"\n运行规模 {size} ...")
+            server.reset_stats()
+            with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as tmp:
+                result_file = tmp.name
+            try:
+                subprocess.run([sys.executable, os.path.abspath(__file__),
+                                '--worker-size', str(size), '--worker-url', server.url,
+                                '--worker-options', json.dumps(options), '--worker-result', result_file],
+                               check=True)
+                with open(result_file, 'r', encoding='utf-8') as f:
+                    result = json.load(f)
+            finally:
+                os.remove(result_file)
+            result['mock_server'] = dict(server.stats)
+            report['results'].append(result)
+
+            stages = result['stages_seconds']
+            print(f"  吞吐量: {result['throughput_ips_per_second']} IP/秒，"
+                  f"请求延迟 p50 {result['request_latency_ms']['p50']} ms / p99 {result['request_latency_ms']['p99']} ms，"
+                  f"每IP平摊 p50 {result['per_ip_latency_ms']['p50']} ms / p99 {result['per_ip_latency_ms']['p99']} ms，"
+                  f"峰值内存 {result['peak_rss_mb']} MB")
+            print(f"  阶段耗时: 加载 {stages['load']:.2f}s，查询 {stages['fetch']:.2f}s，"
+                  f"保存 {stages['save']:.2f}s，国家文件 {stages['country_files']:.2f}s")
+            print(f"  成功 {result['success']}，失败 {result['failed']}，"
+                  f"服务端请求 {result['mock_server']['requests']}（500: {result['mock_server']['errors']}，"
+                  f"429: {result['mock_server']['throttled']}）")
+    finally:
+        server.stop()
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n基准测试报告已保存到: {args.output}")
+
+    if args.baseline:
+        compare_with_baseline(report, args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -1,792 +1,6025 @@
-#!/usr/bin/env python3
-# -*- coding: utf-8 -*-
-"""
-IP地区分类脚本
-使用ipapi.is API服务对IP进行地理位置分类
-"""
-
-import os
-import sys
-import requests
-import json
-import time
-import argparse
-import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List, Optional
-from collections import defaultdict
-
-# 中文翻译映射表
-CHINESE_TRANSLATIONS = {
-    # 国家名称映射
-    'United States': '美国',
-    'China': '中国',
-    'Hong Kong': '中国香港',
-    'Taiwan': '中国台湾',
-    'Japan': '日本',
-    'South Korea': '韩国',
-    'Singapore': '新加坡',
-    'Germany': '德国',
-    'United Kingdom': '英国',
-    'France': '法国',
-    'Canada': '加拿大',
-    'Australia': '澳大利亚',
-    'Russia': '俄罗斯',
-    'India': '印度',
-    'Brazil': '巴西',
-    'Netherlands': '荷兰',
-    'Sweden': '瑞典',
-    'Switzerland': '瑞士',
-    'Spain': '西班牙',
-    'Italy': '意大利',
-    'Unknown': '未知',
-    
-    # 地区名称映射（常见地区）
-    'California': '加利福尼亚州',
-    'New York': '纽约州',
-    'Texas': '德克萨斯州',
-    'Florida': '佛罗里达州',
-    'Beijing': '北京',
-    'Shanghai': '上海',
-    'Guangdong': '广东',
-    'Zhejiang': '浙江',
-    'Jiangsu': '江苏',
-    'Tokyo': '东京',
-    'Osaka': '大阪',
-    'Seoul': '首尔',
-    'Berlin': '柏林',
-    'London': '伦敦',
-    'Paris': '巴黎',
-    'Sydney': '悉尼',
-    'Moscow': '莫斯科',
-    'Mumbai': '孟买',
-    'São Paulo': '圣保罗',
-    'Amsterdam': '阿姆斯特丹',
-    'Stockholm': '斯德哥尔摩',
-    'Zurich': '苏黎世',
-    'Madrid': '马德里',
-    'Rome': '罗马',
-    'Central and Western': '中西区',
-    
-    # 大洲映射
-    'Asia': '亚洲',
-    'North America': '北美洲',
-    'South America': '南美洲',
-    'Europe': '欧洲',
-    'Africa': '非洲',
-    'Oceania': '大洋洲',
-    'Antarctica': '南极洲',
-    
-    # 公司类型映射
-    'hosting': '托管服务',
-    'isp': '互联网服务提供商',
-    'business': '企业',
-    'education': '教育机构',
-    'government': '政府机构',
-    
-    # 字段名称映射
-    'ip': 'IP地址',
-    'country': '国家',
-    'country_code': '国家代码',
-    'region': '地区/州',
-    'city': '城市',
-    'latitude': '纬度',
-    'longitude': '经度',
-    'asn': '自治系统号',
-    'org': '组织',
-    'timezone': '时区',
-    'utc_offset': 'UTC偏移',
-    'country_calling_code': '国家电话代码',
-    'currency': '货币',
-    'languages': '语言',
-    'country_flag': '国旗',
-    'country_flag_emoji': '国旗表情',
-    'country_area': '国家面积',
-    'country_population': '国家人口',
-    'continent': '大洲',
-    'in_eu': '是否在欧盟',
-    'postal': '邮政编码',
-    
-    # 新增完整API字段映射
-    'rir': '区域互联网注册机构',
-    'is_bogon': '是否为保留IP',
-    'is_mobile': '是否为移动网络',
-    'is_satellite': '是否为卫星网络',
-    'is_crawler': '是否为爬虫',
-    'is_datacenter': '是否为数据中心',
-    'is_tor': '是否为Tor网络',
-    'is_proxy': '是否为代理',
-    'is_vpn': '是否为VPN',
-    'is_abuser': '是否为滥用者',
-    'is_eu_member': '是否为欧盟成员国',
-    'is_dst': '是否为夏令时',
-    'abuser_score': '滥用评分',
-    'route': '路由',
-    'descr': '描述',
-    'active': '是否活跃',
-    'domain': '域名',
-    'abuse': '滥用联系人',
-    'type': '类型',
-    'updated': '更新时间',
-    'network': '网络',
-    'datacenter': '数据中心',
-    'name': '名称',
-    'address': '地址',
-    'email': '邮箱',
-    'phone': '电话',
-    'calling_code': '电话代码',
-    'currency_code': '货币代码',
-    'state': '州/省',
-    'zip': '邮编',
-    'local_time': '本地时间',
-    'local_time_unix': '本地时间戳',
-    'elapsed_ms': '耗时(毫秒)',
-    
-    # 嵌套对象名称映射
-    'company': '公司信息',
-    'abuse': '滥用联系人信息',
-    'asn': '自治系统信息',
-    'location': '位置信息'
-}
-
-def translate_to_chinese(text: str) -> str:
-    """
-    将文本翻译成中文
-    :param text: 原始文本
-    :return: 中文翻译
-    """
-    if not text:
-        return text
-    return CHINESE_TRANSLATIONS.get(text, text)
-
-class IPClassifier:
-    def __init__(self, api_key: Optional[str] = None):
-        """
-        初始化IP分类器
-        :param api_key: ipapi.is的API密钥
-        """
-        self.api_base_url = "https://api.ipapi.is/"
-        self.api_key = api_key or "11111111111111111111111111111111"
-
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'IP-Classifier/1.0'
-        })
-        
-    def get_ip_location(self, ip: str) -> Optional[Dict]:
-        """
-        获取IP的完整地理位置信息
-        :param ip: IP地址
-        :return: 包含完整地理位置信息的字典，如果失败返回None
-        """
-        try:
-            url = f"{self.api_base_url}"
-            params = {
-                'q': ip,
-                'key': self.api_key
-            }
-                
-            response = self.session.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            # 检查API返回是否有效
-            if data.get('error'):
-                print(f"API错误 for IP {ip}: {data.get('error', 'Unknown error')}")
-                return None
-            
-            # 直接使用官方API的原始结构，不翻译值
-            translated_data = {
-                'ip': data.get('ip', ip),
-                'rir': data.get('rir'),
-                'is_bogon': data.get('is_bogon'),
-                'is_mobile': data.get('is_mobile'),
-                'is_satellite': data.get('is_satellite'),
-                'is_crawler': data.get('is_crawler'),
-                'is_datacenter': data.get('is_datacenter'),
-                'is_tor': data.get('is_tor'),
-                'is_proxy': data.get('is_proxy'),
-                'is_vpn': data.get('is_vpn'),
-                'is_abuser': data.get('is_abuser'),
-                'elapsed_ms': data.get('elapsed_ms'),
-                
-                # company信息（嵌套结构）
-                'company': {
-                    'name': data.get('company', {}).get('name'),
-                    'abuser_score': data.get('company', {}).get('abuser_score'),
-                    'domain': data.get('company', {}).get('domain'),
-                    'type': data.get('company', {}).get('type'),
-                    'network': data.get('company', {}).get('network'),
-                    'whois': data.get('company', {}).get('whois')
-                },
-                
-                # abuse信息（嵌套结构）
-                'abuse': {
-                    'name': data.get('abuse', {}).get('name'),
-                    'address': data.get('abuse', {}).get('address'),
-                    'email': data.get('abuse', {}).get('email'),
-                    'phone': data.get('abuse', {}).get('phone')
-                },
-                
-                # asn信息（嵌套结构）
-                'asn': {
-                    'asn': data.get('asn', {}).get('asn'),
-                    'abuser_score': data.get('asn', {}).get('abuser_score'),
-                    'route': data.get('asn', {}).get('route'),
-                    'descr': data.get('asn', {}).get('descr'),
-                    'country': data.get('asn', {}).get('country'),
-                    'active': data.get('asn', {}).get('active'),
-                    'org': data.get('asn', {}).get('org'),
-                    'domain': data.get('asn', {}).get('domain'),
-                    'abuse': data.get('asn', {}).get('abuse'),
-                    'type': data.get('asn', {}).get('type'),
-                    'updated': data.get('asn', {}).get('updated'),
-                    'rir': data.get('asn', {}).get('rir'),
-                    'whois': data.get('asn', {}).get('whois')
-                },
-                
-                # location信息（嵌套结构）
-                'location': {
-                    'is_eu_member': data.get('location', {}).get('is_eu_member'),
-                    'calling_code': data.get('location', {}).get('calling_code'),
-                    'currency_code': data.get('location', {}).get('currency_code'),
-                    'continent': data.get('location', {}).get('continent'),
-                    'country': data.get('location', {}).get('country'),
-                    'country_code': data.get('location', {}).get('country_code'),
-                    'state': data.get('location', {}).get('state'),
-                    'city': data.get('location', {}).get('city'),
-                    'latitude': data.get('location', {}).get('latitude'),
-                    'longitude': data.get('location', {}).get('longitude'),
-                    'zip': data.get('location', {}).get('zip'),
-                    'timezone': data.get('location', {}).get('timezone'),
-                    'local_time': data.get('location', {}).get('local_time'),
-                    'local_time_unix': data.get('location', {}).get('local_time_unix'),
-                    'is_dst': data.get('location', {}).get('is_dst')
-                }
-            }
-            
-            # 将布尔值转换为中文描述
-            for key, value in translated_data.items():
-                if isinstance(value, bool) and key.startswith('is_'):
-                    translated_data[key] = '是' if value else '否'
-            
-            # 处理嵌套结构中的布尔值
-            for section in ['company', 'abuse', 'asn', 'location']:
-                if section in translated_data and isinstance(translated_data[section], dict):
-                    for key, value in translated_data[section].items():
-                        if isinstance(value, bool):
-                            translated_data[section][key] = '是' if value else '否'
-                        elif isinstance(value, str):
-                            translated_data[section][key] = translate_to_chinese(value)
-            
-            return translated_data
-            
-        except requests.RequestException as e:
-            print(f"网络请求错误 for IP {ip}: {e}")
-            return None
-        except json.JSONDecodeError as e:
-            print(f"JSON解析错误 for IP {ip}: {e}")
-            return None
-        except Exception as e:
-            print(f"未知错误 for IP {ip}: {e}")
-            return None
-    
-    def classify_ips_by_country(self, ip_list: list[str], max_workers: int = 5) -> tuple[dict[str, list[dict]], list[str]]:
-        """
-        按国家对IP列表进行分类（多线程并发版本）
-        :param ip_list: IP地址列表
-        :param max_workers: 最大线程数，默认为5
-        :return: (按国家分类的IP信息字典, 失败的IP列表)
-        """
-        classified_ips = defaultdict(list)
-        failed_ips = []
-        total_ips = len(ip_list)
-        
-        print(f"开始处理 {total_ips} 个IP地址...")
-        print(f"使用 {max_workers} 个线程并发查询...")
-        
-        # 创建线程锁，用于线程安全的进度更新
-        progress_lock = threading.Lock()
-        completed_count = 0
-        
-        def process_single_ip(ip):
-            """
-            处理单个IP的函数，供线程池使用
-            """
-            nonlocal completed_count
-            
-            try:
-                location_data = self.get_ip_location(ip)
-                
-                with progress_lock:
-                    completed_count += 1
-                    progress = completed_count / total_ips * 100
-                    print(f"处理进度: {completed_count}/{total_ips} ({progress:.1f}%) - {ip}")
-                
-                if location_data:
-                    return ip, location_data, None
-                else:
-                    return ip, None, "查询失败"
-                    
-            except Exception as e:
-                with progress_lock:
-                    completed_count += 1
-                    progress = completed_count / total_ips * 100
-                    print(f"处理进度: {completed_count}/{total_ips} ({progress:.1f}%) - {ip} (错误: {str(e)})")
-                return ip, None, str(e)
-        
-        # 使用线程池并发处理
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # 提交所有任务
-            future_to_ip = {executor.submit(process_single_ip, ip): ip for ip in ip_list}
-            
-            # 处理完成的任务
-            for future in as_completed(future_to_ip):
-                ip, location_data, error = future.result()
-                
-                if location_data:
-                    # 从嵌套结构中获取国家信息
-                    if 'location' in location_data and 'country' in location_data['location']:
-                        country = location_data['location']['country']
-                    else:
-                        # 如果没有位置信息，使用默认值
-                        country = 'Unknown'
-                    classified_ips[country].append(location_data)
-                else:
-                    failed_ips.append(ip)
-        
-        return dict(classified_ips), failed_ips
-    
-    def create_country_files(self, classified_ips: Dict[str, List[Dict]], output_dir: str = 'country_files', merge_mode: bool = False):
-        """
-        为每个国家/地区创建单独的txt文件，保存到指定文件夹
-        :param classified_ips: 分类结果
-        :param output_dir: 输出目录名称
-        :param merge_mode: 是否为合并模式（True=合并现有文件，False=覆盖现有文件）
-        """
-        print("\n=== 创建国家/地区IP文件 ===")
-        
-        # 确定实际输出目录
-        actual_output_dir = output_dir
-        if merge_mode:
-            # 合并模式下，在output_dir下创建merged子目录
-            actual_output_dir = os.path.join(output_dir, 'merged')
-        
-        # 创建输出目录
-        try:
-            os.makedirs(actual_output_dir, exist_ok=True)
-            print(f"创建输出目录: {actual_output_dir}")
-        except Exception as e:
-            print(f"创建目录 {actual_output_dir} 时出错: {e}")
-            return
-        
-        for country, ips in classified_ips.items():
-            # 使用国家代码作为文件名，如果没有则使用国家名称的拼音或英文
-            if ips and 'location' in ips[0] and 'country_code' in ips[0]['location']:
-                country_code = ips[0]['location']['country_code']
-            else:
-                country_code = 'Unknown'
-            filename = os.path.join(actual_output_dir, f"{country_code}.txt")
-            
-            try:
-                # 准备IP列表
-                new_ips = [ip_data['ip'] for ip_data in ips]
-                
-                if merge_mode and os.path.exists(filename):
-                    # 合并模式：读取现有文件并合并
-                    try:
-                        with open(filename, 'r', encoding='utf-8') as f:
-                            existing_ips = [line.strip() for line in f if line.strip()]
-                        print(f"读取现有文件: {filename} (包含 {len(existing_ips)} 个IP)")
-                        
-                        # 合并IP列表，去重
-                        merged_ips = list(set(existing_ips + new_ips))
-                        # 按IP地址排序
-                        sorted_ips = sorted(merged_ips, key=lambda x: self.ip_to_tuple(x))
-                        
-                        print(f"合并后: {len(sorted_ips)} 个IP (新增 {len(new_ips)} 个，去重后净增 {len(sorted_ips) - len(existing_ips)} 个)")
-                    except Exception as e:
-                        print(f"读取现有文件失败，将创建新文件: {e}")
-                        # 按IP地址排序
-                        sorted_ips = sorted(new_ips, key=lambda x: self.ip_to_tuple(x))
-                else:
-                    # 覆盖模式或文件不存在：直接使用新IP
-                    # 按IP地址排序
-                    sorted_ips = sorted(new_ips, key=lambda x: self.ip_to_tuple(x))
-                
-                # 写入文件
-                with open(filename, 'w', encoding='utf-8') as f:
-                    for ip in sorted_ips:
-                        f.write(f"{ip}\n")
-                
-                mode_desc = "合并模式" if merge_mode else "覆盖模式"
-                print(f"已创建文件: {filename} ({mode_desc}，包含 {len(sorted_ips)} 个IP，按IP排序)")
-            except Exception as e:
-                print(f"创建文件 {filename} 时出错: {e}")
-    
-    def ip_to_tuple(self, ip_str: str) -> tuple:
-        """
-        将IP地址转换为可排序的元组
-        :param ip_str: IP地址字符串
-        :return: 可排序的元组
-        """
-        try:
-            return tuple(map(int, ip_str.split('.')))
-        except:
-            return (0, 0, 0, 0)
-    
-    def translate_field_names_to_chinese(self, data: Dict) -> Dict:
-        """
-        将字典中的字段名翻译成中文
-        :param data: 原始数据字典
-        :return: 字段名翻译后的字典
-        """
-        if not isinstance(data, dict):
-            return data
-        
-        translated_data = {}
-        for key, value in data.items():
-            # 翻译字段名
-            chinese_key = CHINESE_TRANSLATIONS.get(key, key)
-            
-            # 如果值是字典，递归翻译
-            if isinstance(value, dict):
-                translated_data[chinese_key] = self.translate_field_names_to_chinese(value)
-            # 如果值是列表，对列表中的每个元素进行翻译
-            elif isinstance(value, list):
-                translated_data[chinese_key] = [
-                    self.translate_field_names_to_chinese(item) if isinstance(item, dict) else item
-                    for item in value
-                ]
-            else:
-                translated_data[chinese_key] = value
-        
-        return translated_data
-    
-    def save_results(self, classified_ips: Dict[str, List[Dict]], output_file: str):
-        """
-        保存分类结果到JSON文件，支持增量更新，字段名翻译成中文
-        :param classified_ips: 分类结果
-        :param output_file: 输出文件路径
-        """
-        try:
-            # 确保输出目录存在
-            output_dir = os.path.dirname(output_file)
-            if output_dir:  # 只有当目录路径不为空时才创建目录
-                os.makedirs(output_dir, exist_ok=True)
-            
-            # 尝试读取现有数据
-            existing_classified_ips = {}
-            if os.path.exists(output_file):
-                try:
-                    with open(output_file, 'r', encoding='utf-8') as f:
-                        existing_classified_ips = json.load(f)
-                    print(f"已读取现有数据: {output_file}")
-                except Exception as e:
-                    print(f"读取现有文件失败，将创建新文件: {e}")
-            
-            # 合并数据：新IP添加，已有IP的覆盖旧数据
-            merged_classified_ips = existing_classified_ips.copy()
-            
-            for country, new_ip_list in classified_ips.items():
-                if country not in merged_classified_ips:
-                    merged_classified_ips[country] = []
-                
-                # 创建IP到数据的映射，方便快速查找
-                existing_ip_map = {ip_data['ip']: ip_data for ip_data in merged_classified_ips[country]}
-                
-                for new_ip_data in new_ip_list:
-                    ip_address = new_ip_data['ip']
-                    # 覆盖已有IP的数据或添加新IP
-                    existing_ip_map[ip_address] = new_ip_data
-                
-                # 转换回列表并按IP排序
-                merged_ip_list = list(existing_ip_map.values())
-                merged_ip_list.sort(key=lambda x: self.ip_to_tuple(x['ip']))
-                merged_classified_ips[country] = merged_ip_list
-            
-            # 删除空的国家
-            empty_countries = [country for country, ip_list in merged_classified_ips.items() if not ip_list]
-            for country in empty_countries:
-                del merged_classified_ips[country]
-            
-            # 将字段名翻译成中文
-            translated_classified_ips = self.translate_field_names_to_chinese(merged_classified_ips)
-            
-            # 保存合并后的数据
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(translated_classified_ips, f, ensure_ascii=False, indent=2)
-            print(f"结果已保存到: {output_file} (增量更新，按IP排序，字段名已翻译成中文)")
-        except Exception as e:
-            print(f"保存文件时出错: {e}")
-    
-    def print_summary(self, classified_ips: Dict[str, List[Dict]]):
-        """
-        打印详细的分类摘要和完整检测信息
-        :param classified_ips: 分类结果
-        """
-        print("\n=== IP地区分类详细报告 ===")
-        total_ips = sum(len(ips) for ips in classified_ips.values())
-        print(f"总共处理了 {total_ips} 个IP地址")
-        print(f"涉及 {len(classified_ips)} 个国家/地区\n")
-        
-        for country, ips in sorted(classified_ips.items(), key=lambda x: len(x[1]), reverse=True):
-            print(f"【{country}】 - 共 {len(ips)} 个IP")
-            print("=" * 50)
-            
-            # 显示每个IP的完整信息
-            for i, ip_data in enumerate(ips, 1):
-                print(f"\nIP #{i}: {ip_data['ip']}")
-                print("-" * 30)
-                
-                # 基本信息
-                print(f"区域互联网注册机构: {ip_data.get('rir', 'Unknown')}")
-                print(f"查询耗时: {ip_data.get('elapsed_ms', 'Unknown')}毫秒")
-                
-                # 位置信息
-                if 'location' in ip_data:
-                    location = ip_data['location']
-                    print(f"\n【位置信息】")
-                    print(f"国家: {translate_to_chinese(location.get('country', 'Unknown'))}")
-                    print(f"国家代码: {location.get('country_code', 'Unknown')}")
-                    print(f"地区/州: {translate_to_chinese(location.get('state', 'Unknown'))}")
-                    print(f"城市: {translate_to_chinese(location.get('city', 'Unknown'))}")
-                    print(f"大洲: {translate_to_chinese(location.get('continent', 'Unknown'))}")
-                    print(f"邮政编码: {location.get('zip', 'Unknown')}")
-                    print(f"时区: {location.get('timezone', 'Unknown')}")
-                    print(f"本地时间: {location.get('local_time', 'Unknown')}")
-                    print(f"电话代码: {location.get('calling_code', 'Unknown')}")
-                    print(f"货币代码: {location.get('currency_code', 'Unknown')}")
-                    
-                    if location.get('latitude') and location.get('longitude'):
-                        print(f"坐标: {location['latitude']}, {location['longitude']}")
-                    
-                    # 标识字段
-                    print("\n【网络特征】")
-                    flag_fields = {
-                        'is_bogon': '是否为保留IP',
-                        'is_mobile': '是否为移动网络',
-                        'is_satellite': '是否为卫星网络',
-                        'is_crawler': '是否为爬虫',
-                        'is_datacenter': '是否为数据中心',
-                        'is_tor': '是否为Tor网络',
-                        'is_proxy': '是否为代理',
-                        'is_vpn': '是否为VPN',
-                        'is_abuser': '是否为滥用者'
-                    }
-                    
-                    for field, chinese_name in flag_fields.items():
-                        value = ip_data.get(field)
-                        if value is not None:
-                            print(f"{chinese_name}: {'是' if value else '否'}")
-                    
-                    # ASN信息
-                    if 'asn' in ip_data:
-                        asn = ip_data['asn']
-                        print("\n【自治系统信息】")
-                        print(f"自治系统号: {asn.get('asn', 'Unknown')}")
-                        print(f"组织: {translate_to_chinese(asn.get('org', 'Unknown'))}")
-                        print(f"路由: {asn.get('route', 'Unknown')}")
-                        print(f"描述: {translate_to_chinese(asn.get('descr', 'Unknown'))}")
-                        print(f"国家: {asn.get('country', 'Unknown')}")
-                        print(f"类型: {translate_to_chinese(asn.get('type', 'Unknown'))}")
-                        print(f"滥用评分: {asn.get('abuser_score', 'Unknown')}")
-                        print(f"域名: {asn.get('domain', 'Unknown')}")
-                        print(f"滥用联系人: {asn.get('abuse', 'Unknown')}")
-                        print(f"更新时间: {asn.get('updated', 'Unknown')}")
-                        print(f"区域注册机构: {asn.get('rir', 'Unknown')}")
-                        print(f"是否活跃: {'是' if asn.get('active') else '否'}")
-                    
-                    # 公司信息
-                    if 'company' in ip_data:
-                        company = ip_data['company']
-                        print("\n【公司信息】")
-                        print(f"公司名称: {translate_to_chinese(company.get('name', 'Unknown'))}")
-                        print(f"域名: {company.get('domain', 'Unknown')}")
-                        print(f"类型: {translate_to_chinese(company.get('type', 'Unknown'))}")
-                        print(f"滥用评分: {company.get('abuser_score', 'Unknown')}")
-                        print(f"网络范围: {company.get('network', 'Unknown')}")
-                        print(f"WHOIS信息: {company.get('whois', 'Unknown')}")
-                    
-                    # 滥用联系人信息
-                    if 'abuse' in ip_data:
-                        abuse = ip_data['abuse']
-                        print("\n【滥用联系人】")
-                        print(f"联系人: {translate_to_chinese(abuse.get('name', 'Unknown'))}")
-                        print(f"地址: {translate_to_chinese(abuse.get('address', 'Unknown'))}")
-                        print(f"邮箱: {abuse.get('email', 'Unknown')}")
-                        print(f"电话: {abuse.get('phone', 'Unknown')}")
-                
-                # 如果不是最后一个IP，添加分隔线
-                if i < len(ips):
-                    print("\n" + "·" * 40)
-            
-            print("\n" + "=" * 50 + "\n")
-
-def load_ip_list(file_path: str) -> List[str]:
-    """
-    从文件加载IP列表
-    :param file_path: 文件路径
-    :return: IP地址列表
-    """
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            ips = [line.strip() for line in f if line.strip()]
-        return ips
-    except FileNotFoundError:
-        print(f"文件未找到: {file_path}")
-        return []
-    except Exception as e:
-        print(f"读取文件时出错: {e}")
-        return []
-
-def get_user_input(prompt: str, default: str = None) -> str:
-    """
-    获取用户输入，支持默认值
-    :param prompt: 提示信息
-    :param default: 默认值
-    :return: 用户输入的值
-    """
-    if default:
-        user_input = input(f"{prompt} (默认: {default}): ").strip()
-        return user_input if user_input else default
-    else:
-        return input(f"{prompt}: ").strip()
-
-def interactive_mode() -> tuple:
-    """
-    交互式模式，获取用户输入
-    :return: (input_file, output_file, api_key, country_files_dir, merge_mode, max_workers)
-    """
-    print("\n=== 交互式配置 ===")
-    
-    # 获取输入文件
-    while True:
-        input_file = get_user_input("请输入包含IP地址的文件路径", "ips.txt")
-        if os.path.exists(input_file):
-            break
-        else:
-            print(f"文件 '{input_file}' 不存在，请重新输入或创建该文件。")
-    
-    # 获取输出文件
-    output_file = get_user_input("请输入JSON结果输出文件路径", "iptest_results.json")
-    
-    # 获取API密钥（可选）
-    api_key = get_user_input("请输入ipapi.is的API密钥（可选，直接回车使用内置密钥）", "")
-    api_key = api_key if api_key else None
-    
-    # 获取国家文件输出目录
-    country_files_dir = get_user_input("请输入国家分类文件输出目录", "country_files")
-    
-    # 获取并发线程数
-    while True:
-        try:
-            threads_input = get_user_input("请输入并发线程数（1-20，默认: 5）", "5")
-            max_workers = int(threads_input)
-            if 1 <= max_workers <= 20:
-                break
-            else:
-                print("线程数必须在1-20之间，请重新输入。")
-        except ValueError:
-            print("请输入有效的数字，请重新输入。")
-    
-    # 询问是否使用合并模式
-    merge_input = get_user_input("是否使用合并模式（y/n，默认: n）", "n")
-    merge_mode = merge_input.lower() in ['y', 'yes', '是']
-    
-    return input_file, output_file, api_key, country_files_dir, merge_mode, max_workers
-
-def main():
-    """
-    主函数
-    """
-    parser = argparse.ArgumentParser(description='IP地区分类工具 - 使用ipapi.is API服务')
-    parser.add_argument('input_file', nargs='?', default='ips.txt', help='包含IP地址的文件路径（默认: ips.txt）')
-    parser.add_argument('-o', '--output', default='iptest_results.json', help='输出文件名（默认: iptest_results.json）')
-    parser.add_argument('-k', '--api-key', help='ipapi.is的API密钥（可选，默认使用内置密钥）')
-    parser.add_argument('-d', '--country-dir', default='country_files', help='国家分类文件输出目录（默认: country_files）')
-    parser.add_argument('-t', '--threads', type=int, default=5, help='并发线程数（1-20，默认: 5）')
-    parser.add_argument('--merge', action='store_true', help='合并模式：将新IP合并到现有文件中，而不是覆盖')
-    parser.add_argument('--no-interactive', action='store_true', help='非交互模式，使用默认值')
-    
-    args = parser.parse_args()
-    
-    # 验证线程数参数
-    if not (1 <= args.threads <= 20):
-        print("错误：线程数必须在1-20之间")
-        return
-    
-    print("IP地区分类工具")
-    print("使用ipapi.is API服务\n")
-    
-    # 检查是否使用交互模式
-    if not args.no_interactive and len(sys.argv) == 1:
-        # 没有命令行参数，使用交互模式
-        input_file, output_file, api_key, country_files_dir, merge_mode, max_workers = interactive_mode()
-    else:
-        # 使用命令行参数
-        input_file = args.input_file
-        output_file = args.output
-        api_key = args.api_key
-        country_files_dir = args.country_dir
-        max_workers = args.threads
-        merge_mode = args.merge
-    
-    # 加载IP列表
-    ip_list = load_ip_list(input_file)
-    if not ip_list:
-        print(f"未找到有效的IP地址，程序退出。")
-        return
-    
-    print(f"\n加载了 {len(ip_list)} 个IP地址")
-    print(f"输入文件: {input_file}")
-    print(f"JSON输出文件: {output_file}")
-    print(f"国家分类文件目录: {country_files_dir}")
-    
-    # 创建分类器实例
-    classifier = IPClassifier(api_key)
-    
-    # 进行分类
-    classified_ips, failed_ips = classifier.classify_ips_by_country(ip_list, max_workers)
-    
-    # 打印摘要
-    classifier.print_summary(classified_ips)
-    
-    # 输出统计信息
-    total_ips = len(ip_list)
-    successful_ips = total_ips - len(failed_ips)
-    failed_count = len(failed_ips)
-    
-    print("\n" + "=" * 50)
-    print("处理统计信息")
-    print("=" * 50)
-    print(f"总IP数量: {total_ips}")
-    print(f"成功查询: {successful_ips}")
-    print(f"查询失败: {failed_count}")
-    
-    if failed_count > 0:
-        print("\n失败的IP地址:")
-        for i, failed_ip in enumerate(failed_ips, 1):
-            print(f"  {i}. {failed_ip}")
-    
-    print("=" * 50)
-    
-    # 保存结果
-    classifier.save_results(classified_ips, output_file)
-    
-    # 创建按国家/地区分类的txt文件
-    if merge_mode:
-        print("\n使用合并模式创建国家分类文件...")
-        classifier.create_country_files(classified_ips, country_files_dir, merge_mode=True)
-        print(f"合并后的国家分类文件已保存到: {country_files_dir}/merged/")
-    else:
-        print("\n使用覆盖模式创建国家分类文件...")
-        classifier.create_country_files(classified_ips, country_files_dir, merge_mode=False)
-        print(f"国家分类文件已保存到: {country_files_dir}/")
-    
-    print(f"\n处理完成！")
-    print(f"JSON结果已保存到: {output_file}")
-
-if __name__ == "__main__":
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+IP地区分类脚本
+使用ipapi.is API服务对IP进行地理位置分类
+"""
+
+import os
+import sys
+import io
+import re
+import gzip
+import requests
+import json
+import time
+import argparse
+import contextlib
+import threading
+import sqlite3
+import copy
+import ipaddress
+import zlib
+import math
+import heapq
+import bisect
+import mmap
+import socket
+import struct
+from array import array
+import asyncio
+import random
+import cProfile
+import tracemalloc
+from statistics import NormalDist
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Optional, Iterable, Iterator
+from collections import defaultdict, OrderedDict, deque
+from collections.abc import Mapping, ItemsView, ValuesView
+
+try:
+    import aiohttp  # 可选依赖，仅异步引擎使用
+except ImportError:
+    aiohttp = None
+
+try:
+    import zstandard  # 可选依赖，仅读取 .zst 输入时使用
+except ImportError:
+    zstandard = None
+
+# 中文翻译映射表
+CHINESE_TRANSLATIONS = {
+    # 国家名称映射
+    'United States': '美国',
+    'China': '中国',
+    'Hong Kong': '中国香港',
+    'Taiwan': '中国台湾',
+    'Japan': '日本',
+    'South Korea': '韩国',
+    'Singapore': '新加坡',
+    'Germany': '德国',
+    'United Kingdom': '英国',
+    'France': '法国',
+    'Canada': '加拿大',
+    'Australia': '澳大利亚',
+    'Russia': '俄罗斯',
+    'India': '印度',
+    'Brazil': '巴西',
+    'Netherlands': '荷兰',
+    'Sweden': '瑞典',
+    'Switzerland': '瑞士',
+    'Spain': '西班牙',
+    'Italy': '意大利',
+    'Unknown': '未知',
+    
+    # 地区名称映射（常见地区）
+    'California': '加利福尼亚州',
+    'New York': '纽约州',
+    'Texas': '德克萨斯州',
+    'Florida': '佛罗里达州',
+    'Beijing': '北京',
+    'Shanghai': '上海',
+    'Guangdong': '广东',
+    'Zhejiang': '浙江',
+    'Jiangsu': '江苏',
+    'Tokyo': '东京',
+    'Osaka': '大阪',
+    'Seoul': '首尔',
+    'Berlin': '柏林',
+    'London': '伦敦',
+    'Paris': '巴黎',
+    'Sydney': '悉尼',
+    'Moscow': '莫斯科',
+    'Mumbai': '孟买',
+    'São Paulo': '圣保罗',
+    'Amsterdam': '阿姆斯特丹',
+    'Stockholm': '斯德哥尔摩',
+    'Zurich': '苏黎世',
+    'Madrid': '马德里',
+    'Rome': '罗马',
+    'Central and Western': '中西区',
+    
+    # 大洲映射
+    'Asia': '亚洲',
+    'North America': '北美洲',
+    'South America': '南美洲',
+    'Europe': '欧洲',
+    'Africa': '非洲',
+    'Oceania': '大洋洲',
+    'Antarctica': '南极洲',
+    
+    # 公司类型映射
+    'hosting': '托管服务',
+    'isp': '互联网服务提供商',
+    'business': '企业',
+    'education': '教育机构',
+    'government': '政府机构',
+    
+    # 字段名称映射
+    'ip': 'IP地址',
+    'country': '国家',
+    'country_code': '国家代码',
+    'region': '地区/州',
+    'city': '城市',
+    'latitude': '纬度',
+    'longitude': '经度',
+    'asn': '自治系统号',
+    'org': '组织',
+    'timezone': '时区',
+    'utc_offset': 'UTC偏移',
+    'country_calling_code': '国家电话代码',
+    'currency': '货币',
+    'languages': '语言',
+    'country_flag': '国旗',
+    'country_flag_emoji': '国旗表情',
+    'country_area': '国家面积',
+    'country_population': '国家人口',
+    'continent': '大洲',
+    'in_eu': '是否在欧盟',
+    'postal': '邮政编码',
+    
+    # 新增完整API字段映射
+    'rir': '区域互联网注册机构',
+    'is_bogon': '是否为保留IP',
+    'is_mobile': '是否为移动网络',
+    'is_satellite': '是否为卫星网络',
+    'is_crawler': '是否为爬虫',
+    'is_datacenter': '是否为数据中心',
+    'is_tor': '是否为Tor网络',
+    'is_proxy': '是否为代理',
+    'is_vpn': '是否为VPN',
+    'is_abuser': '是否为滥用者',
+    'is_eu_member': '是否为欧盟成员国',
+    'is_dst': '是否为夏令时',
+    'abuser_score': '滥用评分',
+    'route': '路由',
+    'descr': '描述',
+    'active': '是否活跃',
+    'domain': '域名',
+    'abuse': '滥用联系人',
+    'type': '类型',
+    'updated': '更新时间',
+    'network': '网络',
+    'datacenter': '数据中心',
+    'name': '名称',
+    'address': '地址',
+    'email': '邮箱',
+    'phone': '电话',
+    'calling_code': '电话代码',
+    'currency_code': '货币代码',
+    'state': '州/省',
+    'zip': '邮编',
+    'local_time': '本地时间',
+    'local_time_unix': '本地时间戳',
+    'elapsed_ms': '耗时(毫秒)',
+    'inherited_from': '继承自网段',
+    
+    # 嵌套对象名称映射
+    'company': '公司信息',
+    'abuse': '滥用联系人信息',
+    'asn': '自治系统信息',
+    'location': '位置信息'
+}
+
+def translate_to_chinese(text: str) -> str:
+    """
+    将文本翻译成中文
+    :param text: 原始文本
+    :return: 中文翻译
+    """
+    if not text:
+        return text
+    return CHINESE_TRANSLATIONS.get(text, text)
+
+# 中文到英文的反向映射，用于读取旧版（已翻译）结果文件
+REVERSE_TRANSLATIONS = {chinese: english for english, chinese in CHINESE_TRANSLATIONS.items()}
+
+# 查询结果中的嵌套结构
+RECORD_SECTIONS = ('company', 'abuse', 'asn', 'location')
+# 嵌套结构中除is_*以外的布尔字段，中文输出时转换为"是/否"
+SECTION_BOOLEAN_FIELDS = ('active',)
+
+class RecordTranslator:
+    """
+    按输出语言转换查询结果。中文输出按记录结构（字段名及其顺序）预先编译字段名映射和每个字段的取值处理方式，
+    同一结构的记录只编译一次，之后每条记录只做一次平铺的转换；英文输出直接返回规范结构
+    """
+
+    # 嵌套结构转换结果缓存的最大条目数
+    SECTION_CACHE_SIZE = 65536
+
+    def __init__(self, lang: str = 'zh'):
+        """
+        :param lang: 输出语言：'zh'为中文（字段名和取值翻译成中文），'en'为原始英文
+        """
+        if lang not in OUTPUT_LANGUAGES:
+            raise ValueError(f"不支持的输出语言: {lang}")
+        self.lang = lang
+        # 记录结构 -> (中文字段名, is_*标识的位置, 嵌套结构的位置)
+        self.record_plans = {}
+        # 嵌套结构 -> (中文字段名, 布尔字段的位置)
+        self.section_plans = {}
+        # (嵌套结构, 取值) -> 转换结果，输出只用于序列化，同一结果可以被多条记录共享
+        self.section_cache = {}
+
+    def _plan(self, record, plans: dict, compile_plan):
+        # 紧凑记录以共享的字段表作为结构标识，普通字典以字段名元组作为结构标识
+        shape = record._schema if type(record) is CompactRecord else tuple(record)
+        plan = plans.get(shape)
+        if plan is None:
+            plan = plans[shape] = compile_plan(tuple(record))
+        return plan
+
+    @staticmethod
+    def _compile_record(fields: tuple) -> tuple:
+        keys = tuple(CHINESE_TRANSLATIONS.get(key, key) for key in fields)
+        flags = tuple(i for i, key in enumerate(fields) if key.startswith('is_'))
+        sections = tuple(i for i, key in enumerate(fields) if key in RECORD_SECTIONS)
+        return keys, flags, sections
+
+    @staticmethod
+    def _compile_section(fields: tuple) -> tuple:
+        keys = tuple(CHINESE_TRANSLATIONS.get(key, key) for key in fields)
+        booleans = tuple(i for i, key in enumerate(fields) if key.startswith('is_') or key in SECTION_BOOLEAN_FIELDS)
+        return keys, booleans
+
+    def _section(self, section) -> Dict:
+        keys, booleans = self._plan(section, self.section_plans, self._compile_section)
+        values = tuple(section.values())
+        # 嵌套结构的取值在大量记录间重复（同一ASN、同一网段、同一城市），转换结果按取值缓存
+        cache_key = (id(keys), values)
+        try:
+            cached = self.section_cache.get(cache_key)
+        except TypeError:
+            # 取值中有不可哈希的对象（如列表），不缓存
+            cache_key = cached = None
+        if cached is not None:
+            return cached
+        
+        translated = [CHINESE_TRANSLATIONS.get(value, value) if type(value) is str else value for value in values]
+        for i in booleans:
+            value = values[i]
+            if type(value) is bool:
+                translated[i] = '是' if value else '否'
+        translated = dict(zip(keys, translated))
+        if cache_key is not None:
+            if len(self.section_cache) >= self.SECTION_CACHE_SIZE:
+                self.section_cache.clear()
+            self.section_cache[cache_key] = translated
+        return translated
+
+    def record(self, record) -> Dict:
+        """
+        转换一条记录（普通字典或紧凑记录）
+        :param record: 规范结构的查询结果
+        :return: 输出格式的字典
+        """
+        if self.lang == 'en':
+            return as_plain_record(record)
+        keys, flags, sections = self._plan(record, self.record_plans, self._compile_record)
+        values = list(record.values())
+        for i in flags:
+            value = values[i]
+            if type(value) is bool:
+                values[i] = '是' if value else '否'
+        for i in sections:
+            value = values[i]
+            if type(value) is dict or type(value) is CompactRecord:
+                values[i] = self._section(value)
+        return dict(zip(keys, values))
+
+    def group(self, country: str) -> str:
+        """
+        转换分组（国家）名称
+        """
+        return translate_to_chinese(country) if self.lang == 'zh' else country
+
+# 支持的输出语言
+OUTPUT_LANGUAGES = ('zh', 'en')
+OUTPUT_LANGUAGE_NOTES = {'zh': '字段名已翻译成中文', 'en': '原始英文字段'}
+_TRANSLATORS = {}
+
+def get_translator(lang: str = 'zh') -> RecordTranslator:
+    """
+    获取（共享的）输出语言转换器，编译结果在多次输出之间复用
+    :param lang: 输出语言
+    :return: 转换器
+    """
+    translator = _TRANSLATORS.get(lang)
+    if translator is None:
+        translator = _TRANSLATORS[lang] = RecordTranslator(lang)
+    return translator
+
+def canonicalize_record(record: Dict) -> Dict:
+    """
+    将旧版结果文件中已翻译的记录还原为规范结构（英文字段名、原始值）
+    :param record: 旧版结果文件中的记录
+    :return: 规范结构的查询结果
+    """
+    def restore_value(value):
+        if value == '是':
+            return True
+        if value == '否':
+            return False
+        if isinstance(value, str):
+            return REVERSE_TRANSLATIONS.get(value, value)
+        return value
+    
+    canonical = {}
+    for key, value in record.items():
+        english_key = REVERSE_TRANSLATIONS.get(key, key)
+        if isinstance(value, dict):
+            canonical[english_key] = {REVERSE_TRANSLATIONS.get(k, k): restore_value(v) for k, v in value.items()}
+        elif english_key.startswith('is_') and value in ('是', '否'):
+            canonical[english_key] = value == '是'
+        else:
+            canonical[english_key] = value
+    return canonical
+
+# 取值高度重复的字段（国家、大洲、时区、RIR、ASN组织、公司类型等），紧凑记录中相同的值只保留一个对象
+COMPACT_POOLED_FIELDS = frozenset((
+    'rir', 'country', 'country_code', 'continent', 'timezone', 'currency_code', 'calling_code',
+    'type', 'name', 'org', 'descr',
+))
+
+# 取值池最多保留的字符串数，达到上限后新出现的取值不再共享（已共享的取值不受影响）
+COMPACT_POOL_SIZE = 100000
+
+class _CompactSchema:
+    """
+    紧凑记录的字段表：相同字段顺序的记录共享同一个字段表
+    """
+    __slots__ = ('fields', 'positions', 'pooled')
+
+    def __init__(self, fields: tuple):
+        self.fields = fields
+        self.positions = {field: i for i, field in enumerate(fields)}
+        self.pooled = tuple(field in COMPACT_POOLED_FIELDS for field in fields)
+
+class CompactRecord(Mapping):
+    """
+    查询结果的紧凑表示：字段名保存在共享的字段表中，值保存在元组中，嵌套结构同样为CompactRecord，
+    重复的分类取值（见COMPACT_POOLED_FIELDS）共享同一个字符串对象。
+    实现只读的Mapping接口（get、[]、in、items等），序列化前用to_dict()转换为普通字典
+    """
+    __slots__ = ('_schema', '_values')
+
+    # 字段顺序 -> 字段表
+    _schemas: Dict[tuple, _CompactSchema] = {}
+    # 分类取值池（只包含低基数的字段，条目数不超过COMPACT_POOL_SIZE）
+    _pool: Dict[str, str] = {}
+
+    def __init__(self, schema: _CompactSchema, values: tuple):
+        self._schema = schema
+        self._values = values
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'CompactRecord':
+        """
+        由查询结果字典构造紧凑记录
+        :param data: 查询结果（嵌套字典）
+        :return: 紧凑记录
+        """
+        fields = tuple(data)
+        schema = cls._schemas.get(fields)
+        if schema is None:
+            schema = cls._schemas.setdefault(fields, _CompactSchema(fields))
+        pool = cls._pool
+        intern = pool.setdefault if len(pool) < COMPACT_POOL_SIZE else pool.get
+        return cls(schema, tuple([
+            cls.from_dict(value) if type(value) is dict
+            else intern(value, value) if pooled and type(value) is str
+            else value
+            for value, pooled in zip(data.values(), schema.pooled)
+        ]))
+
+    def to_dict(self) -> Dict:
+        """
+        转换为普通的嵌套字典（用于JSON序列化）
+        """
+        data = dict(zip(self._schema.fields, self._values))
+        for field, value in data.items():
+            if type(value) is CompactRecord:
+                data[field] = value.to_dict()
+        return data
+
+    def __getitem__(self, key):
+        position = self._schema.positions.get(key)
+        if position is None:
+            raise KeyError(key)
+        return self._values[position]
+
+    def get(self, key, default=None):
+        position = self._schema.positions.get(key)
+        return default if position is None else self._values[position]
+
+    def __contains__(self, key):
+        return key in self._schema.positions
+
+    def __iter__(self):
+        return iter(self._schema.fields)
+
+    def __len__(self):
+        return len(self._values)
+
+    def values(self):
+        return _CompactValuesView(self)
+
+    def items(self):
+        return _CompactItemsView(self)
+
+    def __repr__(self):
+        return f"CompactRecord({self.to_dict()!r})"
+
+class _CompactValuesView(ValuesView):
+    """
+    紧凑记录的values()视图，直接遍历值元组
+    """
+    __slots__ = ()
+
+    def __iter__(self):
+        return iter(self._mapping._values)
+
+class _CompactItemsView(ItemsView):
+    """
+    紧凑记录的items()视图，直接按字段表遍历
+    """
+    __slots__ = ()
+
+    def __iter__(self):
+        return zip(self._mapping._schema.fields, self._mapping._values)
+
+def as_plain_record(record) -> Dict:
+    """
+    将紧凑记录转换为普通字典，普通字典原样返回
+    """
+    return record.to_dict() if isinstance(record, CompactRecord) else record
+
+class LookupCache:
+    """
+    IP查询结果缓存：内存LRU层 + SQLite持久化层，按TTL判断过期
+    """
+
+    def __init__(self, db_path: str, ttl: float = 86400, memory_size: int = 10000, flush_every: int = 500):
+        """
+        初始化查询缓存
+        :param db_path: SQLite缓存文件路径
+        :param ttl: 缓存有效期（秒），小于等于0表示永不过期
+        :param memory_size: 内存LRU层最多保留的条目数
+        :param flush_every: 累计多少条写入后提交一次到磁盘
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # ip -> (查询时间戳, 查询结果)
+        self.pending = []
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'expired': 0, 'writes': 0}
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS lookups ('
+            'ip TEXT PRIMARY KEY, fetched_at REAL NOT NULL, data TEXT NOT NULL)'
+        )
+        self.conn.commit()
+
+    def _is_expired(self, fetched_at: float) -> bool:
+        return self.ttl > 0 and time.time() - fetched_at > self.ttl
+
+    def _remember(self, ip: str, fetched_at: float, record: Dict):
+        """
+        写入内存LRU层，超出容量时淘汰最久未使用的条目（调用方需持有锁）
+        """
+        self.memory[ip] = (fetched_at, record)
+        self.memory.move_to_end(ip)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get(self, ip: str) -> Optional[Dict]:
+        """
+        查询缓存
+        :param ip: IP地址
+        :return: 未过期的缓存结果，未命中或已过期返回None
+        """
+        with self.lock:
+            entry = self.memory.get(ip)
+            if entry is not None:
+                if not self._is_expired(entry[0]):
+                    self.memory.move_to_end(ip)
+                    self.stats['memory_hits'] += 1
+                    return entry[1]
+                del self.memory[ip]
+                self.stats['expired'] += 1
+                return None
+
+            row = self.conn.execute('SELECT fetched_at, data FROM lookups WHERE ip = ?', (ip,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            if self._is_expired(row[0]):
+                self.stats['expired'] += 1
+                return None
+
+            record = json.loads(row[1])
+            self._remember(ip, row[0], record)
+            self.stats['disk_hits'] += 1
+            return record
+
+    def put(self, ip: str, record: Dict):
+        """
+        写入缓存，磁盘写入按批提交
+        :param ip: IP地址
+        :param record: 查询结果
+        """
+        fetched_at = time.time()
+        with self.lock:
+            self._remember(ip, fetched_at, record)
+            self.pending.append((ip, fetched_at, json.dumps(record, ensure_ascii=False)))
+            self.stats['writes'] += 1
+            if len(self.pending) >= self.flush_every:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if not self.pending:
+            return
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO lookups (ip, fetched_at, data) VALUES (?, ?, ?)',
+            self.pending
+        )
+        self.conn.commit()
+        self.pending = []
+
+    def flush(self):
+        """
+        将尚未提交的缓存写入磁盘
+        """
+        with self.lock:
+            self._flush_locked()
+
+    def close(self):
+        """
+        提交剩余写入并关闭数据库连接
+        """
+        with self.lock:
+            self._flush_locked()
+            self.conn.close()
+
+def ip_sort_key(ip_str: str) -> int:
+    """
+    将IP地址转换为单个可排序的整数，IPv4排在IPv6之前，两者各自按数值大小排序
+    :param ip_str: IP地址字符串
+    :return: 排序用整数，无效地址返回-1
+    """
+    try:
+        address = ipaddress.ip_address(ip_str)
+    except ValueError:
+        return -1
+    return (address.version << 128) | int(address)
+
+# 需要退避重试的HTTP状态码
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# 单次重试前的最长等待时间（秒），指数退避和服务端给出的Retry-After都不超过该值
+MAX_RETRY_DELAY = 30.0
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析Retry-After响应头，结果不超过MAX_RETRY_DELAY，避免一个过大的值让查询长时间停顿
+    :param value: 响应头的值（秒数或HTTP日期）
+    :return: 需要等待的秒数，无法解析时返回None
+    """
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    if math.isnan(delay):
+        return None
+    return min(MAX_RETRY_DELAY, max(0.0, delay))
+
+class AdaptiveRateLimiter:
+    """
+    令牌桶限速器，按AIMD方式自动调整速率：
+    请求成功时速率线性增加，遇到限流时速率减半，从而收敛到服务端实际可承受的速率
+    """
+
+    def __init__(self, rate: float = 20, min_rate: float = 1, max_rate: float = 1000,
+                 increase: float = 5, decrease: float = 0.5):
+        """
+        初始化限速器
+        :param rate: 初始速率（次/秒）
+        :param min_rate: 最低速率
+        :param max_rate: 最高速率
+        :param increase: 持续成功时每秒增加的速率
+        :param decrease: 遇到限流时速率的乘数
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.lock = threading.Lock()
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.stats = {'throttled': 0, 'retries': 0}
+
+    def reserve(self) -> float:
+        """
+        预约一个令牌
+        :return: 发送请求前需要等待的秒数
+        """
+        with self.lock:
+            now = time.monotonic()
+            burst = max(1.0, self.rate)
+            self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.blocked_until - now)
+
+    def acquire(self):
+        """
+        阻塞直到可以发送请求
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """
+        acquire的异步版本
+        """
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        """
+        请求成功：线性增加速率（每秒约增加increase）
+        """
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        """
+        遇到限流：速率减半，并在Retry-After期间暂停所有请求
+        :param retry_after: 服务端要求等待的秒数
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.stats['throttled'] += 1
+            # 同一批并发请求同时被限流时只降速一次
+            if now - self.last_decrease > 1.0 / self.rate + 0.5:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.last_decrease = now
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def on_retry(self):
+        with self.lock:
+            self.stats['retries'] += 1
+
+# 延迟直方图的桶上限（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 服务端elapsed_ms通常在毫秒以下，使用更细的桶
+PROVIDER_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class LatencyHistogram:
+    """
+    累积式延迟直方图（与Prometheus histogram语义一致），分位数按桶内线性插值估算
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        估算分位数
+        :param q: 分位（0-1）
+        :return: 估算值（秒），没有数据时返回None
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def summary(self) -> Dict:
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': round(self.sum / self.count * 1000, 3),
+            'p50_ms': round(self.quantile(0.5) * 1000, 3),
+            'p90_ms': round(self.quantile(0.9) * 1000, 3),
+            'p99_ms': round(self.quantile(0.99) * 1000, 3),
+        }
+
+    def prometheus_lines(self, name: str, labels: str = '') -> List[str]:
+        prefix = f"{labels}," if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ''
+        lines.append(f"{name}_sum{suffix} {self.sum:.6f}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+class LookupMetrics:
+    """
+    查询指标：客户端请求延迟直方图、服务端elapsed_ms、连接复用、重试、按类别统计的错误和各阶段耗时，
+    可导出为Prometheus文本格式（文件或HTTP端点）和JSON摘要
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        # 每次HTTP请求（单次尝试）的耗时，按请求方法区分
+        self.request_latency = defaultdict(LatencyHistogram)
+        # 单个IP的API查询耗时（包括重试和退避）
+        self.lookup_latency = LatencyHistogram()
+        # 服务端返回的elapsed_ms
+        self.provider_latency = LatencyHistogram(PROVIDER_BUCKETS)
+        self.requests = defaultdict(int)
+        self.lookups = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.retries = 0
+        self.stages = OrderedDict()
+        self.sessions = []
+        self.async_connections = {'new': 0, 'reused': 0}
+
+    def observe_request(self, method: str, seconds: float, status: Optional[int] = None,
+                        error: Optional[str] = None):
+        """
+        记录一次HTTP请求
+        :param method: 请求方法
+        :param seconds: 耗时（秒）
+        :param status: HTTP状态码，请求未完成时为None
+        :param error: 错误类别（timeout、connection、http_<状态码>、json_decode）
+        """
+        with self.lock:
+            self.request_latency[method.lower()].observe(seconds)
+            self.requests[str(status) if status is not None else 'none'] += 1
+            if error is not None:
+                self.errors[error] += 1
+
+    def observe_lookup(self, seconds: float):
+        with self.lock:
+            self.lookup_latency.observe(seconds)
+
+    def observe_provider(self, elapsed_ms):
+        if isinstance(elapsed_ms, (int, float)):
+            with self.lock:
+                self.provider_latency.observe(elapsed_ms / 1000)
+
+    def count_lookup(self, source: str):
+        """
+        :param source: 结果来源（cache、offline、network、api）或failed
+        """
+        with self.lock:
+            self.lookups[source] += 1
+
+    def count_error(self, error: str):
+        with self.lock:
+            self.errors[error] += 1
+
+    def count_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def stage(self, name: str):
+        """
+        记录某个阶段耗时的上下文管理器，同名阶段的耗时累加
+        :param name: 阶段名称（load、classify、save、country_files等）
+        """
+        metrics = self
+
+        class _Stage:
+            def __enter__(self):
+                self.start = time.perf_counter()
+                return self
+
+            def __exit__(self, *exc):
+                elapsed = time.perf_counter() - self.start
+                with metrics.lock:
+                    metrics.stages[name] = metrics.stages.get(name, 0.0) + elapsed
+                return False
+
+        return _Stage()
+
+    def watch_session(self, session: requests.Session):
+        """
+        登记requests会话，导出时从其urllib3连接池读取新建连接数和请求数
+        """
+        self.sessions.append(session)
+
+    def trace_config(self):
+        """
+        生成aiohttp的TraceConfig，统计异步引擎的新建连接和复用连接
+        """
+        trace = aiohttp.TraceConfig()
+
+        async def on_create(session, context, params):
+            with self.lock:
+                self.async_connections['new'] += 1
+
+        async def on_reuse(session, context, params):
+            with self.lock:
+                self.async_connections['reused'] += 1
+
+        trace.on_connection_create_end.append(on_create)
+        trace.on_connection_reuseconn.append(on_reuse)
+        return trace
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        :return: 新建连接数和复用连接发出的请求数
+        """
+        new = self.async_connections['new']
+        reused = self.async_connections['reused']
+        for session in self.sessions:
+            for adapter in session.adapters.values():
+                pools = getattr(getattr(adapter, 'poolmanager', None), 'pools', None)
+                if pools is None:
+                    continue
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    new += pool.num_connections
+                    reused += max(0, pool.num_requests - pool.num_connections)
+        return {'new': new, 'reused': reused}
+
+    def summary(self) -> Dict:
+        """
+        生成运行结束时的JSON摘要
+        """
+        connections = self.connection_stats()
+        with self.lock:
+            total_connections = connections['new'] + connections['reused']
+            return {
+                'elapsed_seconds': round(time.time() - self.started_at, 3),
+                'stages_seconds': {name: round(value, 4) for name, value in self.stages.items()},
+                'lookups': dict(self.lookups),
+                'requests': dict(self.requests),
+                'request_latency': {method: hist.summary() for method, hist in self.request_latency.items()},
+                'lookup_latency': self.lookup_latency.summary(),
+                'provider_elapsed': self.provider_latency.summary(),
+                'retries': self.retries,
+                'errors': dict(self.errors),
+                'connections': dict(connections, reuse_ratio=round(connections['reused'] / total_connections, 4)
+                                    if total_connections else None),
+            }
+
+    def render_prometheus(self) -> str:
+        """
+        生成Prometheus文本格式的指标
+        """
+        connections = self.connection_stats()
+        with self.lock:
+            lines = [
+                '# HELP iptest_request_duration_seconds HTTP request latency per attempt.',
+                '# TYPE iptest_request_duration_seconds histogram',
+            ]
+            for method, hist in sorted(self.request_latency.items()):
+                lines.extend(hist.prometheus_lines('iptest_request_duration_seconds', f'method="{method}"'))
+            lines += ['# HELP iptest_lookup_duration_seconds API lookup latency per IP, including retries.',
+                      '# TYPE iptest_lookup_duration_seconds histogram']
+            lines.extend(self.lookup_latency.prometheus_lines('iptest_lookup_duration_seconds'))
+            lines += ['# HELP iptest_provider_elapsed_seconds Provider-reported elapsed_ms.',
+                      '# TYPE iptest_provider_elapsed_seconds histogram']
+            lines.extend(self.provider_latency.prometheus_lines('iptest_provider_elapsed_seconds'))
+            lines += ['# HELP iptest_requests_total HTTP requests by status code.',
+                      '# TYPE iptest_requests_total counter']
+            lines.extend(f'iptest_requests_total{{status="{status}"}} {count}'
+                         for status, count in sorted(self.requests.items()))
+            lines += ['# HELP iptest_lookups_total Lookups by result source.',
+                      '# TYPE iptest_lookups_total counter']
+            lines.extend(f'iptest_lookups_total{{source="{source}"}} {count}'
+                         for source, count in sorted(self.lookups.items()))
+            lines += ['# HELP iptest_errors_total Errors by class.',
+                      '# TYPE iptest_errors_total counter']
+            lines.extend(f'iptest_errors_total{{class="{error}"}} {count}'
+                         for error, count in sorted(self.errors.items()))
+            lines += ['# HELP iptest_retries_total Retried requests.',
+                      '# TYPE iptest_retries_total counter',
+                      f'iptest_retries_total {self.retries}',
+                      '# HELP iptest_connections_total Requests on new and reused connections.',
+                      '# TYPE iptest_connections_total counter',
+                      f'iptest_connections_total{{state="new"}} {connections["new"]}',
+                      f'iptest_connections_total{{state="reused"}} {connections["reused"]}',
+                      '# HELP iptest_stage_seconds Wall time spent in each pipeline stage.',
+                      '# TYPE iptest_stage_seconds gauge']
+            lines.extend(f'iptest_stage_seconds{{stage="{name}"}} {value:.6f}'
+                         for name, value in self.stages.items())
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, file_path: str):
+        """
+        以原子替换的方式写入Prometheus文本文件（可供node_exporter的textfile collector读取）
+        """
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, file_path)
+
+    def write_json(self, file_path: str):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+
+    def serve(self, port: int, host: str = '127.0.0.1'):
+        """
+        在后台线程中提供 /metrics HTTP端点
+        :param port: 监听端口，0表示由系统分配
+        :param host: 监听地址，默认只监听本机
+        :return: HTTP服务实例
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+class StageProfiler:
+    """
+    --profile使用的阶段剖析器：记录每个阶段的墙钟时间、进程CPU时间和tracemalloc内存峰值，
+    可选为每个阶段保存cProfile数据；查询过程中的HTTP请求、记录构建、翻译等环节分散在多个线程中，
+    按环节跨线程累计耗时
+    """
+
+    def __init__(self, cprofile_dir: Optional[str] = None, trace_memory: bool = True):
+        """
+        :param cprofile_dir: 如果指定，每个阶段的cProfile数据保存为该目录下的 <阶段名>.prof
+        :param trace_memory: 是否使用tracemalloc跟踪内存（会明显拖慢运行）
+        """
+        self.lock = threading.Lock()
+        self.cprofile_dir = cprofile_dir
+        self.trace_memory = trace_memory
+        # 阶段名 -> {'wall', 'cpu', 'peak', 'net'}，同名阶段累加（内存峰值取最大）
+        self.stages = OrderedDict()
+        # 环节名 -> [次数, 墙钟时间, 线程CPU时间]
+        self.sections = OrderedDict()
+        self.profiles = OrderedDict()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        剖析一个阶段的上下文管理器（阶段不应嵌套）
+        :param name: 阶段名称（load、classify、save、country_files等）
+        """
+        profile = None
+        if self.cprofile_dir:
+            profile = self.profiles.get(name)
+            if profile is None:
+                profile = self.profiles[name] = cProfile.Profile()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            stats = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'peak': 0, 'net': 0})
+            stats['wall'] += wall
+            stats['cpu'] += cpu
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                stats['peak'] = max(stats['peak'], peak - base)
+                stats['net'] += current - base
+
+    @contextlib.contextmanager
+    def section(self, name: str, cpu: bool = True):
+        """
+        累计一个环节耗时的上下文管理器，可在多个线程中同时使用
+        :param name: 环节名称（http、build_record、translate等）
+        :param cpu: 是否记录线程CPU时间（协程中会混入其他协程的时间，应传False）
+        """
+        wall = time.perf_counter()
+        thread_cpu = time.thread_time() if cpu else None
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall,
+                     time.thread_time() - thread_cpu if cpu else None)
+
+    def add(self, name: str, wall: float, cpu: Optional[float] = None):
+        with self.lock:
+            section = self.sections.get(name)
+            if section is None:
+                section = self.sections[name] = [0, 0.0, None]
+            section[0] += 1
+            section[1] += wall
+            if cpu is not None:
+                section[2] = (section[2] or 0.0) + cpu
+
+    def timed(self, name: str, func):
+        """
+        包装函数，每次调用计入指定环节
+        """
+        def wrapper(*args, **kwargs):
+            with self.section(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def print_report(self):
+        """
+        打印各阶段和各环节的耗时、内存表，并保存cProfile数据
+        """
+        mb = 1024 * 1024
+        print("\n=== 性能剖析 ===")
+        print(f"{'stage':<16} {'wall(s)':>9} {'cpu(s)':>9} {'cpu%':>6} {'peak(MB)':>9} {'net(MB)':>9}")
+        total_wall = total_cpu = 0.0
+        for name, stats in self.stages.items():
+            total_wall += stats['wall']
+            total_cpu += stats['cpu']
+            ratio = stats['cpu'] / stats['wall'] * 100 if stats['wall'] else 0
+            memory = (f"{stats['peak'] / mb:>9.1f} {stats['net'] / mb:>9.1f}" if self.trace_memory
+                      else f"{'-':>9} {'-':>9}")
+            print(f"{name:<16} {stats['wall']:>9.3f} {stats['cpu']:>9.3f} {ratio:>5.0f}% {memory}")
+        ratio = total_cpu / total_wall * 100 if total_wall else 0
+        print(f"{'total':<16} {total_wall:>9.3f} {total_cpu:>9.3f} {ratio:>5.0f}%")
+        
+        if self.sections:
+            print("\n各环节累计耗时（多个线程的时间相加，可能超过阶段的墙钟时间；http包含rate_wait和backoff）:")
+            print(f"{'section':<16} {'calls':>9} {'wall(s)':>9} {'cpu(s)':>9} {'avg(ms)':>9}")
+            for name, (calls, wall, cpu) in self.sections.items():
+                cpu_text = f"{cpu:>9.3f}" if cpu is not None else f"{'-':>9}"
+                print(f"{name:<16} {calls:>9} {wall:>9.3f} {cpu_text} {wall / calls * 1000:>9.3f}")
+        
+        if self.profiles:
+            os.makedirs(self.cprofile_dir, exist_ok=True)
+            for name, profile in self.profiles.items():
+                profile.dump_stats(os.path.join(self.cprofile_dir, f"{name}.prof"))
+            print(f"\ncProfile数据已保存到: {self.cprofile_dir}/<阶段名>.prof（可用 python -m pstats 查看；"
+                  f"只包含主线程，线程引擎的查询细节请配合 --engine async 剖析）")
+
+    def close(self):
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+# 查询结果中的顶层字段，网段缓存按策略决定哪些可以从网段继承
+NETWORK_INHERITABLE_FIELDS = (
+    'rir', 'is_bogon', 'is_mobile', 'is_satellite', 'is_crawler', 'is_datacenter',
+    'is_tor', 'is_proxy', 'is_vpn', 'is_abuser', 'company', 'abuse', 'asn', 'location'
+)
+
+# 本地应答（网段库）中保持与API查询结果相同的顶层字段
+RECORD_TEMPLATE_FIELDS = ('rir', 'is_bogon', 'is_mobile', 'is_satellite', 'is_crawler', 'is_datacenter',
+                          'is_tor', 'is_proxy', 'is_vpn', 'is_abuser', 'elapsed_ms',
+                          'company', 'abuse', 'asn', 'location')
+
+# 默认只继承与网段强相关的信息，is_vpn/is_tor等标识必须逐IP查询
+DEFAULT_NETWORK_INHERIT = ('asn', 'company', 'location')
+
+# 网段缓存命中、但记录中有不可继承的字段时的处理方式：
+#   lookup  仍然逐IP查询API（默认），只有继承字段覆盖全部字段时才在本地应答
+#   unknown 在本地应答，不可继承的字段明确标记为未知（取值为None，并在inherited_from中注明来源网段）
+NETWORK_CACHE_POLICIES = ('lookup', 'unknown')
+
+def parse_network_range(value: Optional[str]) -> list:
+    """
+    解析API返回的网段字符串（如"1.1.1.0/24"或"1.1.1.0 - 1.1.1.255"）
+    :param value: 网段字符串
+    :return: 对应的CIDR网络列表，无法解析时返回空列表
+    """
+    if not value or not isinstance(value, str):
+        return []
+    try:
+        if '-' in value and '/' not in value:
+            first, last = (part.strip() for part in value.split('-', 1))
+            return list(ipaddress.summarize_address_range(
+                ipaddress.ip_address(first), ipaddress.ip_address(last)))
+        return [ipaddress.ip_network(value.strip(), strict=False)]
+    except ValueError:
+        return []
+
+class NetworkCache:
+    """
+    网段缓存：根据已查询结果中的company.network和asn.route建立网段索引，
+    之后落在已知网段内的IP按继承策略直接在本地应答
+    """
+
+    # 过于宽泛的网段不参与索引，避免错误继承
+    MIN_PREFIXLEN = {4: 8, 6: 16}
+
+    def __init__(self, inherit_fields=DEFAULT_NETWORK_INHERIT, policy: str = 'lookup'):
+        """
+        初始化网段缓存
+        :param inherit_fields: 允许从网段继承的顶层字段
+        :param policy: 记录中有不可继承的字段时的处理方式，见NETWORK_CACHE_POLICIES
+        """
+        unknown = set(inherit_fields) - set(NETWORK_INHERITABLE_FIELDS)
+        if unknown:
+            raise ValueError(f"不支持继承的字段: {', '.join(sorted(unknown))}")
+        if policy not in NETWORK_CACHE_POLICIES:
+            raise ValueError(f"不支持的网段缓存策略: {policy}")
+        self.inherit_fields = tuple(inherit_fields)
+        self.policy = policy
+        # 继承字段覆盖全部字段时，本地应答与逐IP查询的结果等价
+        self.complete = set(NETWORK_INHERITABLE_FIELDS) <= set(inherit_fields)
+        # 命中已知网段时是否在本地应答
+        self.answers_locally = self.complete or policy == 'unknown'
+        self.lock = threading.Lock()
+        # 按IP版本和前缀长度分层：{版本: {前缀长度: {网络号: 查询结果}}}
+        self.index = {4: {}, 6: {}}
+        self.prefixlens = {4: [], 6: []}
+        self.range_count = 0
+        # needs_lookup：命中已知网段，但按lookup策略仍需逐IP查询
+        self.stats = {'hits': 0, 'misses': 0, 'needs_lookup': 0}
+
+    def learn(self, record: Dict):
+        """
+        从一条查询结果中学习网段
+        :param record: get_ip_location返回的查询结果
+        """
+        networks = parse_network_range((record.get('company') or {}).get('network'))
+        networks += parse_network_range((record.get('asn') or {}).get('route'))
+        if not networks:
+            return
+
+        with self.lock:
+            for network in networks:
+                if network.prefixlen < self.MIN_PREFIXLEN[network.version]:
+                    continue
+                layer = self.index[network.version].get(network.prefixlen)
+                if layer is None:
+                    layer = self.index[network.version][network.prefixlen] = {}
+                    self.prefixlens[network.version] = sorted(self.index[network.version], reverse=True)
+                key = int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+                if key not in layer:
+                    self.range_count += 1
+                layer[key] = (str(network), record)
+
+    def _match(self, ip: str) -> Optional[tuple]:
+        """
+        按最长前缀匹配查找包含该IP的已知网段
+        :return: (网段, 原始查询结果)，未找到返回None
+        """
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        value = int(address)
+        with self.lock:
+            layers = self.index[address.version]
+            for prefixlen in self.prefixlens[address.version]:
+                match = layers[prefixlen].get(value >> (address.max_prefixlen - prefixlen))
+                if match is not None:
+                    return match
+        return None
+
+    def find(self, ip: str) -> Optional[Dict]:
+        """
+        按最长前缀匹配查找包含该IP的已知网段
+        :param ip: IP地址
+        :return: 网段对应的原始查询结果，未找到返回None
+        """
+        match = self._match(ip)
+        return match[1] if match is not None else None
+
+    def lookup(self, ip: str) -> Optional[Dict]:
+        """
+        按继承策略构造本地应答
+        :param ip: IP地址
+        :return: 继承自网段的查询结果；未命中，或按lookup策略仍需逐IP查询时返回None
+        """
+        match = self._match(ip)
+        if match is None:
+            with self.lock:
+                self.stats['misses'] += 1
+            return None
+        network, source = match
+        if not self.answers_locally:
+            # 不可继承的字段（如is_vpn）只能逐IP查询，不能用None冒充查询结果
+            with self.lock:
+                self.stats['needs_lookup'] += 1
+            return None
+
+        result = {'ip': ip}
+        for key, value in source.items():
+            if key in ('ip', 'inherited_from'):
+                continue
+            if key in self.inherit_fields:
+                result[key] = copy.deepcopy(value)
+            elif isinstance(value, dict):
+                result[key] = {sub_key: None for sub_key in value}
+            else:
+                result[key] = None
+        if not self.complete:
+            # 明确标记这是继承自网段的部分结果，取值为None的字段表示未知而不是"否"
+            result['inherited_from'] = network
+        with self.lock:
+            self.stats['hits'] += 1
+        return result
+
+class OfflineRangeDB:
+    """
+    离线网段库：由历史查询结果编译成的二进制网段表，通过mmap加载，
+    查询时只需在起始地址数组上二分查找，加载时只解析第一条记录以确定包含的字段
+
+    文件格式（本机字节序）：
+      文件头  MAGIC | 字节序 | IPv4网段数 | IPv6网段数 | 记录数
+      IPv4    起始地址uint32[] | 结束地址uint32[] | 记录编号uint32[]
+      IPv6    起始地址16字节大端[] | 结束地址16字节大端[] | 记录编号uint32[]
+      记录    偏移uint64[记录数+1] | 去重后的记录JSON
+    """
+
+    MAGIC = b'IPRDB001'
+    HEADER = struct.Struct('<8s8sQQQ')
+
+    def __init__(self, path: str, policy: str = 'lookup'):
+        """
+        加载离线网段库
+        :param path: 网段库文件路径
+        :param policy: 网段库中缺少部分字段时的处理方式，与网段缓存相同，见NETWORK_CACHE_POLICIES
+        """
+        if policy not in NETWORK_CACHE_POLICIES:
+            raise ValueError(f"不支持的离线网段库策略: {policy}")
+        self.path = path
+        self.policy = policy
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byteorder, v4_count, v6_count, record_count = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{path} 不是有效的离线网段库")
+        if byteorder.rstrip(b'\0').decode() != sys.byteorder:
+            raise ValueError(f"{path} 由不同字节序的机器生成，请重新编译")
+        
+        view = memoryview(self.mm)
+        offset = self.HEADER.size
+        self.v4_starts = view[offset:offset + v4_count * 4].cast('I')
+        offset += v4_count * 4
+        self.v4_ends = view[offset:offset + v4_count * 4].cast('I')
+        offset += v4_count * 4
+        self.v4_records = view[offset:offset + v4_count * 4].cast('I')
+        offset += v4_count * 4
+        self.v6_starts = _FixedWidthKeys(view[offset:offset + v6_count * 16], 16)
+        offset += v6_count * 16
+        self.v6_ends = _FixedWidthKeys(view[offset:offset + v6_count * 16], 16)
+        offset += v6_count * 16
+        self.v6_records = view[offset:offset + v6_count * 4].cast('I')
+        offset += v6_count * 4
+        offset += -offset % 8
+        self.record_offsets = view[offset:offset + (record_count + 1) * 8].cast('Q')
+        self.records_base = offset + (record_count + 1) * 8
+        self.view = view
+        self.range_count = v4_count + v6_count
+        self.record_count = record_count
+        self.parsed = {}
+        # 每条记录都只包含编译时的继承字段，取第一条即可得到字段列表
+        self.inherit_fields = tuple(self._record(0)) if record_count else ()
+        self.complete = set(NETWORK_INHERITABLE_FIELDS) <= set(self.inherit_fields)
+        self.answers_locally = self.complete or policy == 'unknown'
+        # needs_lookup：命中网段，但按lookup策略仍需逐IP查询
+        self.stats = {'hits': 0, 'misses': 0, 'needs_lookup': 0}
+
+    def _record(self, record_no: int) -> Dict:
+        """
+        按需解析去重后的记录，解析结果缓存在内存中
+        """
+        record = self.parsed.get(record_no)
+        if record is None:
+            start = self.records_base + self.record_offsets[record_no]
+            end = self.records_base + self.record_offsets[record_no + 1]
+            record = self.parsed[record_no] = json.loads(self.view[start:end].tobytes())
+        return record
+
+    def _match(self, ip: str) -> Optional[tuple]:
+        """
+        查找包含该IP的网段
+        :param ip: IP地址
+        :return: (网段描述, 去重记录)，未找到返回None
+        """
+        # 使用inet_pton解析地址，比构造ipaddress对象快得多
+        try:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+            starts, ends, records = self.v4_starts, self.v4_ends, self.v4_records
+        except OSError:
+            try:
+                value = socket.inet_pton(socket.AF_INET6, ip)
+            except OSError:
+                return None
+            starts, ends, records = self.v6_starts, self.v6_ends, self.v6_records
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+        # IPv4为整数，IPv6为16字节大端地址，两者都可以直接构造地址对象
+        address = ipaddress.IPv4Address if records is self.v4_records else ipaddress.IPv6Address
+        first, last = address(starts[i]), address(ends[i])
+        networks = list(ipaddress.summarize_address_range(first, last))
+        network = str(networks[0]) if len(networks) == 1 else f"{first} - {last}"
+        return network, self._record(records[i])
+
+    def find(self, ip: str) -> Optional[Dict]:
+        """
+        查找包含该IP的网段
+        :param ip: IP地址
+        :return: 网段对应的去重记录，未找到返回None
+        """
+        match = self._match(ip)
+        return match[1] if match is not None else None
+
+    def lookup(self, ip: str) -> Optional[Dict]:
+        """
+        按与网段缓存相同的策略构造与API查询结果结构相同的本地应答
+        :param ip: IP地址
+        :return: 查询结果；未命中，或按lookup策略仍需逐IP查询时返回None
+        """
+        match = self._match(ip)
+        if match is None:
+            self.stats['misses'] += 1
+            return None
+        network, template = match
+        if not self.answers_locally:
+            # 网段库中没有的字段（如is_vpn）只能逐IP查询，不能用None冒充查询结果
+            self.stats['needs_lookup'] += 1
+            return None
+        self.stats['hits'] += 1
+        result = {'ip': ip}
+        for key in RECORD_TEMPLATE_FIELDS:
+            value = template.get(key)
+            if isinstance(value, dict):
+                value = copy.deepcopy(value)
+            elif value is None and key in RECORD_SECTIONS:
+                value = {}
+            result[key] = value
+        if not self.complete:
+            # 明确标记这是继承自网段的部分结果，取值为None的字段表示未知而不是"否"
+            result['inherited_from'] = network
+        return result
+
+    def close(self):
+        for name in ('v4_starts', 'v4_ends', 'v4_records', 'v6_records', 'record_offsets'):
+            getattr(self, name).release()
+        self.v6_starts.view.release()
+        self.v6_ends.view.release()
+        self.view.release()
+        self.mm.close()
+        self.file.close()
+
+    @classmethod
+    def compile(cls, records: Iterable[Dict], output_path: str,
+                inherit_fields=DEFAULT_NETWORK_INHERIT) -> tuple[int, int]:
+        """
+        将历史查询结果编译为离线网段库
+        每条记录贡献其company.network、asn.route以及IP自身三个范围，嵌套范围以最小的范围为准，
+        相同范围以后出现的记录为准
+        :param records: 查询结果迭代器
+        :param output_path: 输出文件路径
+        :param inherit_fields: 写入网段库的字段
+        :return: (网段数, 去重后的记录数)
+        """
+        record_ids = {}
+        templates = []
+        networks = {}
+        for record in records:
+            ip = record.get('ip')
+            if not ip:
+                continue
+            template = {}
+            for key in inherit_fields:
+                value = record.get(key)
+                if isinstance(value, dict):
+                    value = {k: v for k, v in value.items() if not (key == 'location' and k in ('local_time', 'local_time_unix'))}
+                template[key] = value
+            blob = json.dumps(template, ensure_ascii=False, sort_keys=True)
+            record_no = record_ids.get(blob)
+            if record_no is None:
+                record_no = record_ids[blob] = len(templates)
+                templates.append(blob.encode('utf-8'))
+            
+            candidates = parse_network_range((record.get('company') or {}).get('network'))
+            candidates += parse_network_range((record.get('asn') or {}).get('route'))
+            try:
+                candidates.append(ipaddress.ip_network(ip))
+            except ValueError:
+                pass
+            for network in candidates:
+                if network.prefixlen >= NetworkCache.MIN_PREFIXLEN[network.version]:
+                    networks[network] = record_no
+        
+        tables = {4: [], 6: []}
+        for network, record_no in networks.items():
+            tables[network.version].append((int(network.network_address), int(network.broadcast_address), record_no))
+        flat = {version: _flatten_nested_ranges(ranges) for version, ranges in tables.items()}
+        
+        output_dir = os.path.dirname(output_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        temp_path = f"{output_path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, sys.byteorder.encode(), len(flat[4]), len(flat[6]), len(templates)))
+            f.write(array('I', (start for start, _, _ in flat[4])).tobytes())
+            f.write(array('I', (end for _, end, _ in flat[4])).tobytes())
+            f.write(array('I', (record_no for _, _, record_no in flat[4])).tobytes())
+            f.write(b''.join(start.to_bytes(16, 'big') for start, _, _ in flat[6]))
+            f.write(b''.join(end.to_bytes(16, 'big') for _, end, _ in flat[6]))
+            f.write(array('I', (record_no for _, _, record_no in flat[6])).tobytes())
+            f.write(b'\0' * (-f.tell() % 8))
+            offsets = array('Q', [0])
+            for blob in templates:
+                offsets.append(offsets[-1] + len(blob))
+            f.write(offsets.tobytes())
+            for blob in templates:
+                f.write(blob)
+        os.replace(temp_path, output_path)
+        return len(flat[4]) + len(flat[6]), len(templates)
+
+class _FixedWidthKeys:
+    """
+    将定长大端字节数组包装为可二分查找的序列
+    """
+
+    def __init__(self, view: memoryview, width: int):
+        self.view = view
+        self.width = width
+
+    def __len__(self) -> int:
+        return len(self.view) // self.width
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.view[i * self.width:(i + 1) * self.width].tobytes()
+
+def _flatten_nested_ranges(ranges: list) -> list:
+    """
+    将互相嵌套或不相交的范围（CIDR网段满足这一性质）展开为互不重叠的有序范围，
+    重叠部分以最内层（最小）的范围为准，相邻且记录相同的范围会被合并
+    :param ranges: (起始, 结束, 记录编号) 列表
+    :return: 互不重叠、按起始地址排序的 (起始, 结束, 记录编号) 列表
+    """
+    flat = []
+    
+    def emit(start, end, record_no):
+        if start > end:
+            return
+        if flat and flat[-1][2] == record_no and flat[-1][1] + 1 == start:
+            flat[-1] = (flat[-1][0], end, record_no)
+        else:
+            flat.append((start, end, record_no))
+    
+    stack = []
+    cursor = 0
+    for start, end, record_no in sorted(ranges, key=lambda r: (r[0], -r[1])):
+        while stack and stack[-1][0] < start:
+            parent_end, parent_record = stack.pop()
+            emit(cursor, parent_end, parent_record)
+            cursor = parent_end + 1
+        if stack:
+            emit(cursor, start - 1, stack[-1][1])
+        cursor = start
+        stack.append((end, record_no))
+    while stack:
+        parent_end, parent_record = stack.pop()
+        emit(cursor, parent_end, parent_record)
+        cursor = parent_end + 1
+    return flat
+
+class ProviderError(ValueError):
+    """
+    后端返回了错误信息（如API密钥无效、额度用尽或查询的IP无效）
+    """
+
+class ProviderHealth:
+    """
+    后端健康状态：记录最近请求的成败和延迟分布，
+    错误率突增时暂停使用该后端一段时间，之后先试用，再次失败立即重新暂停
+    """
+
+    def __init__(self, window: int = 50, min_samples: int = 10, error_threshold: float = 0.5,
+                 cooldown: float = 30.0, latency_window: int = 200):
+        """
+        初始化健康状态
+        :param window: 计算错误率的最近请求数
+        :param min_samples: 判断错误率和计算p95所需的最少样本数
+        :param error_threshold: 触发切换的错误率
+        :param cooldown: 暂停使用的时间（秒）
+        :param latency_window: 计算p95延迟的最近成功请求数
+        """
+        self.min_samples = min_samples
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.outcomes = deque(maxlen=window)
+        self.latencies = deque(maxlen=latency_window)
+        self.down_until = 0.0
+        self.probation = False
+        self.stats = {'success': 0, 'failure': 0, 'trips': 0, 'hedged': 0, 'hedge_wins': 0}
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def count(self, name: str):
+        with self.lock:
+            self.stats[name] += 1
+
+    def error_rate(self) -> float:
+        with self.lock:
+            return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def record(self, success: bool, elapsed: Optional[float] = None) -> bool:
+        """
+        记录一次请求的结果
+        :param success: 是否成功
+        :param elapsed: 请求耗时（秒），批量请求不计入延迟分布时为None
+        :return: 本次失败是否导致后端被暂停
+        """
+        with self.lock:
+            self.outcomes.append(success)
+            if success:
+                self.stats['success'] += 1
+                self.probation = False
+                if elapsed is not None:
+                    self.latencies.append(elapsed)
+                return False
+            self.stats['failure'] += 1
+            if time.monotonic() < self.down_until:
+                # 暂停前已发出的请求陆续失败，不重复计算
+                return False
+            if not self.probation and (len(self.outcomes) < self.min_samples or
+                                       self.outcomes.count(False) < self.error_threshold * len(self.outcomes)):
+                return False
+            self.down_until = time.monotonic() + self.cooldown
+            self.probation = True
+            self.outcomes.clear()
+            self.stats['trips'] += 1
+            return True
+
+    def p95(self) -> Optional[float]:
+        """
+        最近成功请求的p95延迟（秒），样本不足时返回None
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+class IPAPIProvider:
+    """
+    ipapi.is 后端：构造单个和批量查询请求，并把返回结构整理为规范记录
+    """
+
+    remote = True
+
+    def __init__(self, base_url: str = "https://api.ipapi.is/", api_key: Optional[str] = None,
+                 health: Optional[ProviderHealth] = None):
+        """
+        初始化ipapi.is后端
+        :param base_url: API地址，可指向本地测试服务或自建镜像
+        :param api_key: API密钥
+        :param health: 健康状态，默认使用默认阈值
+        """
+        self.base_url = base_url
+        self.api_key = api_key or "11111111111111111111111111111111"
+        self.name = f"ipapi:{base_url}"
+        self.health = health or ProviderHealth()
+
+    def single_request(self, ip: str) -> tuple:
+        """
+        :return: 单个查询的 (方法, 地址, 请求参数)
+        """
+        return 'get', self.base_url, {'params': {'q': ip, 'key': self.api_key}}
+
+    def batch_request(self, ips: List[str]) -> tuple:
+        """
+        :return: 批量查询的 (方法, 地址, 请求参数)
+        """
+        return 'post', self.base_url, {'json': {'ips': ips, 'key': self.api_key}}
+
+    def parse(self, data: Dict, ip: str) -> Dict:
+        """
+        解析单个查询的返回
+        :param data: API返回的JSON数据
+        :param ip: 查询的IP地址
+        :return: 规范记录，API返回错误时抛出ProviderError
+        """
+        if data.get('error'):
+            raise ProviderError(data.get('error', 'Unknown error'))
+        return self.build_record(data, ip)
+
+    def parse_batch(self, data, ips: List[str]) -> Dict[str, Optional[Dict]]:
+        """
+        解析批量查询的返回
+        :param data: API返回的JSON数据
+        :param ips: 本批查询的IP列表
+        :return: IP到规范记录的映射，缺失或出错的IP对应None；整批无效时抛出ProviderError
+        """
+        if not isinstance(data, dict) or (data.get('error') and not any(ip in data for ip in ips)):
+            raise ProviderError(data.get('error', 'Unknown error') if isinstance(data, dict) else '返回格式无效')
+        results = {}
+        for ip in ips:
+            ip_data = data.get(ip)
+            if isinstance(ip_data, dict) and not ip_data.get('error'):
+                results[ip] = self.build_record(ip_data, ip)
+            else:
+                results[ip] = None
+        return results
+
+    def build_record(self, data: Dict, ip: str) -> Dict:
+        """
+        将API返回的单个IP数据整理为统一的规范结构（英文字段名、原始值），
+        中文翻译只在输出时进行
+        :param data: API返回的原始数据
+        :param ip: 查询的IP地址
+        :return: 查询结果字典
+        """
+        # 直接使用官方API的原始结构，不翻译值
+        record = {
+            'ip': data.get('ip', ip),
+            'rir': data.get('rir'),
+            'is_bogon': data.get('is_bogon'),
+            'is_mobile': data.get('is_mobile'),
+            'is_satellite': data.get('is_satellite'),
+            'is_crawler': data.get('is_crawler'),
+            'is_datacenter': data.get('is_datacenter'),
+            'is_tor': data.get('is_tor'),
+            'is_proxy': data.get('is_proxy'),
+            'is_vpn': data.get('is_vpn'),
+            'is_abuser': data.get('is_abuser'),
+            'elapsed_ms': data.get('elapsed_ms'),
+
+            # company信息（嵌套结构）
+            'company': {
+                'name': data.get('company', {}).get('name'),
+                'abuser_score': data.get('company', {}).get('abuser_score'),
+                'domain': data.get('company', {}).get('domain'),
+                'type': data.get('company', {}).get('type'),
+                'network': data.get('company', {}).get('network'),
+                'whois': data.get('company', {}).get('whois')
+            },
+
+            # abuse信息（嵌套结构）
+            'abuse': {
+                'name': data.get('abuse', {}).get('name'),
+                'address': data.get('abuse', {}).get('address'),
+                'email': data.get('abuse', {}).get('email'),
+                'phone': data.get('abuse', {}).get('phone')
+            },
+
+            # asn信息（嵌套结构）
+            'asn': {
+                'asn': data.get('asn', {}).get('asn'),
+                'abuser_score': data.get('asn', {}).get('abuser_score'),
+                'route': data.get('asn', {}).get('route'),
+                'descr': data.get('asn', {}).get('descr'),
+                'country': data.get('asn', {}).get('country'),
+                'active': data.get('asn', {}).get('active'),
+                'org': data.get('asn', {}).get('org'),
+                'domain': data.get('asn', {}).get('domain'),
+                'abuse': data.get('asn', {}).get('abuse'),
+                'type': data.get('asn', {}).get('type'),
+                'updated': data.get('asn', {}).get('updated'),
+                'rir': data.get('asn', {}).get('rir'),
+                'whois': data.get('asn', {}).get('whois')
+            },
+
+            # location信息（嵌套结构）
+            'location': {
+                'is_eu_member': data.get('location', {}).get('is_eu_member'),
+                'calling_code': data.get('location', {}).get('calling_code'),
+                'currency_code': data.get('location', {}).get('currency_code'),
+                'continent': data.get('location', {}).get('continent'),
+                'country': data.get('location', {}).get('country'),
+                'country_code': data.get('location', {}).get('country_code'),
+                'state': data.get('location', {}).get('state'),
+                'city': data.get('location', {}).get('city'),
+                'latitude': data.get('location', {}).get('latitude'),
+                'longitude': data.get('location', {}).get('longitude'),
+                'zip': data.get('location', {}).get('zip'),
+                'timezone': data.get('location', {}).get('timezone'),
+                'local_time': data.get('location', {}).get('local_time'),
+                'local_time_unix': data.get('location', {}).get('local_time_unix'),
+                'is_dst': data.get('location', {}).get('is_dst')
+            }
+        }
+        
+        return record
+
+class OfflineProvider:
+    """
+    离线后端：从离线网段库（compile-db命令生成）本地应答，不发送网络请求，
+    放在后端列表末尾时可在所有在线后端故障期间继续给出网段级的结果
+    """
+
+    remote = False
+
+    def __init__(self, db: OfflineRangeDB, name: Optional[str] = None, health: Optional[ProviderHealth] = None):
+        self.db = db
+        self.name = name or 'offline'
+        self.health = health or ProviderHealth()
+
+    def lookup(self, ip: str) -> Optional[Dict]:
+        """
+        :return: 网段库中的结果，未命中返回None
+        """
+        return self.db.lookup(ip)
+
+def parse_provider_spec(spec: str, api_url: str = "https://api.ipapi.is/", api_key: Optional[str] = None,
+                        health_options: Optional[Dict] = None):
+    """
+    解析后端描述：ipapi（使用--api-url）、ipapi:<地址> 或 offline:<离线网段库文件>
+    :param spec: 后端描述
+    :param api_url: 默认的ipapi.is地址
+    :param api_key: API密钥
+    :param health_options: 传给ProviderHealth的参数
+    :return: 后端实例
+    """
+    kind, _, value = spec.partition(':')
+    health = ProviderHealth(**(health_options or {}))
+    if kind == 'ipapi':
+        return IPAPIProvider(value or api_url, api_key, health)
+    if kind == 'offline':
+        if not value:
+            raise ValueError("离线后端需要指定网段库文件，如 offline:iptest_ranges.db")
+        # 离线后端用于兜底，总是在本地应答，缺少的字段标记为未知
+        return OfflineProvider(OfflineRangeDB(value, policy='unknown'), f"offline:{value}", health)
+    raise ValueError(f"未知的后端: {spec}（可选: ipapi、ipapi:<地址>、offline:<文件>）")
+
+class IPClassifier:
+    def __init__(self, api_key: Optional[str] = None, cache: Optional[LookupCache] = None,
+                 network_cache: Optional[NetworkCache] = None, api_base_url: str = "https://api.ipapi.is/",
+                 timeout: float = 10, rate_limiter: Optional[AdaptiveRateLimiter] = None,
+                 max_retries: int = 3, offline_db: Optional[OfflineRangeDB] = None,
+                 metrics: Optional[LookupMetrics] = None, providers: Optional[list] = None,
+                 hedge: bool = False, hedge_delay: float = 0.5,
+                 profiler: Optional[StageProfiler] = None):
+        """
+        初始化IP分类器
+        :param api_key: ipapi.is的API密钥
+        :param cache: 可选的查询结果缓存，命中时不再请求API
+        :param network_cache: 可选的网段缓存，已知网段内的IP按继承策略本地应答
+        :param api_base_url: API地址，可指向本地测试服务
+        :param timeout: 单次请求超时时间（秒）
+        :param rate_limiter: 可选的共享限速器
+        :param max_retries: 遇到限流、5xx或网络错误时的最大重试次数
+        :param offline_db: 可选的离线网段库，优先在本地应答，未命中时才请求API
+        :param metrics: 可选的查询指标收集器
+        :param providers: 按优先级排列的后端列表，默认只使用api_base_url对应的ipapi.is后端
+        :param hedge: 是否启用对冲请求：首选后端超过其p95延迟仍未应答时，向下一个后端再发一次，取先返回的结果
+        :param hedge_delay: 后端延迟样本不足时使用的对冲等待时间（秒）
+        :param profiler: 可选的剖析器，累计HTTP请求、记录构建和翻译等环节的耗时
+        """
+        self.api_base_url = api_base_url
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.offline_db = offline_db
+        self.api_key = api_key or "11111111111111111111111111111111"
+        self.cache = cache
+        self.network_cache = network_cache
+        self.providers = providers or [IPAPIProvider(api_base_url, self.api_key)]
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.hedge_executor = None
+        self.hedge_lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'User-Agent': 'IP-Classifier/1.0'
+        })
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.watch_session(self.session)
+        self.profiler = profiler
+        
+    def close(self):
+        """
+        释放分类器持有的对冲线程池和HTTP会话；查询缓存由调用方自行关闭
+        """
+        with self.hedge_lock:
+            executor, self.hedge_executor = self.hedge_executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+        
+    def get_ip_location(self, ip: str) -> Optional[Dict]:
+        """
+        获取IP的完整地理位置信息
+        :param ip: IP地址
+        :return: 包含完整地理位置信息的字典，如果失败返回None
+        """
+        local = self._lookup_local(ip)
+        if local is not None:
+            return local
+
+        start = time.perf_counter()
+        try:
+            candidates = self._candidates()
+            if self.hedge and len(candidates) > 1:
+                record, provider = self._query_hedged(ip, candidates)
+            else:
+                record, provider = self._query_in_order(ip, candidates)
+            if record is not None:
+                self._remember_result(ip, record, provider)
+            return record
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_lookup(time.perf_counter() - start)
+    
+    def get_ip_locations_batch(self, ip_list: List[str]) -> Dict[str, Optional[Dict]]:
+        """
+        使用批量接口一次查询多个IP，整批失败或缺失的IP回退为逐个查询
+        :param ip_list: IP地址列表（建议不超过100个）
+        :return: IP到查询结果的映射，查询失败的IP对应None
+        """
+        results = {}
+        pending = []
+        for ip in ip_list:
+            local = self._lookup_local(ip)
+            if local is not None:
+                results[ip] = local
+            else:
+                pending.append(ip)
+        
+        if not pending:
+            return results
+        
+        provider = self._batch_provider()
+        if provider is None:
+            for ip in pending:
+                results[ip] = self.get_ip_location(ip)
+            return results
+        
+        try:
+            method, url, kwargs = provider.batch_request(pending)
+            with self._section('http'):
+                data = self._fetch_json(method, url, timeout=self.timeout + len(pending) * 0.1, **kwargs)
+            with self._section('build_record'):
+                found = provider.parse_batch(data, pending)
+        except (requests.RequestException, ValueError) as e:
+            self._record_outcome(provider, False)
+            if self.metrics is not None and isinstance(e, ProviderError):
+                self.metrics.count_error('api_error')
+            print(f"批量查询失败（{len(pending)} 个IP），回退为逐个查询: {e}")
+            for ip in pending:
+                results[ip] = self.get_ip_location(ip)
+            return results
+        self._record_outcome(provider, True)
+        
+        for ip in pending:
+            record = found.get(ip)
+            if record is None:
+                # 批量结果中缺失或出错的IP单独重试
+                results[ip] = self.get_ip_location(ip)
+                continue
+            self._remember_result(ip, record, provider)
+            results[ip] = record
+        
+        return results
+    
+    def _section(self, name: str, cpu: bool = True):
+        """
+        未启用剖析时返回空的上下文管理器
+        """
+        return self.profiler.section(name, cpu) if self.profiler is not None else contextlib.nullcontext()
+    
+    def _candidates(self) -> list:
+        """
+        按优先级返回当前可用的后端；全部处于暂停状态时仍按原顺序全部尝试
+        """
+        available = [provider for provider in self.providers if provider.health.available()]
+        return available or list(self.providers)
+    
+    def _batch_provider(self):
+        """
+        批量查询使用的后端：第一个可用后端支持批量接口时返回它，否则返回None（改为逐个查询）
+        """
+        provider = self._candidates()[0]
+        return provider if getattr(provider, 'batch_request', None) is not None else None
+    
+    def _hedge_wait(self, provider) -> float:
+        """
+        对冲等待时间：后端最近成功请求的p95延迟，样本不足时使用hedge_delay
+        """
+        p95 = provider.health.p95()
+        return p95 if p95 is not None else self.hedge_delay
+    
+    def _record_outcome(self, provider, success: bool, elapsed: Optional[float] = None):
+        """
+        记录后端请求结果，错误率突增导致后端被暂停时输出提示
+        """
+        if provider.health.record(success, elapsed) and len(self.providers) > 1:
+            if self.metrics is not None:
+                self.metrics.count_error('failover')
+            print(f"后端 {provider.name} 错误率过高，暂停使用 {provider.health.cooldown:.0f} 秒，切换到下一个后端")
+    
+    def _report_failure(self, ip: str, provider, error: BaseException):
+        """
+        输出单个后端查询失败的原因
+        """
+        where = f"（后端 {provider.name}）" if len(self.providers) > 1 else ''
+        if isinstance(error, ProviderError):
+            if self.metrics is not None:
+                self.metrics.count_error('api_error')
+            print(f"API错误 for IP {ip}{where}: {error}")
+        elif isinstance(error, requests.RequestException) or (aiohttp is not None and isinstance(error, aiohttp.ClientError)):
+            print(f"网络请求错误 for IP {ip}{where}: {error}")
+        elif isinstance(error, asyncio.TimeoutError):
+            print(f"请求超时 for IP {ip}{where}")
+        elif isinstance(error, json.JSONDecodeError):
+            print(f"JSON解析错误 for IP {ip}{where}: {error}")
+        else:
+            print(f"未知错误 for IP {ip}{where}: {error}")
+    
+    def _call_provider(self, provider, ip: str) -> Optional[Dict]:
+        """
+        向单个后端查询一个IP，并记录该后端的延迟和成败
+        :return: 查询结果，离线后端未命中时返回None；请求失败时抛出异常
+        """
+        if not provider.remote:
+            record = provider.lookup(ip)
+            if record is not None:
+                provider.health.count('success')
+            return record
+        start = time.perf_counter()
+        try:
+            method, url, kwargs = provider.single_request(ip)
+            with self._section('http'):
+                data = self._fetch_json(method, url, timeout=self.timeout, **kwargs)
+            with self._section('build_record'):
+                record = provider.parse(data, ip)
+        except Exception:
+            self._record_outcome(provider, False)
+            raise
+        self._record_outcome(provider, True, time.perf_counter() - start)
+        return record
+    
+    def _query_in_order(self, ip: str, candidates: list) -> tuple:
+        """
+        按优先级依次查询，前一个后端失败或未命中时切换到下一个
+        :return: (查询结果, 应答的后端)，全部失败时为 (None, None)
+        """
+        for provider in candidates:
+            try:
+                record = self._call_provider(provider, ip)
+            except Exception as e:
+                self._report_failure(ip, provider, e)
+                continue
+            if record is not None:
+                return record, provider
+        return None, None
+    
+    def _query_hedged(self, ip: str, candidates: list) -> tuple:
+        """
+        对冲查询：先向首选后端发出请求，超过其p95延迟仍未应答（或已失败）时向下一个后端再发一次，
+        取第一个成功的结果；落后的请求在后台完成后被丢弃
+        :return: (查询结果, 应答的后端)，全部失败时为 (None, None)
+        """
+        with self.hedge_lock:
+            if self.hedge_executor is None:
+                self.hedge_executor = ThreadPoolExecutor(max_workers=64)
+            executor = self.hedge_executor
+        pending = {}
+        launched = 0
+        deadline = 0.0
+        
+        def launch():
+            nonlocal launched, deadline
+            provider = candidates[launched]
+            launched += 1
+            pending[executor.submit(self._call_provider, provider, ip)] = provider
+            deadline = time.monotonic() + self._hedge_wait(provider)
+        
+        launch()
+        while pending:
+            timeout = max(0.0, deadline - time.monotonic()) if launched < len(candidates) else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                candidates[launched - 1].health.count('hedged')
+                launch()
+                continue
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    self._report_failure(ip, provider, e)
+                    continue
+                if record is not None:
+                    if provider is not candidates[0] and launched > 1:
+                        provider.health.count('hedge_wins')
+                    return record, provider
+            if not pending and launched < len(candidates):
+                launch()
+        return None, None
+    
+    def _backoff_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        计算第attempt次重试前的等待时间：优先使用Retry-After，否则为指数退避，两者都先限制在MAX_RETRY_DELAY以内；
+        Retry-After再加上最多10%的随机抖动，避免同时被限流的请求在同一时刻重试
+        """
+        if retry_after is not None:
+            return min(MAX_RETRY_DELAY, retry_after) * random.uniform(1.0, 1.1)
+        return random.uniform(0, min(MAX_RETRY_DELAY, 0.5 * (2 ** attempt)))
+    
+    def _fetch_json(self, method: str, url: str, **kwargs):
+        """
+        发送请求并解析JSON，遇到限流、5xx或网络错误时按退避策略重试
+        :param method: 'get'或'post'
+        :param url: 请求地址
+        :return: 解析后的JSON数据
+        """
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                with self._section('rate_wait', cpu=False):
+                    self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if self.metrics is not None:
+                    self.metrics.observe_request(method, time.perf_counter() - start,
+                                                 error='timeout' if isinstance(e, requests.Timeout) else 'connection')
+                if attempt >= self.max_retries:
+                    raise
+                retry_after = None
+            else:
+                if self.metrics is not None:
+                    status = response.status_code
+                    self.metrics.observe_request(method, time.perf_counter() - start, status,
+                                                 f"http_{status}" if status >= 400 else None)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    response.raise_for_status()
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.on_success()
+                    try:
+                        return response.json()
+                    except ValueError:
+                        if self.metrics is not None:
+                            self.metrics.count_error('json_decode')
+                        raise
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if self.rate_limiter is not None and response.status_code in (429, 503):
+                    self.rate_limiter.on_throttle(retry_after)
+                if attempt >= self.max_retries:
+                    response.raise_for_status()
+            
+            if self.rate_limiter is not None:
+                self.rate_limiter.on_retry()
+            if self.metrics is not None:
+                self.metrics.count_retry()
+            with self._section('backoff', cpu=False):
+                time.sleep(self._backoff_delay(attempt, retry_after))
+            attempt += 1
+    
+    async def _fetch_json_async(self, http, method: str, url: str, **kwargs):
+        """
+        _fetch_json的异步版本
+        :param http: aiohttp会话
+        :param method: 'get'或'post'
+        :param url: 请求地址
+        :return: 解析后的JSON数据
+        """
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                with self._section('rate_wait', cpu=False):
+                    await self.rate_limiter.acquire_async()
+            start = time.perf_counter()
+            try:
+                async with http.request(method.upper(), url, **kwargs) as response:
+                    if self.metrics is not None:
+                        status = response.status
+                        self.metrics.observe_request(method, time.perf_counter() - start, status,
+                                                     f"http_{status}" if status >= 400 else None)
+                    if response.status not in RETRYABLE_STATUS_CODES:
+                        response.raise_for_status()
+                        try:
+                            data = await response.json(content_type=None)
+                        except ValueError:
+                            if self.metrics is not None:
+                                self.metrics.count_error('json_decode')
+                            raise
+                        if self.rate_limiter is not None:
+                            self.rate_limiter.on_success()
+                        return data
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    if self.rate_limiter is not None and response.status in (429, 503):
+                        self.rate_limiter.on_throttle(retry_after)
+                    if attempt >= self.max_retries:
+                        response.raise_for_status()
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                if self.metrics is not None:
+                    self.metrics.observe_request(method, time.perf_counter() - start,
+                                                 error='timeout' if isinstance(e, asyncio.TimeoutError) else 'connection')
+                if attempt >= self.max_retries:
+                    raise
+                retry_after = None
+            
+            if self.rate_limiter is not None:
+                self.rate_limiter.on_retry()
+            if self.metrics is not None:
+                self.metrics.count_retry()
+            with self._section('backoff', cpu=False):
+                await asyncio.sleep(self._backoff_delay(attempt, retry_after))
+            attempt += 1
+    
+    def _lookup_local(self, ip: str) -> Optional[Dict]:
+        """
+        依次查询结果缓存、离线网段库和网段缓存
+        :param ip: IP地址
+        :return: 本地可应答的查询结果，否则返回None
+        """
+        if self.cache is not None:
+            cached = self.cache.get(ip)
+            if cached is not None:
+                if self.metrics is not None:
+                    self.metrics.count_lookup('cache')
+                return cached
+
+        if self.offline_db is not None:
+            offline = self.offline_db.lookup(ip)
+            if offline is not None:
+                if self.metrics is not None:
+                    self.metrics.count_lookup('offline')
+                return offline
+
+        if self.network_cache is not None:
+            inherited = self.network_cache.lookup(ip)
+            if inherited is not None:
+                if self.metrics is not None:
+                    self.metrics.count_lookup('network')
+                return inherited
+        
+        return None
+    
+    def _remember_result(self, ip: str, record: Dict, provider=None):
+        """
+        将API查询结果写入结果缓存并学习网段；离线后端的结果只计数
+        """
+        if provider is not None and not provider.remote:
+            if self.metrics is not None:
+                self.metrics.count_lookup('offline')
+            return
+        if self.metrics is not None:
+            self.metrics.count_lookup('api')
+            self.metrics.observe_provider(record.get('elapsed_ms'))
+        if self.cache is not None:
+            self.cache.put(ip, record)
+        if self.network_cache is not None:
+            self.network_cache.learn(record)
+    
+    def classify_ips_by_country(self, ip_list: list[str], max_workers: int = 5,
+                                batch_size: int = 1, sinks: Optional[list] = None,
+                                progress_interval: float = 0.5) -> tuple[dict[str, list[dict]], list[str]]:
+        """
+        按国家对IP列表进行分类（多线程并发版本）
+        :param ip_list: IP地址列表
+        :param max_workers: 最大线程数，默认为5
+        :param batch_size: 每次请求查询的IP数，大于1时使用批量接口
+        :param sinks: 可选的附加输出（如检查点日志），每个IP完成后立即调用其add/fail，不会被关闭
+        :param progress_interval: 进度输出的最小间隔（秒），0表示每个IP输出一行
+        :return: (按国家分类的IP信息字典, 失败的IP列表)
+        """
+        classified_ips = defaultdict(list)
+        failed_ips = []
+        total_ips = len(ip_list)
+        
+        print(f"开始处理 {total_ips} 个IP地址...")
+        print(f"使用 {max_workers} 个线程并发查询...")
+        if batch_size > 1:
+            print(f"使用批量接口，每批 {batch_size} 个IP...")
+        
+        progress = ProgressReporter(total_ips, progress_interval)
+        for ip, location_data, error in self.iter_classify(ip_list, max_workers, batch_size):
+            progress.update(ip, bool(location_data))
+            if location_data:
+                # 汇总时保存为紧凑记录，按原始国家名分组，结束时再统一翻译组名
+                classified_ips[record_country(location_data)].append(CompactRecord.from_dict(location_data))
+            else:
+                failed_ips.append(ip)
+            notify_sinks(sinks, ip, location_data, error)
+        progress.finish()
+        
+        return self._translate_groups(classified_ips), failed_ips
+    
+    def classify_ips_sampled(self, ip_list: list[str], per_stratum: int, max_workers: int = 5,
+                             batch_size: int = 1, sinks: Optional[list] = None,
+                             progress_interval: float = 0.5, engine: str = 'thread',
+                             concurrency: int = 200, seed: int = 0,
+                             confidence: float = 0.95, min_agree: int = 2) -> tuple:
+        """
+        按国家对IP列表进行抽样分类：按网段（IPv4 /16、IPv6 /48）分层，每层只查询抽取的样本，
+        再由样本估计整个输入的国家和ASN分布
+        :param ip_list: IP地址列表
+        :param per_stratum: 每层最多抽取的IP数
+        :param max_workers: 最大线程数（线程引擎）
+        :param batch_size: 每次请求查询的IP数，大于1时使用批量接口
+        :param sinks: 可选的附加输出，只接收样本IP的查询结果
+        :param progress_interval: 进度输出的最小间隔（秒）
+        :param engine: 查询引擎：'thread'或'async'
+        :param concurrency: 异步引擎最大并发请求数
+        :param seed: 抽样随机种子，相同输入和种子抽取的样本相同
+        :param confidence: 置信区间的置信水平
+        :param min_agree: 层内IP继承国家所需的最少一致样本数
+        :return: (样本按国家分类的IP信息字典, 失败的样本IP列表, 保存分层估计的StratifiedSampler)
+        """
+        sampler = StratifiedSampler(per_stratum, seed, confidence, min_agree)
+        for ip in ip_list:
+            sampler.add(ip)
+        sample_ips = sampler.sample_ips()
+        print(f"分层抽样: {sampler.total} 个IP按网段分为 {len(sampler.strata)} 层，"
+              f"每层最多抽取 {per_stratum} 个，共抽取 {len(sample_ips)} 个IP")
+        
+        if engine == 'async':
+            classified_ips, failed_ips = self.classify_ips_by_country_async(
+                sample_ips, concurrency, batch_size=batch_size, sinks=sinks,
+                progress_interval=progress_interval)
+        else:
+            classified_ips, failed_ips = self.classify_ips_by_country(
+                sample_ips, max_workers, batch_size=batch_size, sinks=sinks,
+                progress_interval=progress_interval)
+        sampler.set_results(record for records in classified_ips.values() for record in records)
+        return classified_ips, failed_ips, sampler
+    
+    def iter_classify(self, ip_iter: Iterable[str], max_workers: int = 5, batch_size: int = 1,
+                      window: Optional[int] = None) -> Iterator[tuple]:
+        """
+        流式查询：按需从ip_iter读取IP，同一时间最多只有window个任务在进行中，
+        结果按完成顺序逐个产出
+        :param ip_iter: IP地址可迭代对象（可以是惰性生成器）
+        :param max_workers: 最大线程数
+        :param batch_size: 每次请求查询的IP数，大于1时使用批量接口
+        :param window: 同时进行中的最大任务数，默认为线程数的4倍
+        :return: (IP, 查询结果或None, 错误信息或None) 的迭代器
+        """
+        window = window or max_workers * 4
+        
+        def process_chunk(chunk):
+            """
+            处理一组IP的函数，供线程池使用
+            """
+            try:
+                if batch_size > 1:
+                    chunk_results = self.get_ip_locations_batch(chunk)
+                else:
+                    chunk_results = {ip: self.get_ip_location(ip) for ip in chunk}
+            except Exception as e:
+                chunk_results, error = {}, str(e)
+            else:
+                error = None
+            results = [(ip, chunk_results.get(ip), None if chunk_results.get(ip) else (error or "查询失败"))
+                       for ip in chunk]
+            if self.metrics is not None:
+                for _, location_data, _ in results:
+                    if not location_data:
+                        self.metrics.count_lookup('failed')
+            return results
+        
+        # 使用线程池并发处理，只保留有限数量的进行中任务
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = set()
+            for chunk in iter_chunks(ip_iter, batch_size):
+                pending.add(executor.submit(process_chunk, chunk))
+                if len(pending) >= window:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+            
+            # 处理剩余的任务
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+    
+    def classify_stream(self, ip_iter: Iterable[str], sinks: list, max_workers: int = 5, batch_size: int = 1,
+                        engine: str = 'thread', concurrency: int = 200,
+                        window: Optional[int] = None, progress_interval: float = 0.5) -> tuple[int, int]:
+        """
+        流式分类：结果完成后立即交给下游输出，不在内存中汇总，内存占用与输入规模无关
+        :param ip_iter: IP地址可迭代对象（可以是惰性生成器）
+        :param sinks: 下游输出列表，每个输出需实现add(ip, record)、fail(ip, error)和close()
+        :param max_workers: 线程池引擎的最大线程数
+        :param batch_size: 每次请求查询的IP数，大于1时使用批量接口
+        :param engine: 'thread'或'async'
+        :param concurrency: 异步引擎最大并发请求数
+        :param window: 线程池引擎同时进行中的最大任务数
+        :param progress_interval: 进度输出的最小间隔（秒），0表示每个IP输出一行
+        :return: (成功数量, 失败数量)
+        """
+        counts = {'success': 0, 'failed': 0}
+        progress = ProgressReporter(interval=progress_interval)
+        
+        print("开始流式处理IP地址...")
+        
+        def on_result(ip, location_data, error):
+            progress.update(ip, bool(location_data))
+            if location_data:
+                counts['success'] += 1
+            else:
+                counts['failed'] += 1
+            notify_sinks(sinks, ip, location_data, error)
+        
+        try:
+            if engine == 'async':
+                if aiohttp is None:
+                    raise RuntimeError("异步引擎需要安装aiohttp: pip install aiohttp")
+                print(f"使用异步引擎，最多 {concurrency} 个请求并发...")
+                asyncio.run(self._classify_async(ip_iter, concurrency, batch_size, on_result))
+            else:
+                print(f"使用 {max_workers} 个线程并发查询...")
+                for ip, location_data, error in self.iter_classify(ip_iter, max_workers, batch_size, window):
+                    on_result(ip, location_data, error)
+            progress.finish()
+        finally:
+            for sink in sinks:
+                sink.close()
+        
+        return counts['success'], counts['failed']
+    
+    def _translate_groups(self, groups: Dict[str, List]) -> Dict[str, List]:
+        """
+        将按原始国家名分组的结果转换为按中文国家名分组
+        :param groups: 原始国家名到记录列表的映射
+        :return: 中文国家名到记录列表的映射
+        """
+        classified_ips = {}
+        for country, records in groups.items():
+            name = translate_to_chinese(country)
+            if name in classified_ips:
+                classified_ips[name].extend(records)
+            else:
+                classified_ips[name] = records
+        return classified_ips
+    
+    def classify_ips_by_country_async(self, ip_list: list[str], concurrency: int = 200,
+                                      batch_size: int = 1, sinks: Optional[list] = None,
+                                      progress_interval: float = 0.5) -> tuple[dict[str, list[dict]], list[str]]:
+        """
+        按国家对IP列表进行分类（asyncio异步版本，需要安装aiohttp）
+        :param ip_list: IP地址列表
+        :param concurrency: 同时进行中的最大请求数
+        :param batch_size: 每次请求查询的IP数，大于1时使用批量接口
+        :param sinks: 可选的附加输出（如检查点日志），每个IP完成后立即调用其add/fail，不会被关闭
+        :param progress_interval: 进度输出的最小间隔（秒），0表示每个IP输出一行
+        :return: (按国家分类的IP信息字典, 失败的IP列表)，与classify_ips_by_country相同
+        """
+        if aiohttp is None:
+            raise RuntimeError("异步引擎需要安装aiohttp: pip install aiohttp")
+        
+        classified_ips = defaultdict(list)
+        failed_ips = []
+        total_ips = len(ip_list)
+        progress = ProgressReporter(total_ips, progress_interval)
+        
+        print(f"开始处理 {total_ips} 个IP地址...")
+        print(f"使用异步引擎，最多 {concurrency} 个请求并发...")
+        if batch_size > 1:
+            print(f"使用批量接口，每批 {batch_size} 个IP...")
+        
+        def on_result(ip, location_data, error):
+            progress.update(ip, bool(location_data))
+            if location_data:
+                # 汇总时保存为紧凑记录，按原始国家名分组，结束时再统一翻译组名
+                classified_ips[record_country(location_data)].append(CompactRecord.from_dict(location_data))
+            else:
+                failed_ips.append(ip)
+            notify_sinks(sinks, ip, location_data, error)
+        
+        asyncio.run(self._classify_async(ip_list, concurrency, batch_size, on_result))
+        progress.finish()
+        return self._translate_groups(classified_ips), failed_ips
+    
+    async def _classify_async(self, ip_iter: Iterable[str], concurrency: int, batch_size: int, on_result):
+        """
+        异步查询主循环：concurrency个工作协程从同一个迭代器中按需取IP，
+        进行中的请求数不超过concurrency，不会一次性为全部输入创建任务；
+        回调（写入记录库、检查点日志、SQLite等下游输出）在单独的写入线程中按完成顺序执行，不阻塞事件循环
+        :param ip_iter: IP地址可迭代对象
+        :param concurrency: 同时进行中的最大请求数
+        :param batch_size: 每次请求查询的IP数，大于1时使用批量接口
+        :param on_result: 每个IP完成后的回调 on_result(ip, 查询结果或None, 错误信息或None)
+        """
+        chunks = iter_chunks(ip_iter, batch_size)
+        connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=30, ttl_dns_cache=300)
+        headers = {'User-Agent': self.session.headers.get('User-Agent', 'IP-Classifier/1.0')}
+        
+        def deliver(chunk, chunk_results, error):
+            for ip in chunk:
+                location_data = chunk_results.get(ip)
+                if not location_data and self.metrics is not None:
+                    self.metrics.count_lookup('failed')
+                on_result(ip, location_data, None if location_data else (error or "查询失败"))
+        
+        loop = asyncio.get_running_loop()
+        writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='iptest-sink')
+        trace_configs = [self.metrics.trace_config()] if self.metrics is not None else None
+        async with aiohttp.ClientSession(connector=connector, headers=headers, trace_configs=trace_configs) as http:
+            async def worker():
+                for chunk in chunks:
+                    try:
+                        if batch_size > 1:
+                            chunk_results = await self._get_ip_locations_batch_async(http, chunk)
+                        else:
+                            chunk_results = {chunk[0]: await self._get_ip_location_async(http, chunk[0])}
+                        error = None
+                    except Exception as e:
+                        chunk_results = {}
+                        error = str(e)
+                    # 等待写入完成再取下一批，下游输出变慢时查询也随之放慢
+                    await loop.run_in_executor(writer, deliver, chunk, chunk_results, error)
+            
+            try:
+                await asyncio.gather(*(worker() for _ in range(concurrency)))
+            finally:
+                writer.shutdown(wait=True)
+    
+    async def _run_blocking(self, func, *args):
+        """
+        在事件循环中执行本地查询/写入：配置了结果缓存时其SQLite读写会阻塞，交给默认线程池执行；
+        未配置时离线网段库和网段缓存都是内存查询，直接调用
+        :param func: 要执行的函数
+        :return: 函数的返回值
+        """
+        if self.cache is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+    
+    def _remember_results(self, records: list, provider=None):
+        """
+        依次调用_remember_result，供异步引擎一次性写入一批查询结果
+        :param records: (IP, 查询结果) 列表
+        """
+        for ip, record in records:
+            self._remember_result(ip, record, provider)
+    
+    async def _get_ip_location_async(self, http, ip: str) -> Optional[Dict]:
+        """
+        get_ip_location的异步版本
+        :param http: aiohttp会话
+        :param ip: IP地址
+        :return: 包含完整地理位置信息的字典，如果失败返回None
+        """
+        local = await self._run_blocking(self._lookup_local, ip)
+        if local is not None:
+            return local
+        
+        start = time.perf_counter()
+        try:
+            candidates = self._candidates()
+            if self.hedge and len(candidates) > 1:
+                record, provider = await self._query_hedged_async(http, ip, candidates)
+            else:
+                record, provider = await self._query_in_order_async(http, ip, candidates)
+            if record is not None:
+                await self._run_blocking(self._remember_result, ip, record, provider)
+            return record
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_lookup(time.perf_counter() - start)
+    
+    async def _call_provider_async(self, http, provider, ip: str) -> Optional[Dict]:
+        """
+        _call_provider的异步版本
+        """
+        if not provider.remote:
+            record = provider.lookup(ip)
+            if record is not None:
+                provider.health.count('success')
+            return record
+        start = time.perf_counter()
+        try:
+            method, url, kwargs = provider.single_request(ip)
+            with self._section('http', cpu=False):
+                data = await self._fetch_json_async(http, method, url,
+                                                    timeout=aiohttp.ClientTimeout(total=self.timeout), **kwargs)
+            with self._section('build_record'):
+                record = provider.parse(data, ip)
+        except Exception:
+            self._record_outcome(provider, False)
+            raise
+        self._record_outcome(provider, True, time.perf_counter() - start)
+        return record
+    
+    async def _query_in_order_async(self, http, ip: str, candidates: list) -> tuple:
+        """
+        _query_in_order的异步版本
+        """
+        for provider in candidates:
+            try:
+                record = await self._call_provider_async(http, provider, ip)
+            except Exception as e:
+                self._report_failure(ip, provider, e)
+                continue
+            if record is not None:
+                return record, provider
+        return None, None
+    
+    async def _query_hedged_async(self, http, ip: str, candidates: list) -> tuple:
+        """
+        _query_hedged的异步版本，得到结果后取消落后的请求
+        """
+        pending = {}
+        launched = 0
+        deadline = 0.0
+        
+        def launch():
+            nonlocal launched, deadline
+            provider = candidates[launched]
+            launched += 1
+            pending[asyncio.ensure_future(self._call_provider_async(http, provider, ip))] = provider
+            deadline = time.monotonic() + self._hedge_wait(provider)
+        
+        launch()
+        try:
+            while pending:
+                timeout = max(0.0, deadline - time.monotonic()) if launched < len(candidates) else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    candidates[launched - 1].health.count('hedged')
+                    launch()
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    try:
+                        record = task.result()
+                    except Exception as e:
+                        self._report_failure(ip, provider, e)
+                        continue
+                    if record is not None:
+                        if provider is not candidates[0] and launched > 1:
+                            provider.health.count('hedge_wins')
+                        return record, provider
+                if not pending and launched < len(candidates):
+                    launch()
+            return None, None
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def _get_ip_locations_batch_async(self, http, ip_list: List[str]) -> Dict[str, Optional[Dict]]:
+        """
+        get_ip_locations_batch的异步版本
+        :param http: aiohttp会话
+        :param ip_list: IP地址列表
+        :return: IP到查询结果的映射，查询失败的IP对应None
+        """
+        results = {}
+        pending = []
+        local_records = await self._run_blocking(lambda: [self._lookup_local(ip) for ip in ip_list])
+        for ip, local in zip(ip_list, local_records):
+            if local is not None:
+                results[ip] = local
+            else:
+                pending.append(ip)
+        
+        if not pending:
+            return results
+        
+        provider = self._batch_provider()
+        if provider is None:
+            singles = await asyncio.gather(*(self._get_ip_location_async(http, ip) for ip in pending))
+            results.update(zip(pending, singles))
+            return results
+        
+        try:
+            method, url, kwargs = provider.batch_request(pending)
+            with self._section('http', cpu=False):
+                data = await self._fetch_json_async(
+                    http, method, url, timeout=aiohttp.ClientTimeout(total=self.timeout + len(pending) * 0.1), **kwargs)
+            with self._section('build_record'):
+                found = provider.parse_batch(data, pending)
+        except (asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+            self._record_outcome(provider, False)
+            if self.metrics is not None and isinstance(e, ProviderError):
+                self.metrics.count_error('api_error')
+            print(f"批量查询失败（{len(pending)} 个IP），回退为逐个查询: {e}")
+            singles = await asyncio.gather(*(self._get_ip_location_async(http, ip) for ip in pending))
+            results.update(zip(pending, singles))
+            return results
+        self._record_outcome(provider, True)
+        
+        fresh = [(ip, found[ip]) for ip in pending if found.get(ip) is not None]
+        await self._run_blocking(self._remember_results, fresh, provider)
+        results.update(fresh)
+        for ip in pending:
+            if ip not in results:
+                # 批量结果中缺失或出错的IP单独重试
+                results[ip] = await self._get_ip_location_async(http, ip)
+        
+        return results
+    
+    def create_country_files(self, classified_ips: Dict[str, List[Dict]], output_dir: str = 'country_files', merge_mode: bool = False,
+                             code_groups: Optional[Dict[str, List[str]]] = None):
+        """
+        为每个国家/地区创建单独的txt文件，保存到指定文件夹
+        :param classified_ips: 分类结果
+        :param output_dir: 输出目录名称
+        :param merge_mode: 是否为合并模式（True=合并现有文件，False=覆盖现有文件）
+        :param code_groups: 如果指定，直接使用国家代码到IP列表的映射（如抽样模式按层继承的结果），忽略classified_ips
+        """
+        print("\n=== 创建国家/地区IP文件 ===")
+        
+        # 确定实际输出目录
+        actual_output_dir = output_dir
+        if merge_mode:
+            # 合并模式下，在output_dir下创建merged子目录
+            actual_output_dir = os.path.join(output_dir, 'merged')
+        
+        # 创建输出目录
+        try:
+            os.makedirs(actual_output_dir, exist_ok=True)
+            print(f"创建输出目录: {actual_output_dir}")
+        except Exception as e:
+            print(f"创建目录 {actual_output_dir} 时出错: {e}")
+            return
+        
+        if code_groups is not None:
+            groups = code_groups.items()
+        else:
+            groups = ((self._country_code_of(ips), (ip_data['ip'] for ip_data in ips))
+                      for ips in classified_ips.values())
+        
+        for country_code, ips in groups:
+            filename = os.path.join(actual_output_dir, f"{country_code}.txt")
+            
+            try:
+                # 准备IP列表，按IP地址排序
+                new_ips = sorted(ips, key=ip_sort_key)
+                
+                if merge_mode and os.path.exists(filename):
+                    # 合并模式：与已排序的现有文件做流式归并，内存占用只与新IP数量相关
+                    try:
+                        total_count, existing_count = merge_sorted_ip_file(filename, new_ips)
+                        print(f"读取现有文件: {filename} (包含 {existing_count} 个IP)")
+                        print(f"合并后: {total_count} 个IP (新增 {len(new_ips)} 个，去重后净增 {total_count - existing_count} 个)")
+                    except Exception as e:
+                        print(f"合并现有文件失败，将创建新文件: {e}")
+                        total_count = write_ip_file(filename, dedupe_sorted_ips(new_ips))
+                else:
+                    # 覆盖模式或文件不存在：直接使用新IP
+                    total_count = write_ip_file(filename, dedupe_sorted_ips(new_ips))
+                
+                mode_desc = "合并模式" if merge_mode else "覆盖模式"
+                print(f"已创建文件: {filename} ({mode_desc}，包含 {total_count} 个IP，按IP排序)")
+            except Exception as e:
+                print(f"创建文件 {filename} 时出错: {e}")
+    
+    def _country_code_of(self, ips: List[Dict]) -> str:
+        """
+        获取一组记录的国家代码，用作国家分类文件名
+        :param ips: 同一国家的记录列表
+        :return: 国家代码，没有时返回'Unknown'
+        """
+        # 使用国家代码作为文件名，如果没有则使用国家名称的拼音或英文
+        if ips and 'location' in ips[0] and 'country_code' in ips[0]['location']:
+            return ips[0]['location']['country_code']
+        return 'Unknown'
+    
+    def ip_to_tuple(self, ip_str: str) -> tuple:
+        """
+        将IP地址转换为可排序的元组（保留用于兼容，排序请直接使用ip_sort_key）
+        :param ip_str: IP地址字符串
+        :return: 可排序的元组，同时支持IPv4和IPv6
+        """
+        return (ip_sort_key(ip_str),)
+    
+    def save_results(self, classified_ips: Dict[str, List[Dict]], output_file: str, lang: str = 'zh',
+                     export: bool = True, compact: bool = False):
+        """
+        保存分类结果，支持增量更新：结果合并到与输出文件同名的规范记录库（<输出文件名>.store，英文字段名、原始值），
+        只在需要时由记录库生成排序、翻译后的JSON文件（翻译一次流式完成，耗时与记录库总规模相关）
+        :param classified_ips: 分类结果
+        :param output_file: 输出文件路径
+        :param lang: 输出语言：'zh'中文，'en'原始英文
+        :param export: 是否生成JSON结果文件（默认生成），为False时只写入记录库，耗时只与本批数量相关
+        :param compact: 是否先压缩记录库再生成JSON结果文件
+        """
+        try:
+            store = open_result_store(output_file)
+            try:
+                # 合并数据：新IP添加，已有IP的覆盖旧数据
+                with self._section('store_merge'):
+                    self.save_results_to_store(classified_ips, store)
+                if compact:
+                    with self._section('export'):
+                        compact_store(self, store, output_file, lang)
+                elif export:
+                    with self._section('export'):
+                        export_results(store, output_file, lang, self.profiler)
+                    print(f"结果已保存到: {output_file} (增量更新，按IP排序，{OUTPUT_LANGUAGE_NOTES[lang]})")
+            finally:
+                store.close()
+        except Exception as e:
+            print(f"保存文件时出错: {e}")
+    
+    def save_results_to_store(self, classified_ips: Dict[str, List[Dict]], store: 'RecordStore'):
+        """
+        将分类结果增量写入记录库，只追加新增或发生变化的记录
+        :param classified_ips: 分类结果
+        :param store: 记录库
+        """
+        try:
+            counts = store.put_many(ip_data for ips in classified_ips.values() for ip_data in ips)
+            print(f"已写入记录库: {store.directory} (新增 {counts['added']}，更新 {counts['updated']}，"
+                  f"未变化 {counts['unchanged']}，共 {len(store)} 个IP)")
+        except Exception as e:
+            print(f"写入记录库时出错: {e}")
+    
+    def print_summary(self, classified_ips: Dict[str, List[Dict]], detail_file: Optional[str] = None,
+                      top: int = 10):
+        """
+        一次遍历统计并打印汇总摘要（国家、ASN、公司类型和各is_*标识），
+        逐IP的完整检测信息只在指定detail_file时写入文件
+        :param classified_ips: 分类结果
+        :param detail_file: 可选的详细报告文件路径
+        :param top: ASN等排行显示的条目数
+        """
+        summary = RecordSummary()
+        for ips in classified_ips.values():
+            for ip_data in ips:
+                summary.add(ip_data['ip'], ip_data)
+        summary.print_summary(top)
+        
+        if detail_file:
+            self.write_detail_report(classified_ips, detail_file)
+            print(f"\n逐IP详细报告已写入: {detail_file}")
+    
+    def write_detail_report(self, classified_ips: Dict[str, List[Dict]], detail_file: str):
+        """
+        将每个IP的完整检测信息写入文本文件
+        :param classified_ips: 分类结果
+        :param detail_file: 输出文件路径
+        """
+        with open(detail_file, 'w', encoding='utf-8') as f:
+            def out(*args):
+                print(*args, file=f)
+            
+            out("=== IP地区分类详细报告 ===")
+            total_ips = sum(len(ips) for ips in classified_ips.values())
+            out(f"总共处理了 {total_ips} 个IP地址")
+            out(f"涉及 {len(classified_ips)} 个国家/地区\n")
+            
+            for country, ips in sorted(classified_ips.items(), key=lambda x: len(x[1]), reverse=True):
+                out(f"【{country}】 - 共 {len(ips)} 个IP")
+                out("=" * 50)
+            
+                # 显示每个IP的完整信息
+                for i, ip_data in enumerate(ips, 1):
+                    out(f"\nIP #{i}: {ip_data['ip']}")
+                    out("-" * 30)
+                
+                    # 基本信息
+                    out(f"区域互联网注册机构: {ip_data.get('rir', 'Unknown')}")
+                    out(f"查询耗时: {ip_data.get('elapsed_ms', 'Unknown')}毫秒")
+                
+                    # 位置信息
+                    if 'location' in ip_data:
+                        location = ip_data['location']
+                        out(f"\n【位置信息】")
+                        out(f"国家: {translate_to_chinese(location.get('country', 'Unknown'))}")
+                        out(f"国家代码: {location.get('country_code', 'Unknown')}")
+                        out(f"地区/州: {translate_to_chinese(location.get('state', 'Unknown'))}")
+                        out(f"城市: {translate_to_chinese(location.get('city', 'Unknown'))}")
+                        out(f"大洲: {translate_to_chinese(location.get('continent', 'Unknown'))}")
+                        out(f"邮政编码: {location.get('zip', 'Unknown')}")
+                        out(f"时区: {location.get('timezone', 'Unknown')}")
+                        out(f"本地时间: {location.get('local_time', 'Unknown')}")
+                        out(f"电话代码: {location.get('calling_code', 'Unknown')}")
+                        out(f"货币代码: {location.get('currency_code', 'Unknown')}")
+                    
+                        if location.get('latitude') and location.get('longitude'):
+                            out(f"坐标: {location['latitude']}, {location['longitude']}")
+                    
+                        # 标识字段
+                        out("\n【网络特征】")
+                        for field, chinese_name in FLAG_FIELDS.items():
+                            value = ip_data.get(field)
+                            if value is not None:
+                                out(f"{chinese_name}: {'是' if value else '否'}")
+                    
+                        # ASN信息
+                        if 'asn' in ip_data:
+                            asn = ip_data['asn']
+                            out("\n【自治系统信息】")
+                            out(f"自治系统号: {asn.get('asn', 'Unknown')}")
+                            out(f"组织: {translate_to_chinese(asn.get('org', 'Unknown'))}")
+                            out(f"路由: {asn.get('route', 'Unknown')}")
+                            out(f"描述: {translate_to_chinese(asn.get('descr', 'Unknown'))}")
+                            out(f"国家: {asn.get('country', 'Unknown')}")
+                            out(f"类型: {translate_to_chinese(asn.get('type', 'Unknown'))}")
+                            out(f"滥用评分: {asn.get('abuser_score', 'Unknown')}")
+                            out(f"域名: {asn.get('domain', 'Unknown')}")
+                            out(f"滥用联系人: {asn.get('abuse', 'Unknown')}")
+                            out(f"更新时间: {asn.get('updated', 'Unknown')}")
+                            out(f"区域注册机构: {asn.get('rir', 'Unknown')}")
+                            out(f"是否活跃: {'是' if asn.get('active') else '否'}")
+                    
+                        # 公司信息
+                        if 'company' in ip_data:
+                            company = ip_data['company']
+                            out("\n【公司信息】")
+                            out(f"公司名称: {translate_to_chinese(company.get('name', 'Unknown'))}")
+                            out(f"域名: {company.get('domain', 'Unknown')}")
+                            out(f"类型: {translate_to_chinese(company.get('type', 'Unknown'))}")
+                            out(f"滥用评分: {company.get('abuser_score', 'Unknown')}")
+                            out(f"网络范围: {company.get('network', 'Unknown')}")
+                            out(f"WHOIS信息: {company.get('whois', 'Unknown')}")
+                    
+                        # 滥用联系人信息
+                        if 'abuse' in ip_data:
+                            abuse = ip_data['abuse']
+                            out("\n【滥用联系人】")
+                            out(f"联系人: {translate_to_chinese(abuse.get('name', 'Unknown'))}")
+                            out(f"地址: {translate_to_chinese(abuse.get('address', 'Unknown'))}")
+                            out(f"邮箱: {abuse.get('email', 'Unknown')}")
+                            out(f"电话: {abuse.get('phone', 'Unknown')}")
+                
+                    # 如果不是最后一个IP，添加分隔线
+                    if i < len(ips):
+                        out("\n" + "·" * 40)
+            
+                out("\n" + "=" * 50 + "\n")
+
+# 查询结果中的is_*标识及其中文名称
+FLAG_FIELDS = {
+    'is_bogon': '是否为保留IP',
+    'is_mobile': '是否为移动网络',
+    'is_satellite': '是否为卫星网络',
+    'is_crawler': '是否为爬虫',
+    'is_datacenter': '是否为数据中心',
+    'is_tor': '是否为Tor网络',
+    'is_proxy': '是否为代理',
+    'is_vpn': '是否为VPN',
+    'is_abuser': '是否为滥用者'
+}
+
+# 记录库计算内容校验值时忽略的字段（每次查询都会变化，不代表记录内容变化）
+STORE_VOLATILE_FIELDS = {
+    None: ('elapsed_ms',),
+    'location': ('local_time', 'local_time_unix'),
+}
+
+def record_country(record: Dict) -> str:
+    """
+    获取查询结果的分类国家
+    :param record: 查询结果
+    :return: 国家名称，没有位置信息时返回'Unknown'
+    """
+    location = record.get('location')
+    if isinstance(location, Mapping) and location.get('country'):
+        return location['country']
+    return 'Unknown'
+
+def record_country_code(record: Dict) -> str:
+    """
+    获取查询结果的国家代码
+    :param record: 查询结果
+    :return: 国家代码，没有时返回'Unknown'
+    """
+    location = record.get('location')
+    if isinstance(location, Mapping) and location.get('country_code'):
+        return location['country_code']
+    return 'Unknown'
+
+def record_country_name(record: Dict) -> str:
+    """
+    获取查询结果的中文分类国家名，与分类结果的分组键一致
+    :param record: 查询结果
+    :return: 中文国家名称
+    """
+    return translate_to_chinese(record_country(record))
+
+def record_checksum(record: Dict) -> int:
+    """
+    计算记录内容的校验值，用于判断记录是否发生变化
+    :param record: 查询结果
+    :return: CRC32校验值
+    """
+    stable = dict(record)
+    for field in STORE_VOLATILE_FIELDS[None]:
+        stable.pop(field, None)
+    for section, fields in STORE_VOLATILE_FIELDS.items():
+        if section is not None and isinstance(stable.get(section), dict):
+            stable[section] = {k: v for k, v in stable[section].items() if k not in fields}
+    return zlib.crc32(json.dumps(stable, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+
+def diff_records(old: Dict, new: Dict) -> List[tuple]:
+    """
+    比较同一IP的两条记录，忽略每次查询都会变化的字段
+    :param old: 原记录
+    :param new: 新记录
+    :return: (字段路径, 原值, 新值) 列表，嵌套字段路径形如 location.city
+    """
+    changes = []
+    for key in dict.fromkeys([*old, *new]):
+        if key in STORE_VOLATILE_FIELDS[None]:
+            continue
+        before, after = old.get(key), new.get(key)
+        if isinstance(before, dict) or isinstance(after, dict):
+            before = before if isinstance(before, dict) else {}
+            after = after if isinstance(after, dict) else {}
+            ignored = STORE_VOLATILE_FIELDS.get(key, ())
+            for field in dict.fromkeys([*before, *after]):
+                if field not in ignored and before.get(field) != after.get(field):
+                    changes.append((f"{key}.{field}", before.get(field), after.get(field)))
+        elif before != after:
+            changes.append((key, before, after))
+    return changes
+
+def write_grouped_json(output_file: str, groups: Iterable[tuple], transform=None):
+    """
+    以流式方式写出 {国家: [记录, ...]} 结构的JSON文件，格式与json.dump(indent=2)一致，
+    不需要在内存中构造完整的结果字典
+    :param output_file: 输出文件路径
+    :param groups: (国家, 记录迭代器) 的迭代器，按输出顺序排列
+    :param transform: 可选的记录转换函数（例如字段名翻译）
+    """
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    
+    temp_file = f"{output_file}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        f.write('{')
+        first_group = True
+        for country, records in groups:
+            f.write('\n' if first_group else ',\n')
+            first_group = False
+            f.write(f"  {json.dumps(country, ensure_ascii=False)}: [")
+            first_record = True
+            for record in records:
+                if transform is not None:
+                    record = transform(record)
+                f.write('\n' if first_record else ',\n')
+                first_record = False
+                body = json.dumps(record, ensure_ascii=False, indent=2)
+                f.write('    ' + body.replace('\n', '\n    '))
+            f.write(']' if first_record else '\n  ]')
+        f.write('}' if first_group else '\n}')
+    os.replace(temp_file, output_file)
+
+def default_store_dir(output_file: str) -> str:
+    """
+    获取与输出文件对应的默认记录库目录
+    :param output_file: JSON结果文件路径
+    :return: 记录库目录
+    """
+    return f"{os.path.splitext(output_file)[0]}.store"
+
+def import_legacy_results(input_file: str, store: 'RecordStore') -> int:
+    """
+    将旧版（字段名已翻译成中文）的JSON结果文件导入规范记录库
+    :param input_file: 旧版结果文件路径
+    :param store: 记录库
+    :return: 导入的IP数量
+    """
+    with open(input_file, 'r', encoding='utf-8') as f:
+        legacy = json.load(f)
+    checked_at = os.path.getmtime(input_file)
+    imported = 0
+    for records in legacy.values():
+        for record in records:
+            canonical = canonicalize_record(record)
+            if canonical.get('ip'):
+                store.put(canonical, checked_at)
+                imported += 1
+    store.flush()
+    return imported
+
+def export_results(store: 'RecordStore', output_file: str, lang: str = 'zh',
+                   profiler: Optional[StageProfiler] = None):
+    """
+    由记录库生成按国家分组、按IP排序的JSON结果文件
+    :param store: 记录库
+    :param output_file: 输出文件路径
+    :param lang: 输出语言：'zh'中文，'en'原始英文
+    :param profiler: 可选的剖析器，累计翻译环节的耗时
+    """
+    translator = get_translator(lang)
+    translate_record, translate_group = translator.record, translator.group
+    if profiler is not None:
+        translate_record = profiler.timed('translate', translate_record)
+        translate_group = profiler.timed('translate', translate_group)
+    store.export_json(output_file, translate_record, translate_group)
+
+def open_result_store(output_file: str) -> 'RecordStore':
+    """
+    打开与结果文件同名的规范记录库，首次使用时导入旧版已翻译的结果文件
+    :param output_file: 结果文件路径
+    :return: 记录库
+    """
+    store = RecordStore(default_store_dir(output_file))
+    if not len(store) and os.path.exists(output_file) and os.path.getsize(output_file):
+        try:
+            imported = import_legacy_results(output_file, store)
+            print(f"已导入现有数据: {output_file} ({imported} 个IP)")
+        except Exception as e:
+            print(f"读取现有文件失败，将创建新文件: {e}")
+    return store
+
+class RecordStore:
+    """
+    追加写入的记录库：记录以NDJSON格式追加到分段文件，另有一个追加写入的IP索引，
+    每次只写入新增或发生变化的记录；内容未变化的记录只在内存中更新查询时间，
+    在关闭、压缩或累计足够多次时整体重写索引（检查点），索引行数始终与IP数量相当；
+    compact()回收旧版本记录，export_json()按需生成排序后的结果文件
+    """
+
+    # 单个分段文件的大小上限
+    SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+    INDEX_FILE = 'index.tsv'
+    # 只在内存中更新的查询时间累计达到 max(该值, 索引IP数) 次时写一次索引检查点
+    CHECKPOINT_MIN_TOUCHES = 100000
+    # 累计多少行索引后刷新一次（先刷新分段文件，再写出索引行）
+    INDEX_FLUSH_LINES = 1000
+
+    def __init__(self, directory: str):
+        """
+        打开（或创建）记录库
+        :param directory: 记录库目录
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # ip -> [国家, 分段号, 偏移, 长度, 校验值, 更新时间]
+        self.index = {}
+        self.readers = {}
+        self.segment_no = 0
+        self.stats = {'added': 0, 'updated': 0, 'unchanged': 0}
+        # 尚未写入索引文件的查询时间更新次数
+        self.touched = 0
+        # 尚未写出的索引行：必须在对应记录写入分段文件之后才写出，中断后索引不会指向不存在的数据
+        self.index_pending = []
+        self._load_index()
+        self.segment_file = None
+        self.index_file = open(os.path.join(directory, self.INDEX_FILE), 'a', encoding='utf-8')
+
+    def _segment_path(self, segment_no: int) -> str:
+        return os.path.join(self.directory, f"seg-{segment_no:06d}.ndjson")
+
+    def _load_index(self):
+        """
+        读取索引文件，同一IP以最后一行为准；指向分段文件末尾之外的行（中断时数据未写完）被忽略，
+        该IP保留之前的版本
+        """
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        segment_sizes = {int(name[4:10]): os.path.getsize(os.path.join(self.directory, name))
+                         for name in os.listdir(self.directory) if name.startswith('seg-') and name.endswith('.ndjson')}
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) != 7:
+                        # 忽略中断写入留下的不完整行
+                        continue
+                    ip, country, segment_no, offset, length, checksum, updated_at = parts
+                    if int(offset) + int(length) > segment_sizes.get(int(segment_no), -1):
+                        continue
+                    self.index[ip] = [country, int(segment_no), int(offset), int(length),
+                                      int(checksum), float(updated_at)]
+        
+        self.segment_no = max(segment_sizes, default=0)
+
+    def _writer(self):
+        """
+        获取当前可写入的分段文件，超过大小上限时切换到新分段（调用方需持有锁）
+        """
+        if self.segment_file is not None and self.segment_file.tell() >= self.SEGMENT_MAX_BYTES:
+            # 旧分段的索引行先随分段一起写出
+            self._flush_locked()
+            self.segment_file.close()
+            self.segment_file = None
+            self.segment_no += 1
+        if self.segment_file is None:
+            if self.segment_no == 0:
+                self.segment_no = 1
+            self.segment_file = open(self._segment_path(self.segment_no), 'ab')
+            self.segment_file.seek(0, os.SEEK_END)
+        return self.segment_file
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, ip: str) -> bool:
+        return ip in self.index
+
+    def put(self, record: Dict, checked_at: Optional[float] = None) -> str:
+        """
+        写入一条记录，内容未变化时只更新索引中的时间；
+        继承自网段的部分结果（带inherited_from）不会替换已有的完整记录
+        :param record: 查询结果
+        :param checked_at: 查询时间戳，默认为当前时间
+        :return: 'added'、'updated'或'unchanged'
+        """
+        record = as_plain_record(record)
+        ip = record['ip']
+        checked_at = checked_at or time.time()
+        checksum = record_checksum(record)
+        country = record_country(record).replace('\t', ' ').replace('\n', ' ')
+        
+        with self.lock:
+            entry = self.index.get(ip)
+            if entry is not None and entry[4] == checksum:
+                # 内容未变化：只在内存中更新查询时间，由检查点统一写出，避免每次出现都追加一行索引
+                entry[5] = checked_at
+                self.touched += 1
+                if self.touched >= max(self.CHECKPOINT_MIN_TOUCHES, len(self.index)):
+                    self._checkpoint_locked()
+                self.stats['unchanged'] += 1
+                return 'unchanged'
+            if entry is not None and record.get('inherited_from') and \
+                    not self._read_locked(entry[1], entry[2], entry[3]).get('inherited_from'):
+                # 部分结果中的None表示未知，保留已有的完整记录（也不更新查询时间）
+                self.stats['unchanged'] += 1
+                return 'unchanged'
+            
+            data = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+            writer = self._writer()
+            offset = writer.tell()
+            writer.write(data)
+            self.index[ip] = [country, self.segment_no, offset, len(data), checksum, checked_at]
+            self.index_pending.append(f"{ip}\t{country}\t{self.segment_no}\t{offset}\t{len(data)}\t{checksum}\t{checked_at:.3f}\n")
+            if len(self.index_pending) >= self.INDEX_FLUSH_LINES:
+                self._flush_locked()
+            status = 'added' if entry is None else 'updated'
+            self.stats[status] += 1
+            return status
+
+    def put_many(self, records: Iterable[Dict]) -> Dict[str, int]:
+        """
+        批量写入记录
+        :param records: 查询结果迭代器
+        :return: 本次新增、更新、未变化的数量
+        """
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0}
+        for record in records:
+            counts[self.put(record)] += 1
+        self.flush()
+        return counts
+
+    def get(self, ip: str) -> Optional[Dict]:
+        """
+        读取某个IP的最新记录
+        :param ip: IP地址
+        :return: 查询结果，不存在时返回None
+        """
+        with self.lock:
+            entry = self.index.get(ip)
+            if entry is None:
+                return None
+            return self._read_locked(entry[1], entry[2], entry[3])
+
+    def _read_locked(self, segment_no: int, offset: int, length: int) -> Dict:
+        if self.segment_file is not None and segment_no == self.segment_no:
+            self.segment_file.flush()
+        reader = self.readers.get(segment_no)
+        if reader is None:
+            reader = self.readers[segment_no] = open(self._segment_path(segment_no), 'rb')
+        reader.seek(offset)
+        return json.loads(reader.read(length))
+
+    def iter_records(self, order: str = 'storage', ips: Optional[set] = None) -> Iterator[Dict]:
+        """
+        遍历每个IP的最新记录
+        :param order: 'storage'按存储位置顺序读取（最快），'country'按国家、IP排序
+        :param ips: 只读取这些IP的记录，默认读取全部
+        :return: 查询结果迭代器
+        """
+        with self.lock:
+            entries = [(ip, entry[0], entry[1], entry[2], entry[3]) for ip, entry in self.index.items()
+                       if ips is None or ip in ips]
+        if order == 'country':
+            entries.sort(key=lambda e: (e[1], ip_sort_key(e[0])))
+        else:
+            entries.sort(key=lambda e: (e[2], e[3]))
+        for ip, country, segment_no, offset, length in entries:
+            with self.lock:
+                yield self._read_locked(segment_no, offset, length)
+
+    def iter_grouped(self) -> Iterator[tuple]:
+        """
+        按国家分组、组内按IP排序遍历最新记录，国家按IP数量从多到少排列
+        :return: (国家, 记录迭代器) 的迭代器
+        """
+        with self.lock:
+            groups = defaultdict(list)
+            for ip, entry in self.index.items():
+                groups[entry[0]].append((ip_sort_key(ip), entry[1], entry[2], entry[3]))
+        
+        def read_group(entries):
+            entries.sort()
+            for _, segment_no, offset, length in entries:
+                with self.lock:
+                    yield self._read_locked(segment_no, offset, length)
+        
+        for country in sorted(groups, key=lambda c: len(groups[c]), reverse=True):
+            yield country, read_group(groups[country])
+
+    def export_json(self, output_file: str, transform=None, rename_group=None):
+        """
+        一次流式遍历生成按国家分组、按IP排序的JSON结果文件
+        :param output_file: 输出文件路径
+        :param transform: 可选的记录转换函数（例如中文翻译）
+        :param rename_group: 可选的国家名称转换函数
+        """
+        self.flush()
+        groups = self.iter_grouped()
+        if rename_group is not None:
+            groups = ((rename_group(country), records) for country, records in groups)
+        write_grouped_json(output_file, groups, transform)
+
+    def compact(self) -> int:
+        """
+        压缩记录库：按国家、IP顺序重写只包含最新记录的分段文件，并原子替换索引
+        :return: 回收的旧版本记录占用的字节数
+        """
+        self.flush()
+        with self.lock:
+            old_segments = sorted({entry[1] for entry in self.index.values()} |
+                                  {int(name[4:10]) for name in os.listdir(self.directory)
+                                   if name.startswith('seg-') and name.endswith('.ndjson')})
+            old_bytes = sum(os.path.getsize(self._segment_path(n)) for n in old_segments
+                            if os.path.exists(self._segment_path(n)))
+            entries = sorted(self.index.items(), key=lambda item: (item[1][0], ip_sort_key(item[0])))
+            
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
+            self.segment_no += 1
+            new_index = {}
+            writer = open(self._segment_path(self.segment_no), 'wb')
+            for ip, (country, segment_no, offset, length, checksum, updated_at) in entries:
+                data = self._read_locked(segment_no, offset, length)
+                line = (json.dumps(data, ensure_ascii=False) + '\n').encode('utf-8')
+                if writer.tell() >= self.SEGMENT_MAX_BYTES:
+                    writer.close()
+                    self.segment_no += 1
+                    writer = open(self._segment_path(self.segment_no), 'wb')
+                new_index[ip] = [country, self.segment_no, writer.tell(), len(line), checksum, updated_at]
+                writer.write(line)
+            writer.flush()
+            os.fsync(writer.fileno())
+            writer.close()
+            
+            self.index = new_index
+            self._write_index_locked()
+            
+            for reader in self.readers.values():
+                reader.close()
+            self.readers = {}
+            for segment_no in old_segments:
+                if os.path.exists(self._segment_path(segment_no)):
+                    os.remove(self._segment_path(segment_no))
+            
+            new_bytes = sum(os.path.getsize(self._segment_path(n)) for n in {e[1] for e in new_index.values()})
+            return max(0, old_bytes - new_bytes)
+
+    def _write_index_locked(self):
+        """
+        用内存中的索引原子替换索引文件，每个IP一行（调用方需持有锁）
+        """
+        if self.segment_file is not None:
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        self.index_file.close()
+        self.index_pending = []
+        with open(f"{index_path}.tmp", 'w', encoding='utf-8') as f:
+            for ip, (country, segment_no, offset, length, checksum, updated_at) in self.index.items():
+                f.write(f"{ip}\t{country}\t{segment_no}\t{offset}\t{length}\t{checksum}\t{updated_at:.3f}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{index_path}.tmp", index_path)
+        self.index_file = open(index_path, 'a', encoding='utf-8')
+        self.touched = 0
+
+    def _checkpoint_locked(self):
+        """
+        有只在内存中更新的查询时间时重写索引（调用方需持有锁）
+        """
+        if self.touched and not self.index_file.closed:
+            self._write_index_locked()
+
+    def checkpoint(self):
+        """
+        将只在内存中更新的查询时间写入索引文件
+        """
+        with self.lock:
+            self._checkpoint_locked()
+
+    def add(self, ip: str, record: Dict):
+        """
+        作为流式输出使用时写入一条记录
+        """
+        self.put(record)
+
+    def fail(self, ip: str, error: Optional[str]):
+        pass
+
+    def _flush_locked(self):
+        """
+        先刷新分段文件，再写出并刷新对应的索引行（调用方需持有锁）
+        """
+        if self.segment_file is not None:
+            self.segment_file.flush()
+        if not self.index_file.closed:
+            self.index_file.writelines(self.index_pending)
+            self.index_pending = []
+            self.index_file.flush()
+
+    def flush(self):
+        """
+        刷新分段文件和索引文件的写入缓冲
+        """
+        with self.lock:
+            self._flush_locked()
+
+    def close(self):
+        """
+        刷新并关闭记录库，写出尚未保存的查询时间
+        """
+        with self.lock:
+            self._flush_locked()
+            self._checkpoint_locked()
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
+            for reader in self.readers.values():
+                reader.close()
+            self.readers = {}
+            if not self.index_file.closed:
+                self.index_file.close()
+
+# refresh命令默认视为可变的标识：这些标识为真的记录（VPN、代理出口等）更容易随时间变化
+REFRESH_VOLATILE_FLAGS = ('is_vpn', 'is_proxy', 'is_tor', 'is_abuser')
+
+def select_refresh_candidates(store: RecordStore, budget: int, strategy: str = 'mixed', min_age: float = 86400,
+                              volatile_flags=REFRESH_VOLATILE_FLAGS, volatile_weight: float = 4.0) -> List[tuple]:
+    """
+    按记录库索引中的查询时间挑选需要重新查询的记录
+    :param store: 记录库
+    :param budget: 最多选择的IP数
+    :param strategy: 'oldest'最久未查询优先（只读索引）；'volatile'只选可变记录，最久未查询优先；
+                     'mixed'可变记录的已过时间乘以volatile_weight后与其他记录一起排序
+    :param min_age: 查询时间距今不足该秒数的记录不刷新
+    :param volatile_flags: 视为可变的标识字段
+    :param volatile_weight: mixed策略中可变记录的权重
+    :return: 按优先级排列的 (IP, 距上次查询的秒数, 是否可变记录) 列表，oldest策略中是否可变为None
+    """
+    now = time.time()
+    with store.lock:
+        ages = [(ip, now - entry[5]) for ip, entry in store.index.items() if now - entry[5] >= min_age]
+    if budget <= 0 or not ages:
+        return []
+    if strategy == 'oldest':
+        return [(ip, age, None) for ip, age in heapq.nlargest(budget, ages, key=lambda item: item[1])]
+    
+    # 需要读取记录判断标识；mixed策略中已过时间不足第budget名1/weight的记录不可能入选，不必读取
+    if strategy == 'mixed' and len(ages) > budget:
+        cutoff = heapq.nlargest(budget, (age for _, age in ages))[-1] / max(volatile_weight, 1.0)
+        ages = [(ip, age) for ip, age in ages if age >= cutoff]
+    age_of = dict(ages)
+    scored = []
+    for record in store.iter_records(ips=set(age_of)):
+        ip = record['ip']
+        volatile = any(record.get(flag) for flag in volatile_flags)
+        if strategy == 'volatile' and not volatile:
+            continue
+        weight = volatile_weight if strategy == 'mixed' and volatile else 1.0
+        scored.append((age_of[ip] * weight, ip, volatile))
+    return [(ip, age_of[ip], volatile) for _, ip, volatile in heapq.nlargest(budget, scored)]
+
+class UnsortedFileError(ValueError):
+    """
+    现有国家文件未按IP排序，无法进行流式归并
+    """
+
+def dedupe_sorted_ips(sorted_ips: Iterable[str]) -> Iterator[str]:
+    """
+    去除已排序IP序列中的相邻重复项
+    :param sorted_ips: 按ip_sort_key排序的IP序列
+    :return: 去重后的IP迭代器
+    """
+    last_key = None
+    for ip in sorted_ips:
+        key = ip_sort_key(ip)
+        if key != last_key:
+            last_key = key
+            yield ip
+
+def write_ip_file(filename: str, ips: Iterable[str]) -> int:
+    """
+    先写入同目录下的临时文件，再原子替换目标文件，避免中断时留下不完整的文件
+    :param filename: 目标文件路径
+    :param ips: 要写入的IP序列
+    :return: 写入的IP数量
+    """
+    temp_path = f"{filename}.tmp"
+    count = 0
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for ip in ips:
+                f.write(f"{ip}\n")
+                count += 1
+        os.replace(temp_path, filename)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return count
+
+# 现有国家文件未排序时，每次在内存中排序的最大行数
+MERGE_SORT_CHUNK_LINES = 1000000
+
+def _write_sorted_runs(filename: str, chunk_lines: int) -> List[str]:
+    """
+    分块读取未排序的文件，每块排序后写入一个临时文件（外部排序的第一步）
+    :param filename: 未排序的IP文件
+    :param chunk_lines: 每块的最大行数
+    :return: 已排序的临时文件路径列表
+    """
+    runs = []
+    
+    def write_run(chunk):
+        run_path = f"{filename}.run{len(runs)}.tmp"
+        runs.append(run_path)
+        with open(run_path, 'w', encoding='utf-8') as out:
+            out.writelines(f"{ip}\n" for ip in sorted(chunk, key=ip_sort_key))
+    
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            chunk = []
+            for line in f:
+                ip = line.strip()
+                if ip:
+                    chunk.append(ip)
+                    if len(chunk) >= chunk_lines:
+                        write_run(chunk)
+                        chunk = []
+            if chunk:
+                write_run(chunk)
+    except BaseException:
+        for run_path in runs:
+            if os.path.exists(run_path):
+                os.remove(run_path)
+        raise
+    return runs
+
+def _iter_run(run_path: str) -> Iterator[tuple]:
+    with open(run_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            ip = line.rstrip('\n')
+            yield ip_sort_key(ip), ip
+
+def merge_sorted_ip_file(filename: str, new_ips: List[str],
+                         chunk_lines: int = MERGE_SORT_CHUNK_LINES) -> tuple[int, int]:
+    """
+    将已排序的新IP与已排序的现有国家文件做堆归并，键相同的IP只保留一个，
+    结果写入临时文件后原子替换；现有文件未排序时（例如流式模式追加生成的文件）改为分块外部排序后再归并，
+    内存占用不超过chunk_lines行
+    :param filename: 现有国家文件路径
+    :param new_ips: 按ip_sort_key排序的新IP列表
+    :param chunk_lines: 外部排序每块的最大行数
+    :return: (合并后的IP数量, 现有文件中不重复的IP数量)
+    """
+    existing_count = 0
+    
+    def existing_entries():
+        last_key = None
+        with open(filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                ip = line.strip()
+                if not ip:
+                    continue
+                key = ip_sort_key(ip)
+                if last_key is not None and key < last_key:
+                    raise UnsortedFileError(f"{filename} 未按IP排序")
+                last_key = key
+                yield key, ip
+    
+    def merged_ips(existing):
+        nonlocal existing_count
+        existing_count = 0
+        # 键相同时现有文件中的条目排在前面，保留现有写法，并据此统计现有文件中不重复的IP
+        entries = heapq.merge(((key, 0, ip) for key, ip in existing),
+                              ((ip_sort_key(ip), 1, ip) for ip in new_ips))
+        last_key = None
+        for key, source, ip in entries:
+            if key != last_key:
+                last_key = key
+                if source == 0:
+                    existing_count += 1
+                yield ip
+    
+    try:
+        total_count = write_ip_file(filename, merged_ips(existing_entries()))
+    except UnsortedFileError:
+        print(f"提示：{filename} 未按IP排序（可能由流式模式生成），改为分块外部排序后合并")
+        runs = _write_sorted_runs(filename, chunk_lines)
+        try:
+            total_count = write_ip_file(filename, merged_ips(heapq.merge(*(_iter_run(run) for run in runs))))
+        finally:
+            for run_path in runs:
+                if os.path.exists(run_path):
+                    os.remove(run_path)
+    return total_count, existing_count
+
+class NDJSONResultSink:
+    """
+    流式输出：每完成一个IP就以一行JSON追加到结果文件
+    """
+
+    def __init__(self, file_path: str, append: bool = False, flush_every: int = 1000):
+        """
+        :param file_path: NDJSON输出文件路径
+        :param append: 是否追加到已有文件（否则覆盖）
+        :param flush_every: 每写入多少行刷新一次文件缓冲
+        """
+        output_dir = os.path.dirname(file_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.file = open(file_path, 'a' if append else 'w', encoding='utf-8')
+        self.written = 0
+
+    def add(self, ip: str, record: Dict):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.written += 1
+        if self.written % self.flush_every == 0:
+            self.file.flush()
+
+    def fail(self, ip: str, error: Optional[str]):
+        pass
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class FailedIPSink:
+    """
+    流式输出：将查询失败的IP逐行写入文件
+    """
+
+    def __init__(self, file_path: str):
+        """
+        :param file_path: 失败IP输出文件路径
+        """
+        self.file_path = file_path
+        self.file = None
+        self.count = 0
+
+    def add(self, ip: str, record: Dict):
+        pass
+
+    def fail(self, ip: str, error: Optional[str]):
+        if self.file is None:
+            self.file = open(self.file_path, 'w', encoding='utf-8')
+        self.file.write(f"{ip}\n")
+        self.count += 1
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+class CountryFileSink:
+    """
+    流式输出：按完成顺序把IP追加到对应国家代码的txt文件（不排序）
+    """
+
+    def __init__(self, output_dir: str, append: bool = False):
+        """
+        :param output_dir: 国家文件输出目录
+        :param append: 是否追加到已有文件（否则覆盖）
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.mode = 'a' if append else 'w'
+        self.files = {}
+
+    def add(self, ip: str, record: Dict):
+        country_code = (record.get('location') or {}).get('country_code') or 'Unknown'
+        f = self.files.get(country_code)
+        if f is None:
+            f = self.files[country_code] = open(
+                os.path.join(self.output_dir, f"{country_code}.txt"), self.mode, encoding='utf-8')
+        f.write(f"{ip}\n")
+
+    def fail(self, ip: str, error: Optional[str]):
+        pass
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+def ip_to_blob(ip: str) -> tuple:
+    """
+    将IP地址转换为 (版本, 16字节大端整数)，同一版本内按字节比较即按数值比较
+    :param ip: IP地址
+    :return: (4或6, 16字节)
+    """
+    address = ipaddress.ip_address(ip)
+    return address.version, int(address).to_bytes(16, 'big')
+
+# SQLite导出中建立索引的标识字段：每个标识一个只包含为真的行的部分索引
+SQLITE_FLAG_COLUMNS = tuple(FLAG_FIELDS)
+
+class SQLiteResultSink:
+    """
+    将查询结果写入带索引的SQLite数据库，供query命令按IP网段、国家、ASN、公司类型和is_*标识筛选；
+    已存在的数据库增量更新，相同IP的记录被替换，但继承自网段的部分结果不会替换完整记录
+    """
+
+    def __init__(self, db_path: str, flush_every: int = 5000):
+        """
+        :param db_path: SQLite数据库文件路径
+        :param flush_every: 累计多少条记录后提交一次
+        """
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.pending = []
+        self.written = 0
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        flag_columns = ''.join(f', {flag} INTEGER' for flag in SQLITE_FLAG_COLUMNS)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'ip TEXT NOT NULL, version INTEGER NOT NULL, ip_bin BLOB NOT NULL, '
+            'country_code TEXT, asn INTEGER, company_type TEXT'
+            f'{flag_columns}, checked_at REAL NOT NULL, data TEXT NOT NULL)'
+        )
+        # IP唯一索引既用于替换已有记录，也用于按网段做范围查询
+        self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS results_ip ON results(version, ip_bin)')
+        self.conn.commit()
+        columns = ('ip', 'country_code', 'asn', 'company_type') + SQLITE_FLAG_COLUMNS + ('checked_at', 'data')
+        placeholders = ', '.join('?' * (8 + len(SQLITE_FLAG_COLUMNS)))
+        self.insert_sql = (f"INSERT INTO results (ip, version, ip_bin, country_code, asn, company_type, "
+                           f"{', '.join(SQLITE_FLAG_COLUMNS)}, checked_at, data) VALUES ({placeholders}) "
+                           f"ON CONFLICT(version, ip_bin) DO UPDATE SET "
+                           f"{', '.join(f'{column} = excluded.{column}' for column in columns)} "
+                           f"WHERE json_extract(excluded.data, '$.inherited_from') IS NULL "
+                           f"OR json_extract(results.data, '$.inherited_from') IS NOT NULL")
+
+    def add(self, ip: str, record: Dict):
+        record = as_plain_record(record)
+        version, ip_bin = ip_to_blob(record.get('ip') or ip)
+        asn = (record.get('asn') or {}).get('asn')
+        flags = tuple(None if record.get(flag) is None else int(bool(record.get(flag))) for flag in SQLITE_FLAG_COLUMNS)
+        row = (record.get('ip') or ip, version, ip_bin,
+               (record.get('location') or {}).get('country_code'),
+               asn if isinstance(asn, int) else None,
+               (record.get('company') or {}).get('type')) + flags + (
+               time.time(), json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+        with self.lock:
+            self.pending.append(row)
+            if len(self.pending) >= self.flush_every:
+                self._flush_locked()
+
+    def fail(self, ip: str, error: Optional[str]):
+        pass
+
+    def _flush_locked(self):
+        if self.pending:
+            self.conn.executemany(self.insert_sql, self.pending)
+            self.conn.commit()
+            self.written += len(self.pending)
+            self.pending = []
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def close(self):
+        """
+        提交剩余记录并建立查询索引；索引在批量写入之后建立，比逐行维护快得多
+        """
+        with self.lock:
+            self._flush_locked()
+            self.conn.execute('CREATE INDEX IF NOT EXISTS results_country ON results(country_code, asn)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS results_asn ON results(asn)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS results_company_type ON results(company_type, country_code)')
+            for flag in SQLITE_FLAG_COLUMNS:
+                self.conn.execute(f'CREATE INDEX IF NOT EXISTS results_{flag} ON results(country_code, asn) WHERE {flag} = 1')
+            self.conn.execute('ANALYZE')
+            self.conn.commit()
+            self.conn.close()
+
+def export_sqlite(records: Iterable[Dict], db_path: str) -> int:
+    """
+    将查询结果写入SQLite数据库
+    :param records: 查询结果（字典或紧凑记录）
+    :param db_path: SQLite数据库文件路径
+    :return: 写入的记录数
+    """
+    sink = SQLiteResultSink(db_path)
+    try:
+        for record in records:
+            sink.add(record['ip'], record)
+    finally:
+        sink.close()
+    return sink.written
+
+class RecordSummary:
+    """
+    一次遍历统计查询结果的汇总信息：国家、ASN、公司类型和各is_*标识的数量，
+    也可以作为流式输出使用
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.failed = 0
+        self.countries = defaultdict(int)
+        self.asns = defaultdict(int)
+        self.asn_names = {}
+        self.company_types = defaultdict(int)
+        self.flags = defaultdict(int)
+        # 取值未知（None）的标识，例如网段缓存按unknown策略应答的记录
+        self.unknown_flags = defaultdict(int)
+
+    def add(self, ip: str, record: Dict):
+        self.total += 1
+        self.countries[record_country(record)] += 1
+        asn = record.get('asn') or {}
+        if asn.get('asn') is not None:
+            self.asns[asn['asn']] += 1
+            if asn['asn'] not in self.asn_names:
+                self.asn_names[asn['asn']] = asn.get('org') or asn.get('descr') or ''
+        self.company_types[(record.get('company') or {}).get('type') or 'Unknown'] += 1
+        for field in FLAG_FIELDS:
+            value = record.get(field)
+            if value:
+                self.flags[field] += 1
+            elif value is None:
+                self.unknown_flags[field] += 1
+
+    def fail(self, ip: str, error: Optional[str]):
+        self.failed += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def print_summary(self, top: int = 10):
+        """
+        打印汇总摘要
+        :param top: ASN排行显示的条目数
+        """
+        print("\n=== IP地区分类摘要 ===")
+        print(f"共 {self.total} 个IP，涉及 {len(self.countries)} 个国家/地区，{len(self.asns)} 个自治系统")
+        
+        print("\n【国家/地区】")
+        for country, count in sorted(self.countries.items(), key=lambda x: x[1], reverse=True):
+            print(f"{translate_to_chinese(country)}: {count} 个IP")
+        
+        if self.asns:
+            print(f"\n【自治系统（前 {top} 个）】")
+            for asn, count in sorted(self.asns.items(), key=lambda x: x[1], reverse=True)[:top]:
+                print(f"AS{asn} {translate_to_chinese(self.asn_names.get(asn, ''))}: {count} 个IP")
+        
+        print("\n【公司类型】")
+        for company_type, count in sorted(self.company_types.items(), key=lambda x: x[1], reverse=True):
+            print(f"{translate_to_chinese(company_type)}: {count} 个IP")
+        
+        print("\n【网络特征】")
+        for field, chinese_name in FLAG_FIELDS.items():
+            count = self.flags.get(field, 0)
+            ratio = count / self.total * 100 if self.total else 0
+            unknown = self.unknown_flags.get(field, 0)
+            print(f"{chinese_name}: {count} 个 ({ratio:.1f}%)" + (f"，未知 {unknown} 个" if unknown else ""))
+
+class StratifiedSampler:
+    """
+    分层抽样估计：按网段（IPv4 /16、IPv6 /48）把输入分层，每层用蓄水池抽样抽取固定数量的IP查询，
+    按层的大小加权估计整个输入的国家和ASN分布，并给出正态近似的置信区间；
+    至少min_agree个成功样本且国家全部一致的层，层内其余IP继承该国家
+    """
+
+    def __init__(self, per_stratum: int, seed: int = 0, confidence: float = 0.95, min_agree: int = 2):
+        """
+        :param per_stratum: 每层最多抽取的IP数
+        :param seed: 抽样随机种子
+        :param confidence: 置信区间的置信水平
+        :param min_agree: 层内IP继承国家所需的最少一致样本数
+        """
+        self.per_stratum = per_stratum
+        self.confidence = confidence
+        self.min_agree = min_agree
+        self.rng = random.Random(seed)
+        # 网段键 -> [层内IP数, 样本IP列表]
+        self.strata = {}
+        self.total = 0
+        # 网段键 -> 样本中查询成功的记录
+        self.results = {}
+        # 样本一致的层：网段键 -> 国家代码
+        self.inherited = {}
+        self.records = {}
+
+    def add(self, ip: str):
+        """
+        加入一个输入IP（蓄水池抽样，每层只保留per_stratum个样本）
+        """
+        key = stratum_key(ip)
+        stratum = self.strata.get(key)
+        if stratum is None:
+            stratum = self.strata[key] = [0, []]
+        stratum[0] += 1
+        self.total += 1
+        if len(stratum[1]) < self.per_stratum:
+            stratum[1].append(ip)
+        else:
+            slot = int(self.rng.random() * stratum[0])
+            if slot < self.per_stratum:
+                stratum[1][slot] = ip
+
+    def sample_ips(self) -> List[str]:
+        """
+        :return: 所有层的样本IP
+        """
+        return [ip for _, sample in self.strata.values() for ip in sample]
+
+    def set_results(self, records: Iterable[Dict]):
+        """
+        记录样本的查询结果，并找出成功样本足够多且国家一致、可以整体继承的层
+        :param records: 查询成功的样本记录
+        """
+        self.records = {record['ip']: record for record in records}
+        self.results = {}
+        for key, (_, sample) in self.strata.items():
+            found = [self.records[ip] for ip in sample if ip in self.records]
+            if found:
+                self.results[key] = found
+        self.inherited = {}
+        for key, found in self.results.items():
+            if len(found) < self.min_agree:
+                # 只有一个成功样本时"一致"没有意义，层内其余IP不继承
+                continue
+            codes = {record_country_code(record) for record in found}
+            if len(codes) == 1:
+                self.inherited[key] = codes.pop()
+
+    def estimate(self, label) -> tuple:
+        """
+        分层估计每个取值的IP数：层内样本比例乘以层的大小后求和，
+        方差为各层 N²·(1-n/N)·p(1-p)/(n-1) 之和；只有一个成功样本的层无法估计层内方差，按最大值 p(1-p)=0.25 保守计入
+        没有成功样本的层不参与估计
+        :param label: 从记录中取出分类值的函数
+        :return: ([(取值, 估计数, 区间下限, 区间上限), ...]按估计数降序, 参与估计的IP数)
+        """
+        z = NormalDist().inv_cdf(0.5 + self.confidence / 2)
+        sums = defaultdict(float)
+        variances = defaultdict(float)
+        singleton_variance = 0.0
+        covered = 0
+        for key, found in self.results.items():
+            size = self.strata[key][0]
+            n = len(found)
+            covered += size
+            correction = 1 - n / size
+            if n == 1:
+                singleton_variance += 0.25 * size * size * correction
+            hits = defaultdict(int)
+            for record in found:
+                hits[label(record)] += 1
+            for value, count in hits.items():
+                p = count / n
+                sums[value] += size * p
+                if n > 1:
+                    variances[value] += size * size * correction * p * (1 - p) / (n - 1)
+        
+        rows = []
+        for value, total in sums.items():
+            margin = z * math.sqrt(variances[value] + singleton_variance)
+            rows.append((value, total, max(0.0, total - margin), min(float(covered), total + margin)))
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows, covered
+
+    def assign_countries(self, ip_list: Iterable[str]) -> tuple:
+        """
+        为全部输入IP确定国家代码：查询过的样本使用查询结果，样本一致的层中其余IP继承层的国家，
+        继承的IP与查询过的IP分开返回
+        :param ip_list: 输入IP
+        :return: (国家代码到查询过的IP列表的映射, 国家代码到继承国家的IP列表的映射, 无法确定国家的IP列表)
+        """
+        groups = defaultdict(list)
+        inherited_groups = defaultdict(list)
+        unresolved = []
+        inherited = self.inherited
+        records = self.records
+        for ip in ip_list:
+            record = records.get(ip)
+            if record is not None:
+                groups[record_country_code(record)].append(ip)
+                continue
+            code = inherited.get(stratum_key(ip))
+            if code is None:
+                unresolved.append(ip)
+            else:
+                inherited_groups[code].append(ip)
+        return groups, inherited_groups, unresolved
+
+    def print_summary(self, top: int = 10):
+        """
+        打印抽样估计摘要
+        :param top: ASN排行显示的条目数
+        """
+        sampled = sum(len(sample) for _, sample in self.strata.values())
+        succeeded = len(self.records)
+        ratio = sampled / self.total * 100 if self.total else 0
+        level = f"{self.confidence * 100:g}%"
+        
+        print("\n=== 抽样估计摘要 ===")
+        print(f"输入 {self.total} 个IP，按网段（IPv4 /16、IPv6 /48）分为 {len(self.strata)} 层，每层最多抽取 {self.per_stratum} 个")
+        print(f"抽样查询 {sampled} 个IP（{ratio:.2f}%），成功 {succeeded} 个")
+        
+        countries, covered = self.estimate(record_country)
+        if covered < self.total:
+            missing = len(self.strata) - len(self.results)
+            print(f"{missing} 层没有查询成功的样本，其中 {self.total - covered} 个IP未计入估计")
+        
+        print(f"\n【国家/地区（估计值，{level}置信区间）】")
+        for country, total, low, high in countries:
+            share = total / covered * 100 if covered else 0
+            print(f"{translate_to_chinese(country)}: 约 {total:.0f} 个IP（{low:.0f} - {high:.0f}），占 {share:.1f}%")
+        
+        asns, _ = self.estimate(lambda record: (record.get('asn') or {}).get('asn'))
+        asns = [row for row in asns if row[0] is not None]
+        if asns:
+            names = {}
+            for record in self.records.values():
+                asn = record.get('asn') or {}
+                if asn.get('asn') is not None and asn['asn'] not in names:
+                    names[asn['asn']] = asn.get('org') or asn.get('descr') or ''
+            print(f"\n【自治系统（估计值，前 {top} 个）】")
+            for asn, total, low, high in asns[:top]:
+                print(f"AS{asn} {translate_to_chinese(names.get(asn, ''))}: 约 {total:.0f} 个IP（{low:.0f} - {high:.0f}）")
+        
+        inherited_ips = sum(self.strata[key][0] - len(self.results[key]) for key in self.inherited)
+        print(f"\n至少 {self.min_agree} 个样本且国家一致的层: {len(self.inherited)} 层，"
+              f"其中未查询的 {inherited_ips} 个IP按层继承国家，写入 <国家代码>.inherited.txt")
+
+def format_duration(seconds: float) -> str:
+    """
+    将秒数格式化为 时:分:秒 或 分:秒
+    """
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
+class ProgressReporter:
+    """
+    限频的进度输出：最多每interval秒输出一次进度、速率和预计剩余时间，
+    避免逐IP打印使终端输出成为瓶颈；只应在消费结果的线程中调用
+    """
+
+    def __init__(self, total: Optional[int] = None, interval: float = 0.5):
+        """
+        :param total: IP总数，未知时（流式模式）不显示百分比和预计剩余时间
+        :param interval: 两次输出之间的最小间隔（秒），0表示每个IP输出一行
+        """
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.overwrite = sys.stdout.isatty()
+
+    def update(self, ip: str, success: bool = True):
+        """
+        记录一个IP完成
+        :param ip: IP地址
+        :param success: 是否查询成功
+        """
+        self.done += 1
+        if not success:
+            self.failed += 1
+        if self.interval <= 0:
+            if self.total:
+                print(f"处理进度: {self.done}/{self.total} ({self.done / self.total * 100:.1f}%) - {ip}")
+            else:
+                print(f"处理进度: {self.done} - {ip}")
+            return
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self._report(now)
+
+    def _report(self, now: float):
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        if self.total:
+            line = f"处理进度: {self.done}/{self.total} ({self.done / self.total * 100:.1f}%)"
+        else:
+            line = f"处理进度: {self.done}"
+        line += f"，失败 {self.failed}，{rate:.1f} 个/秒"
+        if self.total and rate > 0:
+            line += f"，预计剩余 {format_duration((self.total - self.done) / rate)}"
+        if self.overwrite:
+            print(f"\r{line}\033[K", end='', flush=True)
+        else:
+            print(line, flush=True)
+
+    def finish(self):
+        """
+        输出最终进度和平均速率
+        """
+        if self.interval <= 0:
+            return
+        elapsed = time.monotonic() - self.started
+        if self.overwrite and self.done:
+            print()
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        print(f"查询完成: {self.done} 个IP（失败 {self.failed} 个），用时 {format_duration(elapsed)}，平均 {rate:.1f} 个/秒")
+
+class CheckpointJournal:
+    """
+    检查点日志（预写日志）：每完成一个IP就追加一行记录，按批刷新并同步到磁盘，
+    程序中断后可以通过replay()恢复已完成的查询结果
+    """
+
+    def __init__(self, file_path: str, append: bool = False, flush_every: int = 100, before_flush=None):
+        """
+        :param file_path: 检查点日志文件路径
+        :param append: 是否追加到已有日志（恢复运行时使用）
+        :param flush_every: 每完成多少个IP同步一次磁盘
+        :param before_flush: 可选的回调，在日志同步前调用（用于先刷新其他输出，保证日志中的记录都已写出）
+        """
+        output_dir = os.path.dirname(file_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.before_flush = before_flush
+        self.file = open(file_path, 'a' if append else 'w', encoding='utf-8')
+        self.pending = 0
+
+    @staticmethod
+    def replay(file_path: str) -> Dict[str, Dict]:
+        """
+        读取检查点日志
+        :param file_path: 检查点日志文件路径
+        :return: IP到查询结果的映射，日志不存在时返回空字典
+        """
+        done = {}
+        if not os.path.exists(file_path):
+            return done
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 中断时最后一行可能不完整
+                    continue
+                done[entry['ip']] = entry['record']
+        return done
+
+    def add(self, ip: str, record: Dict):
+        self.file.write(json.dumps({'ip': ip, 'record': record}, ensure_ascii=False) + '\n')
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def fail(self, ip: str, error: Optional[str]):
+        pass
+
+    def flush(self):
+        """
+        将日志同步到磁盘
+        """
+        if self.before_flush is not None:
+            self.before_flush()
+        self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        # 关闭时其他输出可能已经关闭，只同步日志本身
+        if not self.file.closed:
+            self._sync()
+            self.file.close()
+
+    def remove(self):
+        """
+        运行成功完成后删除检查点日志
+        """
+        self.close()
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+def notify_sinks(sinks: Optional[list], ip: str, record: Optional[Dict], error: Optional[str]):
+    """
+    将一个IP的查询结果交给所有下游输出
+    :param sinks: 下游输出列表，可以为None
+    :param ip: IP地址
+    :param record: 查询结果，失败时为None
+    :param error: 错误信息
+    """
+    if not sinks:
+        return
+    for sink in sinks:
+        if record:
+            sink.add(ip, record)
+        else:
+            sink.fail(ip, error)
+
+def iter_chunks(items: Iterable, size: int) -> Iterator[list]:
+    """
+    将可迭代对象按固定大小惰性分组
+    :param items: 可迭代对象
+    :param size: 每组大小
+    :return: 列表迭代器
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+@contextlib.contextmanager
+def open_input(file_path: str):
+    """
+    以二进制流打开输入：'-' 为标准输入，.gz 用gzip解压，.zst 用zstandard解压（可选依赖），其余为普通文件
+    :param file_path: 文件路径
+    :return: 二进制文件对象（上下文管理器）
+    """
+    if file_path == '-':
+        yield sys.stdin.buffer
+    elif file_path.endswith('.gz'):
+        with gzip.open(file_path, 'rb') as f:
+            yield f
+    elif file_path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError("读取 .zst 文件需要安装zstandard: pip install zstandard")
+        with open(file_path, 'rb') as raw, zstandard.ZstdDecompressor().stream_reader(raw) as f:
+            yield f
+    else:
+        with open(file_path, 'rb') as f:
+            yield f
+
+def iter_ip_list(file_path: str) -> Iterator[str]:
+    """
+    逐行惰性读取IP列表，不会把整个文件读入内存；支持标准输入（-）、.gz 和 .zst
+    :param file_path: 文件路径
+    :return: IP地址迭代器
+    """
+    with open_input(file_path) as raw:
+        for line in io.TextIOWrapper(raw, encoding='utf-8', errors='replace'):
+            line = line.strip()
+            if line:
+                yield line
+
+def iter_input_chunks(file_path: str, chunk_size: int = 4 * 1024 * 1024) -> Iterator:
+    """
+    按大块读取输入，每块都在换行处结束，不会把一行拆到两块中；
+    普通文件用mmap映射后按块切分，由操作系统按需换页，不经过文件对象的逐行读取
+    :param file_path: 文件路径（'-'、.gz、.zst 或普通文件）
+    :param chunk_size: 每块的大致字节数
+    :return: bytes迭代器
+    """
+    if file_path != '-' and not file_path.endswith(('.gz', '.zst')):
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start = 0
+                while start < size:
+                    end = min(start + chunk_size, size)
+                    if end < size:
+                        cut = mm.rfind(b'\n', start, end)
+                        end = cut + 1 if cut >= 0 else end
+                    yield mm[start:end]
+                    start = end
+        return
+    
+    with open_input(file_path) as f:
+        tail = b''
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            cut = block.rfind(b'\n') + 1
+            if cut == 0:
+                tail += block
+                continue
+            yield tail + block[:cut]
+            tail = block[cut:]
+        if tail:
+            yield tail
+
+# 日志扫描用的IP模式。整个模式以字符集开头，正则引擎可以快速跳过不可能开始匹配的位置；
+# 第一个字符之后再用后顾断言区分IPv4和IPv6，并检查前一个字符，避免从更长的数字或十六进制串中间开始匹配
+_IP_OCTET = rb'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+# IPv4：四段0-255且无前导零，前后不能紧接数字或点（排除版本号、更长的点分数字）
+_IPV4_REST = (rb'(?<=[0-9])(?<![0-9.][0-9])'
+              rb'(?:(?<=2)(?:5[0-5]|[0-4][0-9]|[0-9])?|(?<=1)(?:[0-9][0-9]?)?|(?<=[3-9])[0-9]?|(?<=0))\.'
+              rb'(?:' + _IP_OCTET + rb'\.){2}' + _IP_OCTET + rb'(?!\.?[0-9])')
+# IPv6候选：至少两个冒号的十六进制串（可带内嵌IPv4），最终由ipaddress校验
+_IPV6_REST = (rb'(?<![0-9A-Fa-f:.][0-9A-Fa-f:])(?:(?<=:)|[0-9A-Fa-f]{0,3}:)(?:[0-9A-Fa-f]{0,4}:){1,6}'
+              rb'(?:[0-9]{1,3}(?:\.[0-9]{1,3}){3}|[0-9A-Fa-f]{1,4})?(?![0-9A-Fa-f:])')
+LOG_IP_PATTERN = re.compile(rb'[0-9A-Fa-f:](?:' + _IPV4_REST + rb'|' + _IPV6_REST + rb')')
+
+class LogIPExtractor:
+    """
+    从任意文本（nginx、防火墙日志等）中提取IPv4/IPv6地址，边扫描边去重，
+    只有第一次出现的地址会被产出；可选统计每个地址的出现次数
+    """
+
+    def __init__(self, count_hits: bool = False):
+        """
+        :param count_hits: 是否统计每个IP的出现次数
+        """
+        self.count_hits = count_hits
+        # IPv4以匹配到的原始字节为键（正则保证写法唯一），IPv6以规范化后的字符串为键
+        self.seen = {} if count_hits else set()
+        self.bytes_scanned = 0
+        self.matches = 0
+        self.unique = {4: 0, 6: 0}
+
+    def scan(self, chunks: Iterable) -> Iterator[str]:
+        """
+        扫描输入块，产出去重后的规范化IP地址
+        :param chunks: iter_input_chunks产出的bytes块
+        :return: IP地址迭代器（按第一次出现的顺序）
+        """
+        seen = self.seen
+        count_hits = self.count_hits
+        for chunk in chunks:
+            self.bytes_scanned += len(chunk)
+            for match in LOG_IP_PATTERN.findall(chunk):
+                is_v6 = b':' in match
+                if not is_v6:
+                    key = match
+                else:
+                    # 时间戳、MAC地址等也会命中候选模式：合法IPv6必须含 :: 或至少6个冒号；
+                    # 每段都是两位十六进制数的是EUI-64等冒号分隔的硬件地址，不是IPv6
+                    if b'::' not in match and (match.count(b':') < 6 or
+                                               all(len(group) == 2 for group in match.split(b':'))):
+                        continue
+                    try:
+                        key = str(ipaddress.IPv6Address(match.decode('ascii')))
+                    except ValueError:
+                        continue
+                self.matches += 1
+                if key in seen:
+                    if count_hits:
+                        seen[key] += 1
+                    continue
+                if count_hits:
+                    seen[key] = 1
+                else:
+                    seen.add(key)
+                if is_v6:
+                    self.unique[6] += 1
+                    yield key
+                else:
+                    self.unique[4] += 1
+                    yield key.decode('ascii')
+
+    def write_hits(self, file_path: str) -> int:
+        """
+        按出现次数从多到少写出每个IP的命中次数（制表符分隔）
+        :param file_path: 输出文件路径
+        :return: 写出的IP数
+        """
+        ranked = sorted(self.seen.items(), key=lambda item: -item[1])
+        with open(file_path, 'w', encoding='utf-8') as f:
+            for key, hits in ranked:
+                f.write(f"{key.decode('ascii') if isinstance(key, bytes) else key}\t{hits}\n")
+        return len(ranked)
+
+    def print_summary(self):
+        """
+        打印提取统计
+        """
+        print(f"扫描 {self.bytes_scanned / 1024 / 1024:.1f} MB，匹配IP {self.matches} 次，"
+              f"唯一IP {self.unique[4] + self.unique[6]} 个（IPv4 {self.unique[4]}，IPv6 {self.unique[6]}）")
+
+def extract_ips(file_path: str, extractor: LogIPExtractor) -> Iterator[str]:
+    """
+    从日志文件中惰性提取去重后的IP地址
+    :param file_path: 文件路径（'-'、.gz、.zst 或普通文件）
+    :param extractor: 提取器，扫描结束后可读取统计和命中次数
+    :return: IP地址迭代器
+    """
+    return extractor.scan(iter_input_chunks(file_path))
+
+def load_log_ips(file_path: str, extractor: LogIPExtractor) -> List[str]:
+    """
+    从日志文件提取IP列表（去重，保持第一次出现的顺序）
+    :param file_path: 文件路径（'-'、.gz、.zst 或普通文件）
+    :param extractor: 提取器
+    :return: IP地址列表
+    """
+    try:
+        return list(extract_ips(file_path, extractor))
+    except FileNotFoundError:
+        print(f"文件未找到: {file_path}")
+        return []
+    except Exception as e:
+        print(f"读取文件时出错: {e}")
+        return []
+
+class InputReport:
+    """
+    输入预处理统计：记录有效、重复、展开和被拒绝的行
+    """
+
+    # 最多保留多少条被拒绝行的示例
+    MAX_EXAMPLES = 10
+
+    def __init__(self):
+        self.total_lines = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.expanded_blocks = 0
+        self.rejected = 0
+        self.rejected_examples = []
+        # 去重集合达到上限后轮换的次数（流式模式）
+        self.dedupe_rotations = 0
+
+    def reject(self, line_no: int, line: str, reason: str):
+        self.rejected += 1
+        if len(self.rejected_examples) < self.MAX_EXAMPLES:
+            self.rejected_examples.append((line_no, line, reason))
+
+    def print_summary(self):
+        """
+        打印输入预处理统计
+        """
+        print(f"读取 {self.total_lines} 行，有效IP {self.accepted} 个，"
+              f"去除重复 {self.duplicates} 个，展开CIDR {self.expanded_blocks} 个，拒绝 {self.rejected} 行")
+        if self.dedupe_rotations:
+            print(f"去重集合达到上限，已轮换 {self.dedupe_rotations} 次：相距很远的重复IP可能未被去除（写入记录库和国家文件时仍会去重）")
+        if self.rejected_examples:
+            print("被拒绝的行:")
+            for line_no, line, reason in self.rejected_examples:
+                print(f"  第 {line_no} 行: {line} ({reason})")
+            if self.rejected > len(self.rejected_examples):
+                print(f"  ... 另有 {self.rejected - len(self.rejected_examples)} 行未显示")
+
+def normalize_ip_lines(lines: Iterable[str], report: Optional[InputReport] = None,
+                       max_cidr_size: int = 65536, hosts_only: bool = False,
+                       dedupe_limit: int = 0) -> Iterator[str]:
+    """
+    使用ipaddress解析输入行：规范化IP写法、展开CIDR网段、在查询前去除重复
+    :param lines: 输入行（已去除首尾空白）
+    :param report: 可选的统计对象
+    :param max_cidr_size: 允许展开的CIDR网段最大地址数
+    :param hosts_only: 展开CIDR时只保留主机地址（去掉IPv4网络地址、广播地址和IPv6子网路由器任播地址），默认展开全部地址
+    :param dedupe_limit: 去重集合的最大条目数，0表示不限制；达到上限时保留上一代集合并开始新的一代，
+                         内存占用不超过两代，代价是相距很远的重复IP可能未被去除
+    :return: 规范化且去重后的IP地址迭代器
+    """
+    report = report if report is not None else InputReport()
+    seen = set()
+    previous = set()
+    
+    for line_no, line in enumerate(lines, 1):
+        report.total_lines += 1
+        try:
+            candidates = [ipaddress.ip_address(line)]
+        except ValueError:
+            if '/' not in line:
+                report.reject(line_no, line, "不是有效的IP地址")
+                continue
+            try:
+                network = ipaddress.ip_network(line, strict=False)
+            except ValueError:
+                report.reject(line_no, line, "不是有效的CIDR网段")
+                continue
+            if network.num_addresses > max_cidr_size:
+                report.reject(line_no, line, f"网段包含 {network.num_addresses} 个地址，超过上限 {max_cidr_size}")
+                continue
+            report.expanded_blocks += 1
+            candidates = network.hosts() if hosts_only else iter(network)
+        
+        for address in candidates:
+            key = (address.version << 128) | int(address)
+            if key in seen or key in previous:
+                report.duplicates += 1
+                continue
+            if dedupe_limit and len(seen) >= dedupe_limit:
+                previous = seen
+                seen = set()
+                report.dedupe_rotations += 1
+            seen.add(key)
+            report.accepted += 1
+            yield str(address)
+
+def load_ip_list(file_path: str, report: Optional[InputReport] = None, max_cidr_size: int = 65536,
+                 hosts_only: bool = False) -> List[str]:
+    """
+    从文件加载IP列表（规范化、展开CIDR并去重）
+    :param file_path: 文件路径
+    :param report: 可选的输入统计对象
+    :param max_cidr_size: 允许展开的CIDR网段最大地址数
+    :param hosts_only: 展开CIDR时只保留主机地址
+    :return: IP地址列表
+    """
+    try:
+        return list(normalize_ip_lines(iter_ip_list(file_path), report, max_cidr_size, hosts_only))
+    except FileNotFoundError:
+        print(f"文件未找到: {file_path}")
+        return []
+    except Exception as e:
+        print(f"读取文件时出错: {e}")
+        return []
+
+def parse_shard(spec: str) -> tuple:
+    """
+    解析分片参数
+    :param spec: 形如 "i/N" 的分片描述，i从0开始
+    :return: (分片序号, 分片总数)
+    """
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"分片参数格式应为 i/N（如 0/4）: {spec}")
+    if count < 1 or not (0 <= index < count):
+        raise ValueError(f"分片序号必须在 0 到 N-1 之间: {spec}")
+    return index, count
+
+def network_key(ip: str) -> int:
+    """
+    计算IP所在网段（IPv4 /24、IPv6 /48）的键，IPv4和IPv6的键互不冲突
+    :param ip: IP地址
+    :return: 网段键，无效地址返回-1
+    """
+    key = ip_sort_key(ip)
+    if key < 0:
+        return -1
+    return key >> 8 if key >> 128 == 4 else key >> 80
+
+def stratum_key(ip: str) -> int:
+    """
+    计算抽样分层用的网段（IPv4 /16、IPv6 /48）键，IPv4和IPv6的键互不冲突
+    :param ip: 规范化后的IP地址
+    :return: 网段键，无效地址返回-1
+    """
+    if ':' not in ip:
+        # 规范化后的IPv4地址直接取前两段，避免为每个IP构造ipaddress对象
+        try:
+            first, second, _ = ip.split('.', 2)
+            return (4 << 112) | (int(first) << 8) | int(second)
+        except ValueError:
+            return -1
+    key = ip_sort_key(ip)
+    if key < 0:
+        return -1
+    return key >> 80
+
+def shard_of(ip: str, count: int) -> int:
+    """
+    计算IP所属的分片：按所在网段（IPv4 /24、IPv6 /48）哈希，
+    同一网段的IP总在同一个分片中，网段缓存和离线网段库在各分片内仍然有效；
+    使用crc32而不是hash()，不同进程、不同机器上结果一致
+    :param ip: 规范化后的IP地址
+    :param count: 分片总数
+    :return: 分片序号
+    """
+    prefix = network_key(ip)
+    if prefix < 0:
+        return 0
+    return zlib.crc32(prefix.to_bytes(17, 'big')) % count
+
+def filter_shard(ips: Iterable[str], index: int, count: int) -> Iterator[str]:
+    """
+    只保留属于指定分片的IP
+    :param ips: IP地址迭代器
+    :param index: 分片序号
+    :param count: 分片总数
+    :return: IP地址迭代器
+    """
+    for ip in ips:
+        if shard_of(ip, count) == index:
+            yield ip
+
+def shard_path(path: str, index: int, count: int) -> str:
+    """
+    为分片运行生成输出路径，例如 iptest_results.json -> iptest_results.shard-0-of-4.json
+    :param path: 原输出路径（文件或目录）
+    :param index: 分片序号
+    :param count: 分片总数
+    :return: 分片输出路径
+    """
+    base, ext = os.path.splitext(path.rstrip('/\\'))
+    return f"{base}.shard-{index}-of-{count}{ext}"
+
+def get_user_input(prompt: str, default: str = None) -> str:
+    """
+    获取用户输入，支持默认值
+    :param prompt: 提示信息
+    :param default: 默认值
+    :return: 用户输入的值
+    """
+    if default:
+        user_input = input(f"{prompt} (默认: {default}): ").strip()
+        return user_input if user_input else default
+    else:
+        return input(f"{prompt}: ").strip()
+
+def interactive_mode() -> tuple:
+    """
+    交互式模式，获取用户输入
+    :return: (input_file, output_file, api_key, country_files_dir, merge_mode, max_workers)
+    """
+    print("\n=== 交互式配置 ===")
+    
+    # 获取输入文件
+    while True:
+        input_file = get_user_input("请输入包含IP地址的文件路径", "ips.txt")
+        if os.path.exists(input_file):
+            break
+        else:
+            print(f"文件 '{input_file}' 不存在，请重新输入或创建该文件。")
+    
+    # 获取输出文件
+    output_file = get_user_input("请输入JSON结果输出文件路径", "iptest_results.json")
+    
+    # 获取API密钥（可选）
+    api_key = get_user_input("请输入ipapi.is的API密钥（可选，直接回车使用内置密钥）", "")
+    api_key = api_key if api_key else None
+    
+    # 获取国家文件输出目录
+    country_files_dir = get_user_input("请输入国家分类文件输出目录", "country_files")
+    
+    # 获取并发线程数
+    while True:
+        try:
+            threads_input = get_user_input("请输入并发线程数（1-20，默认: 5）", "5")
+            max_workers = int(threads_input)
+            if 1 <= max_workers <= 20:
+                break
+            else:
+                print("线程数必须在1-20之间，请重新输入。")
+        except ValueError:
+            print("请输入有效的数字，请重新输入。")
+    
+    # 询问是否使用合并模式
+    merge_input = get_user_input("是否使用合并模式（y/n，默认: n）", "n")
+    merge_mode = merge_input.lower() in ['y', 'yes', '是']
+    
+    return input_file, output_file, api_key, country_files_dir, merge_mode, max_workers
+
+def print_lookup_stats(classifier: IPClassifier):
+    """
+    输出缓存、网段缓存和限速器的统计信息
+    :param classifier: IP分类器
+    """
+    cache = classifier.cache
+    if cache is not None:
+        cache.flush()
+        cache_stats = cache.stats
+        print(f"缓存命中: {cache_stats['memory_hits'] + cache_stats['disk_hits']} "
+              f"(内存 {cache_stats['memory_hits']}，磁盘 {cache_stats['disk_hits']})")
+        print(f"缓存未命中: {cache_stats['misses']}")
+        print(f"缓存已过期: {cache_stats['expired']}")
+    
+    rate_limiter = classifier.rate_limiter
+    if rate_limiter is not None:
+        print(f"自适应限速: 最终速率 {rate_limiter.rate:.1f} 次/秒，"
+              f"限流 {rate_limiter.stats['throttled']} 次，重试 {rate_limiter.stats['retries']} 次")
+    
+    network_cache = classifier.network_cache
+    if network_cache is not None:
+        print(f"网段缓存命中: {network_cache.stats['hits']} (已知网段 {network_cache.range_count} 个)")
+        if network_cache.stats['needs_lookup']:
+            print(f"命中已知网段但需逐IP查询: {network_cache.stats['needs_lookup']} "
+                  f"(继承字段未覆盖全部字段，可用 --network-cache-policy unknown 在本地应答)")
+    
+    offline_db = classifier.offline_db
+    if offline_db is not None:
+        print(f"离线网段库命中: {offline_db.stats['hits']}，未命中: {offline_db.stats['misses']}")
+        if offline_db.stats['needs_lookup']:
+            print(f"命中离线网段库但需逐IP查询: {offline_db.stats['needs_lookup']} "
+                  f"(网段库未包含全部字段，可用 --offline-db-policy unknown 在本地应答)")
+    
+    if len(classifier.providers) > 1:
+        for provider in classifier.providers:
+            health = provider.health
+            p95 = health.p95()
+            line = (f"后端 {provider.name}: 成功 {health.stats['success']}，失败 {health.stats['failure']}，"
+                    f"暂停 {health.stats['trips']} 次")
+            if p95 is not None:
+                line += f"，p95 {p95 * 1000:.1f} ms"
+            if classifier.hedge:
+                line += f"，发出对冲 {health.stats['hedged']} 次，对冲胜出 {health.stats['hedge_wins']} 次"
+            print(line)
+    
+    metrics = classifier.metrics
+    if metrics is not None:
+        summary = metrics.summary()
+        lookup = summary['lookup_latency']
+        if lookup['count']:
+            print(f"API查询延迟: p50 {lookup['p50_ms']:.1f} ms，p90 {lookup['p90_ms']:.1f} ms，p99 {lookup['p99_ms']:.1f} ms")
+        provider = summary['provider_elapsed']
+        if provider['count']:
+            print(f"服务端耗时(elapsed_ms): p50 {provider['p50_ms']:.1f} ms，p99 {provider['p99_ms']:.1f} ms")
+        connections = summary['connections']
+        print(f"连接: 新建 {connections['new']}，复用 {connections['reused']}")
+        if summary['errors']:
+            print("错误分类: " + "，".join(f"{name} {count}" for name, count in sorted(summary['errors'].items())))
+
+def add_lookup_arguments(parser: argparse.ArgumentParser):
+    """
+    添加查询相关的命令行参数（API、限速、重试、缓存、网段库），主程序和serve命令共用
+    :param parser: 命令行解析器
+    """
+    parser.add_argument('-k', '--api-key', help='ipapi.is的API密钥（可选，默认使用内置密钥）')
+    parser.add_argument('--timeout', type=float, default=10, help='单次请求超时时间（秒，默认: 10）')
+    parser.add_argument('--rate', type=float, default=20, help='自适应限速的初始速率（次/秒，默认: 20，0表示不限速）')
+    parser.add_argument('--max-rate', type=float, default=1000, help='自适应限速的最高速率（次/秒，默认: 1000）')
+    parser.add_argument('--retries', type=int, default=3, help='遇到限流、5xx或网络错误时的最大重试次数（默认: 3）')
+    parser.add_argument('--api-url', default='https://api.ipapi.is/', help='API地址（默认: https://api.ipapi.is/，可指向本地测试服务）')
+    parser.add_argument('--cache', nargs='?', const='iptest_cache.db', help='启用持久化查询缓存（默认文件: iptest_cache.db）')
+    parser.add_argument('--cache-ttl', type=float, default=24, help='缓存有效期（小时，默认: 24，0表示永不过期）')
+    parser.add_argument('--cache-size', type=int, default=10000, help='内存缓存最多保留的IP数（默认: 10000）')
+    parser.add_argument('--offline-db', help='离线网段库文件（由compile-db命令生成），优先在本地应答，未命中时才请求API；'
+                                             '网段库未包含全部字段时按--offline-db-policy处理')
+    parser.add_argument('--offline-db-policy', choices=NETWORK_CACHE_POLICIES, default='lookup',
+                        help='离线网段库命中但缺少部分字段（如is_vpn）时：lookup=仍逐IP查询API；'
+                             'unknown=本地应答，这些字段标记为未知（null）并注明来源网段（默认: lookup）')
+    parser.add_argument('--network-cache', action='store_true',
+                        help='启用网段缓存：已知网段内的IP继承网段信息；继承字段未覆盖全部字段时按--network-cache-policy处理')
+    parser.add_argument('--inherit-fields', default=','.join(DEFAULT_NETWORK_INHERIT),
+                        help=f"网段缓存允许继承的字段，逗号分隔（默认: {','.join(DEFAULT_NETWORK_INHERIT)}）")
+    parser.add_argument('--network-cache-policy', choices=NETWORK_CACHE_POLICIES, default='lookup',
+                        help='网段缓存命中但有不可继承的字段（如is_vpn）时：lookup=仍逐IP查询API；'
+                             'unknown=本地应答，这些字段标记为未知（null）并注明来源网段（默认: lookup）')
+    parser.add_argument('--provider', action='append', metavar='SPEC',
+                        help='查询后端，可重复指定，按优先级排列：ipapi（使用--api-url）、ipapi:<地址>、offline:<离线网段库文件>（默认: ipapi）')
+    parser.add_argument('--hedge', action='store_true', help='对冲请求：首选后端超过其p95延迟仍未应答时向下一个后端再发一次，取先返回的结果')
+    parser.add_argument('--hedge-delay', type=float, default=0.5, help='后端延迟样本不足时的对冲等待时间（秒，默认: 0.5）')
+    parser.add_argument('--failover-error-rate', type=float, default=0.5, help='后端最近请求的错误率达到该值时暂停使用并切换到下一个后端（默认: 0.5）')
+    parser.add_argument('--failover-cooldown', type=float, default=30, help='后端被暂停使用的时间（秒，默认: 30）')
+
+def build_classifier(args, api_key: Optional[str] = None,
+                     metrics: Optional[LookupMetrics] = None,
+                     profiler: Optional[StageProfiler] = None) -> Optional[IPClassifier]:
+    """
+    按add_lookup_arguments添加的参数创建查询缓存、网段缓存、离线网段库、限速器和分类器
+    :param args: 命令行参数
+    :param api_key: API密钥，为None时使用args.api_key
+    :param metrics: 可选的查询指标收集器
+    :param profiler: 可选的剖析器
+    :return: IP分类器，参数错误时输出原因并返回None
+    """
+    # 创建网段缓存
+    network_cache = None
+    if args.network_cache:
+        inherit_fields = [field.strip() for field in args.inherit_fields.split(',') if field.strip()]
+        try:
+            network_cache = NetworkCache(inherit_fields, args.network_cache_policy)
+        except ValueError as e:
+            print(f"错误：{e}")
+            return None
+    
+    # 加载离线网段库
+    offline_db = None
+    if args.offline_db:
+        try:
+            offline_db = OfflineRangeDB(args.offline_db, args.offline_db_policy)
+        except (OSError, ValueError) as e:
+            print(f"错误：无法加载离线网段库: {e}")
+            return None
+    
+    # 创建查询后端
+    health_options = {'error_threshold': args.failover_error_rate, 'cooldown': args.failover_cooldown}
+    try:
+        providers = [parse_provider_spec(spec, args.api_url, api_key or args.api_key, health_options)
+                     for spec in args.provider or ['ipapi']]
+    except (OSError, ValueError) as e:
+        print(f"错误：无法创建查询后端: {e}")
+        return None
+    
+    # 创建查询缓存
+    cache = None
+    if args.cache:
+        cache = LookupCache(args.cache, ttl=args.cache_ttl * 3600, memory_size=args.cache_size)
+        print(f"查询缓存文件: {args.cache} (有效期 {args.cache_ttl} 小时)")
+    if network_cache is not None:
+        print(f"网段缓存已启用，继承字段: {', '.join(network_cache.inherit_fields)}，策略: {network_cache.policy}")
+        if not network_cache.answers_locally:
+            print("警告：继承字段未覆盖全部字段，lookup策略下已知网段内的IP仍会逐IP查询API，网段缓存不会减少API查询；"
+                  "使用 --network-cache-policy unknown 在本地应答（结果标记为继承，不会覆盖记录库和SQLite中的完整记录）")
+    if offline_db is not None:
+        print(f"离线网段库: {args.offline_db} ({offline_db.range_count} 个网段，策略: {offline_db.policy})")
+        if not offline_db.answers_locally:
+            print("警告：网段库未包含全部字段，lookup策略下命中网段的IP仍会逐IP查询API，离线网段库不会减少API查询；"
+                  "使用 --offline-db-policy unknown 在本地应答（结果标记为继承，不会覆盖记录库和SQLite中的完整记录）")
+    if len(providers) > 1:
+        print(f"查询后端: {' -> '.join(provider.name for provider in providers)}"
+              f"{'（对冲请求已启用）' if args.hedge else ''}")
+    
+    # 创建自适应限速器
+    rate_limiter = None
+    if args.rate > 0:
+        rate_limiter = AdaptiveRateLimiter(rate=args.rate, max_rate=max(args.rate, args.max_rate))
+    
+    return IPClassifier(api_key or args.api_key, cache=cache, network_cache=network_cache,
+                        api_base_url=args.api_url, timeout=args.timeout,
+                        rate_limiter=rate_limiter, max_retries=max(0, args.retries),
+                        offline_db=offline_db, metrics=metrics, providers=providers,
+                        hedge=args.hedge, hedge_delay=args.hedge_delay, profiler=profiler)
+
+def stage_timer(metrics: Optional[LookupMetrics], name: str, profiler: Optional[StageProfiler] = None):
+    """
+    同时记录指标中的阶段耗时和剖析数据，两者都未启用时返回空的上下文管理器
+    """
+    if profiler is None:
+        return metrics.stage(name) if metrics is not None else contextlib.nullcontext()
+    stack = contextlib.ExitStack()
+    if metrics is not None:
+        stack.enter_context(metrics.stage(name))
+    stack.enter_context(profiler.stage(name))
+    return stack
+
+def export_metrics(metrics: Optional[LookupMetrics], args):
+    """
+    运行结束时导出指标文件
+    :param metrics: 查询指标，未启用时为None
+    :param args: 命令行参数
+    """
+    if metrics is None:
+        return
+    print("阶段耗时: " + "，".join(f"{name} {seconds:.2f}s" for name, seconds in metrics.stages.items()))
+    if args.metrics_file:
+        metrics.write_prometheus(args.metrics_file)
+        print(f"Prometheus指标已写入: {args.metrics_file}")
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+        print(f"指标摘要已写入: {args.metrics_json}")
+
+def compact_store(classifier: IPClassifier, store: RecordStore, output_file: str, lang: str = 'zh'):
+    """
+    压缩记录库并生成排序、翻译后的JSON结果文件
+    """
+    reclaimed = store.compact()
+    print(f"记录库已压缩: 回收 {reclaimed / 1024 / 1024:.1f} MB")
+    export_results(store, output_file, lang)
+    print(f"结果已保存到: {output_file} (由记录库生成，按IP排序，{OUTPUT_LANGUAGE_NOTES[lang]})")
+
+def load_checkpoint(journal_file: str, resume: bool) -> Dict[str, Dict]:
+    """
+    读取上次中断留下的检查点日志
+    :param journal_file: 检查点日志文件路径
+    :param resume: 是否从检查点恢复
+    :return: 已完成查询的IP到结果的映射，不恢复时返回空字典
+    """
+    if not os.path.exists(journal_file):
+        if resume:
+            print(f"未找到检查点日志: {journal_file}，从头开始")
+        return {}
+    if not resume:
+        print(f"警告：发现上次未完成的检查点日志 {journal_file}，本次将从头开始（使用 --resume 可继续上次的进度）")
+        return {}
+    done = CheckpointJournal.replay(journal_file)
+    print(f"从检查点日志恢复了 {len(done)} 个已完成的IP: {journal_file}")
+    return done
+
+def run_stream_mode(classifier: IPClassifier, args, input_file: str, output_file: str,
+                    country_files_dir: str, merge_mode: bool, max_workers: int):
+    """
+    流式模式：惰性读取输入，结果完成后立即写入NDJSON结果文件、失败IP文件和国家文件
+    """
+    if input_file != '-' and not os.path.exists(input_file):
+        print(f"文件未找到: {input_file}")
+        return
+    
+    base_name = os.path.splitext(output_file)[0]
+    ndjson_file = f"{base_name}.ndjson"
+    failed_file = f"{base_name}.failed.txt"
+    country_dir = os.path.join(country_files_dir, 'merged') if merge_mode else country_files_dir
+    
+    print("\n流式模式")
+    print(f"输入文件: {input_file}")
+    print(f"NDJSON输出文件: {ndjson_file}")
+    print(f"国家分类文件目录: {country_dir}")
+    
+    journal_file = f"{base_name}.journal"
+    done = load_checkpoint(journal_file, args.resume)
+    append = merge_mode or bool(done)
+    
+    input_report = InputReport()
+    summary = RecordSummary()
+    failed_sink = FailedIPSink(failed_file)
+    sinks = [
+        NDJSONResultSink(ndjson_file, append=append),
+        CountryFileSink(country_dir, append=append),
+        failed_sink,
+        summary,
+    ]
+    store = None
+    if args.store:
+        store = RecordStore(args.store)
+        sinks.append(store)
+        print(f"记录库目录: {args.store}")
+    if args.sqlite:
+        sinks.append(SQLiteResultSink(args.sqlite))
+        print(f"SQLite数据库: {args.sqlite}")
+    # 检查点日志放在最后：同步日志前先刷新其他输出，日志中的IP保证已经写出
+    other_sinks = list(sinks)
+    journal = CheckpointJournal(journal_file, append=bool(done),
+                                before_flush=lambda: [sink.flush() for sink in other_sinks])
+    sinks.append(journal)
+    
+    extractor = None
+    if args.extract:
+        extractor = LogIPExtractor(count_hits=bool(args.hit_counts))
+        ip_iter = extract_ips(input_file, extractor)
+    else:
+        ip_iter = normalize_ip_lines(iter_ip_list(input_file), input_report, args.max_cidr_size,
+                                     args.hosts_only, args.dedupe_limit)
+    if args.shard:
+        ip_iter = filter_shard(ip_iter, *args.shard)
+    if done:
+        ip_iter = (ip for ip in ip_iter if ip not in done)
+    try:
+        successful_ips, failed_count = classifier.classify_stream(
+            ip_iter, sinks, max_workers, batch_size=args.batch_size,
+            engine=args.engine, concurrency=args.concurrency, window=args.window or None,
+            progress_interval=args.progress_interval)
+    except KeyboardInterrupt:
+        print(f"\n已中断，进度已保存到检查点: {journal_file}")
+        print("使用相同参数并加上 --resume 继续运行")
+        return
+    
+    print()
+    if extractor is not None:
+        extractor.print_summary()
+        if args.hit_counts:
+            extractor.write_hits(args.hit_counts)
+            print(f"命中次数已写入: {args.hit_counts}")
+    else:
+        input_report.print_summary()
+    if done:
+        print(f"从检查点恢复（已跳过）: {len(done)} 个IP")
+    
+    summary.print_summary(args.top)
+    
+    print("\n" + "=" * 50)
+    print("处理统计信息")
+    print("=" * 50)
+    print(f"总IP数量: {successful_ips + failed_count}")
+    print(f"成功查询: {successful_ips}")
+    print(f"查询失败: {failed_count}")
+    print_lookup_stats(classifier)
+    if failed_sink.count:
+        print(f"失败的IP已写入: {failed_file}")
+    if store is not None:
+        print(f"记录库: 新增 {store.stats['added']}，更新 {store.stats['updated']}，"
+              f"未变化 {store.stats['unchanged']}，共 {len(store)} 个IP")
+    print("=" * 50)
+    
+    if store is not None and args.compact:
+        store = RecordStore(args.store)
+        compact_store(classifier, store, output_file, args.lang)
+        store.close()
+    
+    journal.remove()
+    
+    print("\n处理完成！")
+    print(f"NDJSON结果已保存到: {ndjson_file}")
+    if args.sqlite:
+        print(f"SQLite数据库已更新: {args.sqlite}")
+    print(f"国家分类文件已保存到: {country_dir}/（按完成顺序追加，未排序）")
+
+def command_compile_db(argv: List[str]):
+    """
+    compile-db命令：将记录库中的历史查询结果编译为离线网段库
+    :param argv: 命令行参数
+    """
+    parser = argparse.ArgumentParser(prog='iptest.py compile-db', description='将历史查询结果编译为离线网段库')
+    parser.add_argument('--store', default=default_store_dir('iptest_results.json'),
+                        help='记录库目录（默认: iptest_results.store）')
+    parser.add_argument('-o', '--output', default='iptest_ranges.db', help='离线网段库输出文件（默认: iptest_ranges.db）')
+    parser.add_argument('--inherit-fields', default=','.join(DEFAULT_NETWORK_INHERIT),
+                        help=f"写入网段库的字段，逗号分隔（默认: {','.join(DEFAULT_NETWORK_INHERIT)}）")
+    args = parser.parse_args(argv)
+    
+    inherit_fields = [field.strip() for field in args.inherit_fields.split(',') if field.strip()]
+    unknown = set(inherit_fields) - set(NETWORK_INHERITABLE_FIELDS)
+    if unknown:
+        print(f"错误：不支持的字段: {', '.join(sorted(unknown))}")
+        return
+    if not os.path.isdir(args.store):
+        print(f"错误：记录库不存在: {args.store}")
+        return
+    
+    store = RecordStore(args.store)
+    try:
+        print(f"读取记录库: {args.store} ({len(store)} 个IP)")
+        range_count, record_count = OfflineRangeDB.compile(store.iter_records(), args.output, inherit_fields)
+    finally:
+        store.close()
+    print(f"离线网段库已生成: {args.output} ({range_count} 个网段，{record_count} 条去重记录)")
+
+def import_shard_output(path: str, store: RecordStore) -> int:
+    """
+    将一个分片的输出导入记录库
+    :param path: 分片输出：记录库目录、流式模式的NDJSON文件或JSON结果文件
+    :param store: 目标记录库
+    :return: 导入的IP数量
+    """
+    if os.path.isdir(path):
+        shard_store = RecordStore(path)
+        try:
+            for record in shard_store.iter_records():
+                store.put(record, shard_store.index[record['ip']][5])
+            count = len(shard_store)
+        finally:
+            shard_store.close()
+    elif path.endswith('.ndjson'):
+        checked_at = os.path.getmtime(path)
+        count = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    store.put(json.loads(line), checked_at)
+                    count += 1
+    else:
+        count = import_legacy_results(path, store)
+    store.flush()
+    return count
+
+def command_merge(argv: List[str]):
+    """
+    merge命令：将各分片的输出合并为一个结果文件和一组国家分类文件
+    :param argv: 命令行参数
+    """
+    parser = argparse.ArgumentParser(prog='iptest.py merge', description='合并分片运行（--shard）的输出')
+    parser.add_argument('shards', nargs='+',
+                        help='分片输出：记录库目录（*.store）、流式模式的NDJSON文件（*.ndjson）或JSON结果文件')
+    parser.add_argument('-o', '--output', default='iptest_results.json', help='合并后的输出文件名（默认: iptest_results.json）')
+    parser.add_argument('-d', '--country-dir', default='country_files', help='国家分类文件输出目录（默认: country_files）')
+    parser.add_argument('--merge', action='store_true', help='合并模式：国家分类文件与现有文件合并，而不是覆盖')
+    parser.add_argument('--lang', choices=OUTPUT_LANGUAGES, default='zh', help='结果文件语言：zh=中文，en=原始英文（默认: zh）')
+    parser.add_argument('--sqlite', help='同时将合并结果写入带索引的SQLite数据库，可用query命令筛选')
+    args = parser.parse_args(argv)
+    
+    missing = [path for path in args.shards if not os.path.exists(path)]
+    if missing:
+        print(f"错误：分片输出不存在: {', '.join(missing)}")
+        return
+    
+    store = open_result_store(args.output)
+    try:
+        for path in args.shards:
+            count = import_shard_output(path, store)
+            print(f"已导入分片: {path} ({count} 个IP)")
+        print(f"合并后共 {len(store)} 个IP，新增 {store.stats['added']}，更新 {store.stats['updated']}")
+        
+        export_results(store, args.output, args.lang)
+        print(f"结果已保存到: {args.output} (按IP排序，{OUTPUT_LANGUAGE_NOTES[args.lang]})")
+        if args.sqlite:
+            count = export_sqlite(store.iter_records(), args.sqlite)
+            print(f"SQLite数据库已更新: {args.sqlite} ({count} 条记录)")
+        
+        # 国家分类文件只需要IP和国家代码
+        classified_ips = {
+            country: [{'ip': record['ip'], 'location': record.get('location') or {}} for record in records]
+            for country, records in store.iter_grouped()
+        }
+    finally:
+        store.close()
+    IPClassifier().create_country_files(classified_ips, args.country_dir, merge_mode=args.merge)
+
+class StoreRefreshSink:
+    """
+    refresh命令的输出：把重新查询的结果写回记录库，并记录内容发生变化的字段
+    """
+
+    def __init__(self, store: RecordStore, changes_file: Optional[str] = None):
+        """
+        :param store: 记录库（不会被关闭）
+        :param changes_file: 可选的变化明细文件（NDJSON，每行一个变化的字段）
+        """
+        self.store = store
+        self.counts = {'updated': 0, 'unchanged': 0, 'added': 0, 'failed': 0}
+        self.field_counts = defaultdict(int)
+        self.examples = []
+        self.changes_file = open(changes_file, 'w', encoding='utf-8') if changes_file else None
+
+    def add(self, ip: str, record: Dict):
+        old = self.store.get(ip)
+        status = self.store.put(record)
+        self.counts[status] += 1
+        if status != 'updated' or old is None:
+            return
+        changes = diff_records(old, as_plain_record(record))
+        for field, before, after in changes:
+            self.field_counts[field] += 1
+            if self.changes_file is not None:
+                self.changes_file.write(json.dumps({'ip': ip, 'field': field, 'old': before, 'new': after},
+                                                   ensure_ascii=False) + '\n')
+        if changes and len(self.examples) < 100:
+            self.examples.append((ip, changes))
+
+    def fail(self, ip: str, error: Optional[str]):
+        # 查询失败时保留原记录
+        self.counts['failed'] += 1
+
+    def flush(self):
+        self.store.flush()
+        if self.changes_file is not None:
+            self.changes_file.flush()
+
+    def close(self):
+        self.flush()
+        if self.changes_file is not None:
+            self.changes_file.close()
+
+def command_refresh(argv: List[str]):
+    """
+    refresh命令：在查询预算内只重新查询最久未更新或最可能变化的记录，并报告变化
+    :param argv: 命令行参数
+    """
+    parser = argparse.ArgumentParser(prog='iptest.py refresh', description='按查询时间和可变标识增量刷新记录库')
+    parser.add_argument('--store', default=default_store_dir('iptest_results.json'),
+                        help='记录库目录（默认: iptest_results.store）')
+    parser.add_argument('--budget', type=int, default=1000, help='本次最多重新查询的IP数（默认: 1000）')
+    parser.add_argument('--strategy', choices=['oldest', 'volatile', 'mixed'], default='mixed',
+                        help='oldest=最久未查询优先，volatile=只刷新可变记录，mixed=可变记录加权后与其他记录一起排序（默认: mixed）')
+    parser.add_argument('--min-age', type=float, default=24, help='距上次查询不足该小时数的记录不刷新（默认: 24）')
+    parser.add_argument('--volatile-flags', default=','.join(flag[3:] for flag in REFRESH_VOLATILE_FLAGS),
+                        help=f"视为可变记录的标识，逗号分隔（默认: {','.join(flag[3:] for flag in REFRESH_VOLATILE_FLAGS)}）")
+    parser.add_argument('--volatile-weight', type=float, default=4, help='mixed策略中可变记录已过时间的权重（默认: 4）')
+    parser.add_argument('--dry-run', action='store_true', help='只显示将要刷新的记录，不发送查询')
+    parser.add_argument('--changes', help='将变化明细写入该NDJSON文件（每行一个变化的字段）')
+    parser.add_argument('--show', type=int, default=10, help='输出的变化示例数（默认: 10）')
+    parser.add_argument('-o', '--output', help='刷新后由记录库重新生成该JSON结果文件')
+    parser.add_argument('--lang', choices=OUTPUT_LANGUAGES, default='zh', help='JSON结果文件语言（默认: zh）')
+    parser.add_argument('--sqlite', help='同时把刷新后的记录写入该SQLite数据库')
+    parser.add_argument('-t', '--threads', type=int, default=5, help='并发线程数（默认: 5）')
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread', help='查询引擎（默认: thread）')
+    parser.add_argument('--concurrency', type=int, default=200, help='异步引擎最大并发请求数（默认: 200）')
+    parser.add_argument('--batch-size', type=int, default=1, help='每次请求查询的IP数，大于1时使用批量接口（1-100，默认: 1）')
+    parser.add_argument('--progress-interval', type=float, default=0.5, help='进度输出的最小间隔（秒，默认: 0.5）')
+    add_lookup_arguments(parser)
+    args = parser.parse_args(argv)
+    
+    if not os.path.isdir(args.store):
+        print(f"错误：记录库不存在: {args.store}")
+        return
+    if args.cache or args.network_cache or args.offline_db:
+        print("错误：refresh需要重新请求API，不能与 --cache、--network-cache、--offline-db 同时使用")
+        return
+    if not (1 <= args.batch_size <= 100):
+        print("错误：批量大小必须在1-100之间")
+        return
+    if args.engine == 'async' and aiohttp is None:
+        print("错误：异步引擎需要安装aiohttp，请运行 pip install aiohttp")
+        return
+    try:
+        volatile_flags = parse_flag_names(args.volatile_flags)
+    except ValueError as e:
+        print(f"错误：{e}")
+        return
+    
+    store = RecordStore(args.store)
+    try:
+        print(f"记录库: {args.store} ({len(store)} 个IP)")
+        candidates = select_refresh_candidates(store, args.budget, args.strategy, args.min_age * 3600,
+                                               volatile_flags, args.volatile_weight)
+        if not candidates:
+            print(f"没有超过 {args.min_age} 小时未查询的记录，无需刷新")
+            return
+        volatile_count = sum(1 for _, _, volatile in candidates if volatile)
+        oldest = max(age for _, age, _ in candidates)
+        print(f"选择 {len(candidates)} 个IP（策略 {args.strategy}"
+              f"{f'，其中可变记录 {volatile_count} 个' if args.strategy != 'oldest' else ''}），"
+              f"最久 {format_duration(oldest)} 未查询")
+        if args.dry_run:
+            for ip, age, volatile in candidates[:args.show]:
+                print(f"  {ip}: {format_duration(age)} 前查询{'（可变）' if volatile else ''}")
+            if len(candidates) > args.show:
+                print(f"  ... 另有 {len(candidates) - args.show} 个未显示")
+            return
+        
+        classifier = build_classifier(args)
+        if classifier is None:
+            return
+        refresh_sink = StoreRefreshSink(store, args.changes)
+        sinks = [refresh_sink]
+        if args.sqlite:
+            sinks.append(SQLiteResultSink(args.sqlite))
+        try:
+            classifier.classify_stream((ip for ip, _, _ in candidates), sinks, args.threads, args.batch_size,
+                                       engine=args.engine, concurrency=args.concurrency,
+                                       progress_interval=args.progress_interval)
+        except KeyboardInterrupt:
+            print("\n已中断，已完成的IP已写回记录库")
+        finally:
+            classifier.close()
+        
+        counts = refresh_sink.counts
+        print("\n" + "=" * 50)
+        print("刷新统计信息")
+        print("=" * 50)
+        print(f"重新查询: {sum(counts.values())}")
+        print(f"内容变化: {counts['updated']}")
+        print(f"未变化: {counts['unchanged']}")
+        print(f"查询失败（保留原记录）: {counts['failed']}")
+        if refresh_sink.field_counts:
+            ranked = sorted(refresh_sink.field_counts.items(), key=lambda item: (-item[1], item[0]))
+            print("变化的字段: " + "，".join(f"{field} {count}" for field, count in ranked))
+        for ip, changes in refresh_sink.examples[:args.show]:
+            print(f"  {ip}: " + "；".join(f"{field} {before!r} -> {after!r}" for field, before, after in changes))
+        print_lookup_stats(classifier)
+        if args.changes:
+            print(f"变化明细已写入: {args.changes}")
+        print("=" * 50)
+        
+        if args.output:
+            export_results(store, args.output, args.lang)
+            print(f"结果已保存到: {args.output} (由记录库生成，按IP排序，{OUTPUT_LANGUAGE_NOTES[args.lang]})")
+    finally:
+        store.close()
+
+def parse_flag_names(value: str) -> List[str]:
+    """
+    解析逗号分隔的标识名，vpn与is_vpn等价
+    :param value: 如 "vpn,proxy"
+    :return: 标识字段名列表
+    """
+    flags = []
+    for name in value.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        flag = name if name.startswith('is_') else f"is_{name}"
+        if flag not in FLAG_FIELDS:
+            raise ValueError(f"未知的标识: {name}（可选: {', '.join(flag[3:] for flag in FLAG_FIELDS)}）")
+        flags.append(flag)
+    return flags
+
+def command_query(argv: List[str]):
+    """
+    query命令：按IP网段、国家、ASN、公司类型和is_*标识筛选SQLite数据库中的结果
+    :param argv: 命令行参数
+    """
+    parser = argparse.ArgumentParser(prog='iptest.py query', description='筛选SQLite数据库（--sqlite生成）中的查询结果')
+    parser.add_argument('database', help='SQLite数据库文件')
+    parser.add_argument('--cidr', action='append', default=[], help='只保留落在该网段内的IP，可重复指定（任一网段）')
+    parser.add_argument('--ip', action='append', default=[], help='指定IP，可重复指定')
+    parser.add_argument('--country', help='国家代码，逗号分隔，如 HK,MO')
+    parser.add_argument('--asn', help='ASN，逗号分隔，如 13335,4134')
+    parser.add_argument('--company-type', help='公司类型，逗号分隔，如 hosting,isp')
+    parser.add_argument('--flags', help='标识，逗号分隔，如 vpn,proxy；默认满足任一即可')
+    parser.add_argument('--all-flags', action='store_true', help='要求满足--flags中的全部标识')
+    parser.add_argument('--limit', type=int, default=0, help='最多输出的条数（默认: 0，不限制）')
+    parser.add_argument('--count', action='store_true', help='只输出匹配的条数')
+    parser.add_argument('--format', choices=['table', 'ips', 'json', 'ndjson'], default='table',
+                        help='输出格式：table=摘要表格，ips=每行一个IP，json/ndjson=完整记录（默认: table）')
+    parser.add_argument('--lang', choices=OUTPUT_LANGUAGES, default='en', help='json/ndjson输出的语言（默认: en）')
+    parser.add_argument('--explain', action='store_true', help='输出SQLite查询计划，检查是否使用了索引')
+    args = parser.parse_args(argv)
+    
+    if not os.path.exists(args.database):
+        print(f"错误：数据库不存在: {args.database}")
+        return
+    
+    clauses = []
+    params = []
+    
+    def add_in(column: str, values: list):
+        clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+        params.extend(values)
+    
+    try:
+        ranges = []
+        for cidr in args.cidr:
+            network = ipaddress.ip_network(cidr.strip(), strict=False)
+            ranges.append((network.version, int(network.network_address).to_bytes(16, 'big'),
+                           int(network.broadcast_address).to_bytes(16, 'big')))
+        for ip in args.ip:
+            version, ip_bin = ip_to_blob(ip.strip())
+            ranges.append((version, ip_bin, ip_bin))
+        if ranges:
+            clauses.append('(' + ' OR '.join('(version = ? AND ip_bin BETWEEN ? AND ?)' for _ in ranges) + ')')
+            for version, first, last in ranges:
+                params.extend((version, first, last))
+        if args.country:
+            add_in('country_code', [code.strip().upper() for code in args.country.split(',') if code.strip()])
+        if args.asn:
+            add_in('asn', [int(asn.strip().upper().removeprefix('AS')) for asn in args.asn.split(',') if asn.strip()])
+        if args.company_type:
+            add_in('company_type', [kind.strip() for kind in args.company_type.split(',') if kind.strip()])
+        flags = parse_flag_names(args.flags) if args.flags else []
+    except ValueError as e:
+        print(f"错误：{e}")
+        return
+    if flags:
+        # 继承自网段的部分结果中标识取值未知（NULL），不会被标识条件匹配，单独统计后提示
+        unknown_where = ' WHERE ' + ' AND '.join(clauses + ['(' + ' OR '.join(f"{flag} IS NULL" for flag in flags) + ')'])
+        # 写成 is_vpn = 1 的形式，才能使用只包含为真行的部分索引
+        joiner = ' AND ' if args.all_flags else ' OR '
+        clauses.append('(' + joiner.join(f"{flag} = 1" for flag in flags) + ')')
+    else:
+        unknown_where = ''
+    
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+    if args.count:
+        sql = f"SELECT COUNT(*) FROM results{where}"
+    else:
+        columns = 'data' if args.format in ('json', 'ndjson') else \
+            f"ip, country_code, asn, company_type, {', '.join(SQLITE_FLAG_COLUMNS)}"
+        sql = f"SELECT {columns} FROM results{where} ORDER BY version, ip_bin"
+        if args.limit > 0:
+            sql += f" LIMIT {args.limit}"
+    
+    conn = sqlite3.connect(f"file:{args.database}?mode=ro", uri=True)
+    try:
+        if args.explain:
+            for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+                print(f"查询计划: {row[-1]}")
+        start = time.perf_counter()
+        cursor = conn.execute(sql, params)
+        if args.count:
+            print(cursor.fetchone()[0])
+            report_unknown_flags(conn, unknown_where, params, flags)
+            return
+        matched = 0
+        if args.format == 'ips':
+            for row in cursor:
+                print(row[0])
+                matched += 1
+        elif args.format in ('json', 'ndjson'):
+            translator = get_translator(args.lang)
+            if args.format == 'json':
+                sys.stdout.write('[')
+            for row in cursor:
+                record = json.dumps(translator.record(json.loads(row[0])), ensure_ascii=False)
+                if args.format == 'json':
+                    sys.stdout.write((',\n  ' if matched else '\n  ') + record)
+                else:
+                    print(record)
+                matched += 1
+            if args.format == 'json':
+                print('\n]' if matched else ']')
+        else:
+            print(f"{'IP地址':<40} {'国家':<4} {'ASN':<10} {'公司类型':<12} 标识")
+            for row in cursor:
+                flag_names = [flag[3:] for flag, value in zip(SQLITE_FLAG_COLUMNS, row[4:]) if value]
+                print(f"{row[0]:<40} {row[1] or '-':<4} {row[2] or '-':<10} {row[3] or '-':<12} {','.join(flag_names) or '-'}")
+                matched += 1
+            print(f"共 {matched} 条，用时 {(time.perf_counter() - start) * 1000:.1f} ms")
+        report_unknown_flags(conn, unknown_where, params, flags)
+    finally:
+        conn.close()
+
+def report_unknown_flags(conn, where: str, params: list, flags: List[str]):
+    """
+    按标识筛选时，提示满足其余条件、但这些标识取值未知的记录数（输出到标准错误，不影响ips/json输出）
+    :param conn: SQLite连接
+    :param where: 其余条件加上"任一标识为NULL"的WHERE子句
+    :param params: 其余条件的参数
+    :param flags: 筛选的标识列
+    """
+    if not flags:
+        return
+    unknown = conn.execute(f"SELECT COUNT(*) FROM results{where}", params).fetchone()[0]
+    if unknown:
+        print(f"注意：另有 {unknown} 条记录的 {','.join(flag[3:] for flag in flags)} 标识未知"
+              f"（继承自网段的部分结果），未包含在结果中", file=sys.stderr)
+
+def normalize_ip(value) -> Optional[str]:
+    """
+    规范化单个IP地址
+    :param value: 请求中的IP地址
+    :return: 规范化后的IP地址，无效时返回None
+    """
+    if not isinstance(value, str):
+        return None
+    try:
+        return str(ipaddress.ip_address(value.strip()))
+    except ValueError:
+        return None
+
+class _Flight:
+    """
+    一次进行中的上游查询，相同IP（或同一网段）的并发请求等待它完成，而不是重复查询
+    """
+    __slots__ = ('key', 'ip', 'record', 'done')
+
+    def __init__(self, key, ip: str):
+        self.key = key
+        self.ip = ip
+        self.record = None
+        self.done = threading.Event()
+
+class LookupServer:
+    """
+    常驻查询服务：分类器、HTTP连接池和各级缓存在进程内常驻，通过本地HTTP/JSON接口应答查询；
+    应答保存在有界LRU缓存中，相同IP的并发请求合并为一次上游查询，
+    启用网段缓存时同一网段（IPv4 /24、IPv6 /48）的并发请求也先等待第一个查询完成
+    """
+
+    def __init__(self, classifier: IPClassifier, lru_size: int = 100000, lru_ttl: float = 3600,
+                 batch_size: int = 1, max_workers: int = 20):
+        """
+        初始化查询服务
+        :param classifier: IP分类器
+        :param lru_size: LRU缓存最多保留的应答数
+        :param lru_ttl: 应答有效期（秒），小于等于0表示永不过期
+        :param batch_size: 上游批量查询的IP数，大于1时使用批量接口
+        :param max_workers: 同时进行的上游查询数
+        """
+        self.classifier = classifier
+        self.lru_size = lru_size
+        self.lru_ttl = lru_ttl
+        self.batch_size = batch_size
+        self.coalesce_network = classifier.network_cache is not None and classifier.network_cache.answers_locally
+        self.lock = threading.Lock()
+        self.answers = OrderedDict()  # ip -> (应答时间戳, 查询结果)
+        self.inflight = {}  # 合并键 -> _Flight
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.started_at = time.time()
+        self.stats = {'requests': 0, 'lru_hits': 0, 'coalesced': 0, 'lookups': 0, 'failed': 0}
+
+    def _cached(self, ip: str) -> Optional[Dict]:
+        """
+        查询LRU缓存（调用方需持有锁）
+        """
+        entry = self.answers.get(ip)
+        if entry is None:
+            return None
+        if self.lru_ttl > 0 and time.time() - entry[0] > self.lru_ttl:
+            del self.answers[ip]
+            return None
+        self.answers.move_to_end(ip)
+        return entry[1]
+
+    def _remember(self, ip: str, record: Dict):
+        """
+        写入LRU缓存，超出容量时淘汰最久未使用的应答（调用方需持有锁）
+        """
+        self.answers[ip] = (time.time(), record)
+        self.answers.move_to_end(ip)
+        while len(self.answers) > self.lru_size:
+            self.answers.popitem(last=False)
+
+    def lookup(self, ip: str) -> Optional[Dict]:
+        """
+        查询单个IP
+        :param ip: 规范化后的IP地址
+        :return: 查询结果，失败返回None
+        """
+        return self.lookup_many([ip])[ip]
+
+    def lookup_many(self, ips: List[str], by_network: Optional[bool] = None) -> Dict[str, Optional[Dict]]:
+        """
+        批量查询：先查LRU缓存，其余IP若已有进行中的查询则等待其结果，否则由本次请求发起上游查询
+        :param ips: 规范化后的IP地址列表
+        :param by_network: 是否按网段合并，默认启用网段缓存时按网段合并
+        :return: IP到查询结果的映射，查询失败的IP对应None
+        """
+        first_pass = by_network is None
+        if first_pass:
+            by_network = self.coalesce_network
+        results = {}
+        own = []
+        waiting = []
+        with self.lock:
+            for ip in dict.fromkeys(ips):
+                if first_pass:
+                    self.stats['requests'] += 1
+                record = self._cached(ip)
+                if record is not None:
+                    self.stats['lru_hits'] += 1
+                    results[ip] = record
+                    continue
+                key = network_key(ip) if by_network else ip
+                flight = self.inflight.get(key)
+                if flight is None:
+                    flight = self.inflight[key] = _Flight(key, ip)
+                    own.append(flight)
+                else:
+                    self.stats['coalesced'] += 1
+                    waiting.append((ip, flight))
+        
+        if own:
+            self._resolve(own)
+            for flight in own:
+                results[flight.ip] = flight.record
+        
+        # 先完成自己发起的查询再等待别人的，同一批中落在同一网段的IP不会互相等待
+        followers = []
+        for ip, flight in waiting:
+            flight.done.wait()
+            if flight.ip == ip:
+                results[ip] = flight.record
+            else:
+                followers.append(ip)
+        if followers:
+            # 同一网段的查询已完成，网段缓存通常可以直接应答，只需按IP合并
+            results.update(self.lookup_many(followers, by_network=False))
+        return results
+
+    def _resolve(self, flights: List[_Flight]):
+        """
+        为本次请求发起的查询请求上游，完成后唤醒等待中的请求
+        :param flights: 进行中的查询
+        """
+        ips = [flight.ip for flight in flights]
+        found = {}
+        try:
+            if len(ips) == 1:
+                found[ips[0]] = self.classifier.get_ip_location(ips[0])
+            elif self.batch_size > 1:
+                futures = [self.executor.submit(self.classifier.get_ip_locations_batch, chunk)
+                           for chunk in iter_chunks(ips, self.batch_size)]
+                for future in futures:
+                    found.update(future.result())
+            else:
+                found.update(zip(ips, self.executor.map(self.classifier.get_ip_location, ips)))
+        finally:
+            with self.lock:
+                for flight in flights:
+                    flight.record = found.get(flight.ip)
+                    self.stats['lookups'] += 1
+                    if flight.record is not None:
+                        self._remember(flight.ip, flight.record)
+                    else:
+                        self.stats['failed'] += 1
+                    del self.inflight[flight.key]
+                    flight.done.set()
+
+    def status(self) -> Dict:
+        """
+        服务状态和统计信息
+        """
+        with self.lock:
+            return {
+                'status': 'ok',
+                'uptime_s': round(time.time() - self.started_at, 1),
+                'lru_entries': len(self.answers),
+                'inflight': len(self.inflight),
+                **self.stats,
+            }
+
+    def make_handler(self, max_batch: int = 1000, default_lang: str = 'en'):
+        """
+        创建HTTP请求处理类
+        :param max_batch: 单次批量请求最多包含的IP数
+        :param default_lang: 未指定lang参数时的应答语言
+        :return: BaseHTTPRequestHandler子类
+        """
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # 保持长连接，调用方不必每次重新建立连接
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status: int, payload, content_type: str = 'application/json; charset=utf-8'):
+                body = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def translator(self, params: Dict):
+                lang = params.get('lang', [default_lang])[0]
+                if lang not in OUTPUT_LANGUAGES:
+                    self.send_json(400, {'error': f"不支持的语言: {lang}，可选: {', '.join(OUTPUT_LANGUAGES)}"})
+                    return None
+                return get_translator(lang)
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                params = parse_qs(query)
+                if path == '/health':
+                    self.send_json(200, service.status())
+                    return
+                if path == '/metrics' and service.classifier.metrics is not None:
+                    self.send_json(200, service.classifier.metrics.render_prometheus().encode('utf-8'),
+                                   'text/plain; version=0.0.4; charset=utf-8')
+                    return
+                if path.startswith('/lookup/'):
+                    value = unquote(path[len('/lookup/'):])
+                elif path == '/lookup' and 'ip' in params:
+                    value = params['ip'][0]
+                else:
+                    self.send_json(404, {'error': '未知路径，可用: GET /lookup/<ip>、POST /lookup、GET /health'})
+                    return
+                translator = self.translator(params)
+                if translator is None:
+                    return
+                ip = normalize_ip(value)
+                if ip is None:
+                    self.send_json(400, {'error': f"无效的IP地址: {value}"})
+                    return
+                record = service.lookup(ip)
+                if record is None:
+                    self.send_json(502, {'error': '查询失败', 'ip': ip})
+                    return
+                self.send_json(200, translator.record(record))
+
+            def do_POST(self):
+                path, _, query = self.path.partition('?')
+                if path != '/lookup':
+                    self.send_json(404, {'error': '未知路径，批量查询请使用 POST /lookup'})
+                    return
+                translator = self.translator(parse_qs(query))
+                if translator is None:
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    body = json.loads(self.rfile.read(length) or b'null')
+                except ValueError:
+                    self.send_json(400, {'error': '请求体不是有效的JSON'})
+                    return
+                values = body.get('ips') if isinstance(body, dict) else body
+                if not isinstance(values, list):
+                    self.send_json(400, {'error': '请求体应为IP列表或 {"ips": [...]}'})
+                    return
+                if len(values) > max_batch:
+                    self.send_json(413, {'error': f"单次最多查询 {max_batch} 个IP"})
+                    return
+                ips = []
+                invalid = []
+                for value in values:
+                    ip = normalize_ip(value)
+                    if ip is None:
+                        invalid.append(value)
+                    else:
+                        ips.append(ip)
+                found = service.lookup_many(ips)
+                self.send_json(200, {
+                    'results': {ip: translator.record(record) if record is not None else None
+                                for ip, record in found.items()},
+                    'failed': [ip for ip, record in found.items() if record is None],
+                    'invalid': invalid,
+                })
+
+        return Handler
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+def command_serve(argv: List[str]):
+    """
+    serve命令：常驻查询服务，通过本地HTTP/JSON接口应答单个和批量查询
+    :param argv: 命令行参数
+    """
+    parser = argparse.ArgumentParser(prog='iptest.py serve', description='常驻查询服务：通过本地HTTP/JSON接口应答IP查询')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址（默认: 127.0.0.1）')
+    parser.add_argument('--port', type=int, default=8080, help='监听端口（默认: 8080）')
+    parser.add_argument('--lru-size', type=int, default=100000, help='内存LRU缓存最多保留的应答数（默认: 100000）')
+    parser.add_argument('--lru-ttl', type=float, default=1, help='LRU缓存中应答的有效期（小时，默认: 1，0表示永不过期）')
+    parser.add_argument('-t', '--threads', type=int, default=20, help='同时进行的上游查询数（默认: 20）')
+    parser.add_argument('--batch-size', type=int, default=1, help='批量请求中上游每次查询的IP数，大于1时使用批量接口（1-100，默认: 1）')
+    parser.add_argument('--max-batch', type=int, default=1000, help='单次批量请求最多包含的IP数（默认: 1000）')
+    parser.add_argument('--lang', choices=OUTPUT_LANGUAGES, default='en', help='默认应答语言，可用 ?lang= 覆盖（默认: en）')
+    add_lookup_arguments(parser)
+    args = parser.parse_args(argv)
+    
+    if not (1 <= args.batch_size <= 100):
+        print("错误：批量大小必须在1-100之间")
+        return
+    if args.threads < 1 or args.lru_size < 1 or args.max_batch < 1:
+        print("错误：线程数、LRU缓存大小和批量上限必须大于0")
+        return
+    
+    classifier = build_classifier(args, metrics=LookupMetrics())
+    if classifier is None:
+        return
+    service = LookupServer(classifier, args.lru_size, args.lru_ttl * 3600, args.batch_size, args.threads)
+    try:
+        server = ThreadingHTTPServer((args.host, args.port), service.make_handler(args.max_batch, args.lang))
+    except OSError as e:
+        print(f"错误：无法监听 {args.host}:{args.port}: {e}")
+        return
+    server.daemon_threads = True
+    
+    print(f"查询服务已启动: http://{args.host}:{args.port}")
+    print("  GET  /lookup/<ip>             查询单个IP")
+    print('  POST /lookup  {"ips": [...]}  批量查询')
+    print("  GET  /health                  服务状态")
+    print("  GET  /metrics                 Prometheus指标")
+    print("按 Ctrl+C 停止")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n正在停止...")
+    finally:
+        server.server_close()
+        service.close()
+        classifier.close()
+        if classifier.cache is not None:
+            classifier.cache.close()
+    status = service.status()
+    print(f"服务已停止：共 {status['requests']} 次查询，LRU命中 {status['lru_hits']}，"
+          f"合并 {status['coalesced']}，上游查询 {status['lookups']}，失败 {status['failed']}")
+
+# 子命令：python iptest.py <命令> [参数]
+COMMANDS = {
+    'compile-db': command_compile_db,
+    'merge': command_merge,
+    'serve': command_serve,
+    'query': command_query,
+    'refresh': command_refresh,
+}
+
+def main():
+    """
+    主函数
+    """
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+    
+    parser = argparse.ArgumentParser(description='IP地区分类工具 - 使用ipapi.is API服务')
+    parser.add_argument('input_file', nargs='?', default='ips.txt', help='包含IP地址的文件路径，支持 .gz/.zst 压缩文件，- 表示标准输入（默认: ips.txt）')
+    parser.add_argument('-o', '--output', default='iptest_results.json', help='输出文件名（默认: iptest_results.json）')
+    parser.add_argument('-d', '--country-dir', default='country_files', help='国家分类文件输出目录（默认: country_files）')
+    parser.add_argument('-t', '--threads', type=int, default=5, help='并发线程数（1-20，默认: 5）')
+    parser.add_argument('--extract', action='store_true', help='日志提取模式：从任意文本（nginx、防火墙日志等）中扫描出IPv4/IPv6地址并去重，而不是逐行读取IP')
+    parser.add_argument('--hit-counts', help='与--extract配合：将每个IP在日志中的出现次数写入该文件（制表符分隔，按次数降序）')
+    parser.add_argument('--merge', action='store_true', help='合并模式：将新IP合并到现有文件中，而不是覆盖')
+    parser.add_argument('--no-interactive', action='store_true', help='非交互模式，使用默认值')
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread', help='查询引擎：thread=线程池，async=asyncio异步（需要aiohttp，默认: thread）')
+    parser.add_argument('--concurrency', type=int, default=200, help='异步引擎最大并发请求数（默认: 200）')
+    parser.add_argument('--max-cidr-size', type=int, default=65536, help='输入中CIDR网段允许展开的最大地址数（默认: 65536）')
+    parser.add_argument('--hosts-only', action='store_true', help='展开CIDR网段时只保留主机地址，去掉IPv4网络地址、广播地址和IPv6子网路由器任播地址（默认展开全部地址）')
+    parser.add_argument('--dedupe-limit', type=int, default=2000000, help='流式模式下输入去重集合的最大条目数，达到上限后轮换，内存占用不超过两倍；0表示不限制（默认: 2000000）')
+    parser.add_argument('--store', help='记录库目录：结果以追加方式增量写入，只写入新增或变化的记录')
+    parser.add_argument('--no-export', action='store_true', help='只把本批结果增量写入记录库，不由记录库重新生成JSON结果文件（耗时只与本批数量相关）')
+    parser.add_argument('--compact', action='store_true', help='压缩记录库（--store指定的或与输出文件同名的记录库）并生成排序、翻译后的JSON结果文件')
+    parser.add_argument('--sqlite', help='同时将结果写入带索引的SQLite数据库（已存在时增量更新），可用query命令筛选')
+    parser.add_argument('--shard', help='分片模式 i/N（i从0开始）：只处理输入中属于第i个分片的IP，输出文件名自动加上分片后缀，之后用merge命令合并')
+    parser.add_argument('--resume', action='store_true', help='从上次中断留下的检查点日志（<输出文件名>.journal）继续运行，跳过已完成的IP')
+    parser.add_argument('--stream', action='store_true', help='流式模式：逐行读取输入，结果完成即写出，内存占用与输入规模无关')
+    parser.add_argument('--window', type=int, default=0, help='流式模式下同时进行中的最大任务数（默认: 线程数的4倍）')
+    parser.add_argument('--batch-size', type=int, default=1, help='每次请求查询的IP数，大于1时使用批量接口（1-100，默认: 1）')
+    parser.add_argument('--sample', type=int, default=0, help='抽样模式：按网段（IPv4 /16、IPv6 /48）分层，每层最多查询该数量的IP，估计国家和ASN分布（默认: 0，不抽样）')
+    parser.add_argument('--sample-seed', type=int, default=0, help='抽样随机种子，相同输入和种子抽取的样本相同（默认: 0）')
+    parser.add_argument('--sample-min-agree', type=int, default=2,
+                        help='抽样模式下层内其余IP继承国家所需的最少一致样本数（默认: 2）')
+    parser.add_argument('--confidence', type=float, default=0.95, help='抽样估计的置信水平（默认: 0.95）')
+    parser.add_argument('--lang', choices=OUTPUT_LANGUAGES, default='zh', help='JSON结果文件语言：zh=字段名和取值翻译成中文，en=原始英文（默认: zh）')
+    parser.add_argument('--progress-interval', type=float, default=0.5, help='进度输出的最小间隔（秒，默认: 0.5，0表示每个IP输出一行）')
+    parser.add_argument('--top', type=int, default=10, help='摘要中ASN排行显示的条目数（默认: 10）')
+    parser.add_argument('--detail-report', help='将逐IP的完整检测信息写入该文件（默认不输出）')
+    parser.add_argument('--metrics-file', help='运行结束时将指标写入Prometheus文本文件（可供node_exporter textfile collector读取）')
+    parser.add_argument('--metrics-json', help='运行结束时将指标摘要写入JSON文件')
+    parser.add_argument('--metrics-port', type=int, help='运行期间在该端口提供Prometheus /metrics 端点')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='/metrics 端点的监听地址（默认: 127.0.0.1，只允许本机访问；0.0.0.0表示所有网卡）')
+    parser.add_argument('--profile', action='store_true', help='剖析各阶段的墙钟时间、CPU时间和内存峰值（tracemalloc），结束时输出耗时分解表')
+    parser.add_argument('--profile-dump', help='与--profile配合：将每个阶段的cProfile数据保存到该目录（<阶段名>.prof）')
+    add_lookup_arguments(parser)
+    
+    args = parser.parse_args()
+    
+    # 验证线程数参数
+    if not (1 <= args.threads <= 20):
+        print("错误：线程数必须在1-20之间")
+        return
+    
+    if not (1 <= args.batch_size <= 100):
+        print("错误：批量大小必须在1-100之间")
+        return
+    
+    if args.concurrency < 1:
+        print("错误：并发请求数必须大于0")
+        return
+    
+    if args.engine == 'async' and aiohttp is None:
+        print("错误：异步引擎需要安装aiohttp，请运行 pip install aiohttp")
+        return
+    
+    if args.sample < 0:
+        print("错误：每层抽样数不能为负数")
+        return
+    
+    if args.sample_min_agree < 1:
+        print("错误：最少一致样本数必须大于0")
+        return
+    
+    if args.sample and (args.stream or args.resume):
+        print("错误：抽样模式不能与 --stream 或 --resume 同时使用")
+        return
+    
+    if not (0 < args.confidence < 1):
+        print("错误：置信水平必须在0到1之间")
+        return
+    
+    if args.profile_dump and not args.profile:
+        print("错误：--profile-dump 需要与 --profile 一起使用")
+        return
+    
+    if args.hit_counts and not args.extract:
+        print("错误：--hit-counts 需要与 --extract 一起使用")
+        return
+    
+    if args.shard:
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as e:
+            print(f"错误：{e}")
+            return
+    
+    print("IP地区分类工具")
+    print("使用ipapi.is API服务\n")
+    
+    # 检查是否使用交互模式
+    if not args.no_interactive and len(sys.argv) == 1:
+        # 没有命令行参数，使用交互模式
+        input_file, output_file, api_key, country_files_dir, merge_mode, max_workers = interactive_mode()
+        # 交互模式下用户指定了输出文件，总是生成JSON结果文件
+        export_json = True
+    else:
+        # 使用命令行参数
+        input_file = args.input_file
+        output_file = args.output
+        api_key = args.api_key
+        country_files_dir = args.country_dir
+        max_workers = args.threads
+        merge_mode = args.merge
+        export_json = not args.no_export
+    
+    if args.shard:
+        # 每个分片写入独立的输出，避免多个进程互相覆盖
+        output_file = shard_path(output_file, *args.shard)
+        country_files_dir = shard_path(country_files_dir, *args.shard)
+        print(f"分片模式: 第 {args.shard[0]} 片，共 {args.shard[1]} 片")
+    
+    # 创建查询指标
+    metrics = None
+    if args.metrics_file or args.metrics_json or args.metrics_port:
+        metrics = LookupMetrics()
+    
+    # 创建剖析器：在加载输入之前开始跟踪内存
+    profiler = StageProfiler(args.profile_dump) if args.profile else None
+    
+    # 创建分类器实例
+    classifier = build_classifier(args, api_key, metrics, profiler)
+    if classifier is None:
+        return
+    cache = classifier.cache
+    if metrics is not None and args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_host)
+        print(f"指标端点: http://{args.metrics_host}:{args.metrics_port}/metrics")
+    
+    if args.stream:
+        with stage_timer(metrics, 'classify', profiler):
+            run_stream_mode(classifier, args, input_file, output_file, country_files_dir, merge_mode, max_workers)
+        classifier.close()
+        if cache is not None:
+            cache.close()
+        export_metrics(metrics, args)
+        if profiler is not None:
+            profiler.print_report()
+            profiler.close()
+        return
+    
+    # 加载IP列表
+    input_report = InputReport()
+    with stage_timer(metrics, 'load', profiler):
+        if args.extract:
+            extractor = LogIPExtractor(count_hits=bool(args.hit_counts))
+            ip_list = load_log_ips(input_file, extractor)
+        else:
+            ip_list = load_ip_list(input_file, input_report, args.max_cidr_size, args.hosts_only)
+    if args.extract:
+        extractor.print_summary()
+        if args.hit_counts:
+            extractor.write_hits(args.hit_counts)
+            print(f"命中次数已写入: {args.hit_counts}")
+    elif input_report.total_lines:
+        input_report.print_summary()
+    if args.shard:
+        ip_list = list(filter_shard(ip_list, *args.shard))
+        print(f"本分片IP数: {len(ip_list)}")
+    if not ip_list:
+        print(f"未找到有效的IP地址，程序退出。")
+        return
+    
+    print(f"\n加载了 {len(ip_list)} 个IP地址")
+    print(f"输入文件: {input_file}")
+    print(f"JSON输出文件: {output_file}")
+    print(f"国家分类文件目录: {country_files_dir}")
+    
+    # 检查点日志：每完成一个IP就记录，中断后可用--resume继续
+    base_name = os.path.splitext(output_file)[0]
+    journal_file = f"{base_name}.journal"
+    failed_file = f"{base_name}.failed.txt"
+    total_ips = len(ip_list)
+    done = load_checkpoint(journal_file, args.resume)
+    if done:
+        # 只恢复本次输入中的IP
+        input_ips = set(ip_list)
+        done = {ip: record for ip, record in done.items() if ip in input_ips}
+        ip_list = [ip for ip in ip_list if ip not in done]
+    journal = CheckpointJournal(journal_file, append=bool(done))
+    failed_sink = FailedIPSink(failed_file)
+    sinks = [journal, failed_sink]
+    
+    # 进行分类
+    sampler = None
+    try:
+        with stage_timer(metrics, 'classify', profiler):
+            if args.sample:
+                classified_ips, failed_ips, sampler = classifier.classify_ips_sampled(
+                    ip_list, args.sample, max_workers, batch_size=args.batch_size, sinks=sinks,
+                    progress_interval=args.progress_interval, engine=args.engine,
+                    concurrency=args.concurrency, seed=args.sample_seed, confidence=args.confidence,
+                    min_agree=args.sample_min_agree)
+                total_ips = len(sampler.sample_ips())
+            elif args.engine == 'async':
+                classified_ips, failed_ips = classifier.classify_ips_by_country_async(
+                    ip_list, args.concurrency, batch_size=args.batch_size, sinks=sinks,
+                    progress_interval=args.progress_interval)
+            else:
+                classified_ips, failed_ips = classifier.classify_ips_by_country(
+                    ip_list, max_workers, batch_size=args.batch_size, sinks=sinks,
+                    progress_interval=args.progress_interval)
+    except KeyboardInterrupt:
+        print(f"\n已中断，进度已保存到检查点: {journal_file}")
+        print("使用相同参数并加上 --resume 继续运行")
+        classifier.close()
+        if cache is not None:
+            cache.close()
+        return
+    finally:
+        journal.close()
+        failed_sink.close()
+    
+    # 合并从检查点恢复的结果
+    for record in done.values():
+        classified_ips.setdefault(record_country_name(record), []).append(CompactRecord.from_dict(record))
+    
+    # 打印摘要
+    with stage_timer(metrics, 'summary', profiler):
+        if sampler is not None:
+            sampler.print_summary(args.top)
+            if args.detail_report:
+                classifier.write_detail_report(classified_ips, args.detail_report)
+                print(f"\n逐IP详细报告已写入: {args.detail_report}")
+        else:
+            classifier.print_summary(classified_ips, args.detail_report, args.top)
+    
+    # 输出统计信息
+    successful_ips = total_ips - len(failed_ips)
+    failed_count = len(failed_ips)
+    
+    print("\n" + "=" * 50)
+    print("处理统计信息")
+    print("=" * 50)
+    if sampler is not None:
+        print("抽样模式：以下为样本IP的查询统计")
+    print(f"总IP数量: {total_ips}")
+    print(f"成功查询: {successful_ips}")
+    print(f"查询失败: {failed_count}")
+    
+    print_lookup_stats(classifier)
+    
+    if failed_count > 0:
+        print("\n失败的IP地址:")
+        for i, failed_ip in enumerate(failed_ips[:20], 1):
+            print(f"  {i}. {failed_ip}")
+        if failed_count > 20:
+            print(f"  ... 另有 {failed_count - 20} 个未显示")
+        print(f"失败的IP已写入: {failed_file}（可作为输入文件重新查询）")
+    
+    print("=" * 50)
+    
+    # 保存结果
+    with stage_timer(metrics, 'save', profiler):
+        if args.store:
+            store = RecordStore(args.store)
+            classifier.save_results_to_store(classified_ips, store)
+            if args.compact:
+                compact_store(classifier, store, output_file, args.lang)
+            store.close()
+        else:
+            classifier.save_results(classified_ips, output_file, args.lang, export=export_json, compact=args.compact)
+        if args.sqlite:
+            count = export_sqlite((record for records in classified_ips.values() for record in records), args.sqlite)
+            print(f"SQLite数据库已更新: {args.sqlite} ({count} 条记录)")
+    
+    # 创建按国家/地区分类的txt文件
+    with stage_timer(metrics, 'country_files', profiler):
+        code_groups = None
+        if sampler is not None:
+            # 抽样模式：查询过的样本写入<国家代码>.txt，按层继承国家的IP写入<国家代码>.inherited.txt，
+            # 其余未查询的IP写入单独的文件，可作为输入再完整查询
+            code_groups, inherited_groups, unresolved = sampler.assign_countries(ip_list)
+            for code, ips in inherited_groups.items():
+                code_groups[f"{code}.inherited"] = ips
+            inherited_count = sum(len(ips) for ips in inherited_groups.values())
+            print(f"\n按层继承国家的IP（未查询）: {inherited_count} 个，写入 <国家代码>.inherited.txt")
+            unresolved_file = f"{base_name}.unresolved.txt"
+            write_ip_file(unresolved_file, unresolved)
+            print(f"未能确定国家的IP: {len(unresolved)} 个，已写入: {unresolved_file}")
+        if merge_mode:
+            print("\n使用合并模式创建国家分类文件...")
+            classifier.create_country_files(classified_ips, country_files_dir, merge_mode=True, code_groups=code_groups)
+            print(f"合并后的国家分类文件已保存到: {country_files_dir}/merged/")
+        else:
+            print("\n使用覆盖模式创建国家分类文件...")
+            classifier.create_country_files(classified_ips, country_files_dir, merge_mode=False, code_groups=code_groups)
+            print(f"国家分类文件已保存到: {country_files_dir}/")
+    
+    # 结果已全部写出，检查点日志不再需要
+    journal.remove()
+    
+    classifier.close()
+    if cache is not None:
+        cache.close()
+    export_metrics(metrics, args)
+    if profiler is not None:
+        profiler.print_report()
+        profiler.close()
+    
+    print(f"\n处理完成！")
+    if args.compact or (export_json and not args.store):
+        print(f"JSON结果已保存到: {output_file}")
+    else:
+        hint = '使用 --compact' if args.store else '去掉 --no-export 或使用 --compact'
+        print(f"结果已写入记录库: {args.store or default_store_dir(output_file)}（{hint} 生成JSON结果文件 {output_file}）")
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
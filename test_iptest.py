@@ -0,0 +1,1256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+iptest.py 的测试：查询路径使用 benchmark.py 中的本地模拟API服务，不访问外网
+
+运行: python -m pytest -q
+"""
+
+import os
+import sys
+import gzip
+import json
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from statistics import NormalDist
+from collections.abc import ItemsView, ValuesView
+
+import pytest
+
+import iptest
+from benchmark import MockIPAPIServer, mock_record
+
+IPS = [f"1.{a}.{b}.{c}" for a in range(3) for b in range(4) for c in (1, 77, 200)] + ['2001:db8::1', '2400:cb00::5']
+
+@pytest.fixture(scope='module')
+def api():
+    server = MockIPAPIServer()
+    server.start()
+    yield server
+    server.stop()
+
+def expected_groups(ips):
+    """
+    模拟服务对这些IP应返回的分组（中文国家名 -> IP集合）
+    """
+    groups = {}
+    for ip in ips:
+        groups.setdefault(iptest.translate_to_chinese(mock_record(ip)['location']['country']), set()).add(ip)
+    return groups
+
+def grouped_ips(classified):
+    return {country: {record['ip'] for record in records} for country, records in classified.items()}
+
+# ---------------------------------------------------------------- 批量接口
+
+class DroppingServer(MockIPAPIServer):
+    """
+    批量应答中漏掉每批第一个IP的模拟服务
+    """
+    def handle(self, request, ips, batch):
+        super().handle(request, ips[1:] if batch and len(ips) > 1 else ips, batch)
+
+class BatchRejectingServer(MockIPAPIServer):
+    """
+    拒绝所有批量请求（400）的模拟服务
+    """
+    def handle(self, request, ips, batch):
+        super().handle(request, [] if batch else ips, batch)
+
+@pytest.mark.parametrize('batch_size', [1, 10])
+def test_thread_engine(api, batch_size):
+    api.reset_stats()
+    classifier = iptest.IPClassifier(api_base_url=api.url)
+    try:
+        classified, failed = classifier.classify_ips_by_country(IPS, 8, batch_size=batch_size)
+    finally:
+        classifier.close()
+    assert failed == []
+    assert grouped_ips(classified) == expected_groups(IPS)
+    assert api.stats['ips'] == len(IPS)
+    assert api.stats['requests'] == -(-len(IPS) // batch_size)
+
+@pytest.mark.parametrize('server_class, extra_requests', [(DroppingServer, 4), (BatchRejectingServer, len(IPS))])
+def test_batch_falls_back_to_single_lookups(server_class, extra_requests):
+    server = server_class()
+    server.start()
+    classifier = iptest.IPClassifier(api_base_url=server.url)
+    try:
+        classified, failed = classifier.classify_ips_by_country(IPS, 4, batch_size=10)
+    finally:
+        classifier.close()
+        server.stop()
+    assert failed == []
+    assert grouped_ips(classified) == expected_groups(IPS)
+    assert server.stats['requests'] == 4 + extra_requests
+
+# ---------------------------------------------------------------- 查询缓存
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(iptest.time, 'time', lambda: now[0])
+    return now
+
+def test_lookup_cache_persists_and_evicts_memory_tier(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = iptest.LookupCache(path, memory_size=2, flush_every=2)
+    for ip in ('1.0.0.1', '1.0.0.2', '1.0.0.3'):
+        cache.put(ip, mock_record(ip))
+    assert list(cache.memory) == ['1.0.0.2', '1.0.0.3']
+    assert cache.get('1.0.0.1') == mock_record('1.0.0.1')
+    assert cache.stats['disk_hits'] == 1
+    assert list(cache.memory) == ['1.0.0.3', '1.0.0.1']
+    cache.close()
+
+    cache = iptest.LookupCache(path)
+    try:
+        assert cache.get('1.0.0.3') == mock_record('1.0.0.3')
+        assert cache.get('1.0.0.9') is None
+        assert cache.stats == {'memory_hits': 0, 'disk_hits': 1, 'misses': 1, 'expired': 0, 'writes': 0}
+    finally:
+        cache.close()
+
+@pytest.mark.parametrize('reopen', [False, True])
+def test_lookup_cache_ttl(tmp_path, clock, reopen):
+    path = str(tmp_path / 'cache.db')
+    cache = iptest.LookupCache(path, ttl=60)
+    cache.put('1.0.0.1', mock_record('1.0.0.1'))
+    if reopen:
+        cache.close()
+        cache = iptest.LookupCache(path, ttl=60)
+    clock[0] += 59
+    assert cache.get('1.0.0.1') is not None
+    clock[0] += 2
+    assert cache.get('1.0.0.1') is None
+    assert cache.stats['expired'] == 1
+    cache.close()
+
+    forever = iptest.LookupCache(path, ttl=0)
+    clock[0] += 10 ** 6
+    assert forever.get('1.0.0.1') == mock_record('1.0.0.1')
+    forever.close()
+
+def test_classifier_answers_repeat_lookups_from_cache(api, tmp_path):
+    cache = iptest.LookupCache(str(tmp_path / 'cache.db'))
+    classifier = iptest.IPClassifier(api_base_url=api.url, cache=cache)
+    try:
+        classifier.classify_ips_by_country(IPS, 8)
+        api.reset_stats()
+        classified, failed = classifier.classify_ips_by_country(IPS, 8)
+    finally:
+        classifier.close()
+        cache.close()
+    assert failed == []
+    assert api.stats['requests'] == 0
+    assert grouped_ips(classified) == expected_groups(IPS)
+
+# ---------------------------------------------------------------- 网段缓存
+
+def test_network_cache_policies():
+    source = mock_record('1.1.1.1')
+    lookup = iptest.NetworkCache()
+    lookup.learn(source)
+    assert lookup.lookup('1.1.1.9') is None
+    assert lookup.lookup('1.1.2.9') is None
+    assert lookup.stats == {'hits': 0, 'misses': 1, 'needs_lookup': 1}
+
+    unknown = iptest.NetworkCache(policy='unknown')
+    unknown.learn(source)
+    result = unknown.lookup('1.1.1.9')
+    assert result['ip'] == '1.1.1.9'
+    assert result['inherited_from'] == '1.1.1.0/24'
+    assert result['location'] == source['location']
+    assert result['is_vpn'] is None and result['abuse'] == dict.fromkeys(source['abuse'])
+
+    complete = iptest.NetworkCache(iptest.NETWORK_INHERITABLE_FIELDS)
+    complete.learn(source)
+    result = complete.lookup('1.1.1.9')
+    assert 'inherited_from' not in result
+    assert result == dict(source, ip='1.1.1.9', elapsed_ms=None)
+
+def test_network_cache_longest_prefix_and_limits():
+    cache = iptest.NetworkCache(policy='unknown')
+    cache.learn({'ip': '10.1.2.3', 'company': {'network': '10.1.0.0/16'}, 'asn': {'route': '10.0.0.0/7'}})
+    cache.learn({'ip': '10.1.2.4', 'company': {'network': '10.1.2.0 - 10.1.2.255'}})
+    assert cache.range_count == 2  # /7 过于宽泛，不参与索引
+    assert cache.lookup('10.1.2.200')['inherited_from'] == '10.1.2.0/24'
+    assert cache.lookup('10.1.3.1')['inherited_from'] == '10.1.0.0/16'
+    assert cache.lookup('11.0.0.1') is None
+    with pytest.raises(ValueError):
+        iptest.NetworkCache(['is_vpn', 'bogus'])
+    with pytest.raises(ValueError):
+        iptest.NetworkCache(policy='guess')
+
+def test_network_cache_saves_calls_only_under_unknown_policy(api):
+    for policy, requests in (('lookup', len(IPS)), ('unknown', 14)):
+        api.reset_stats()
+        classifier = iptest.IPClassifier(api_base_url=api.url, network_cache=iptest.NetworkCache(policy=policy))
+        try:
+            classified, failed = classifier.classify_ips_by_country(IPS, 1)
+        finally:
+            classifier.close()
+        assert failed == []
+        assert grouped_ips(classified) == expected_groups(IPS)
+        assert api.stats['requests'] == requests
+
+def test_inherited_answers_do_not_replace_complete_records(tmp_path, capsys):
+    vpn_ip = next(f"1.0.0.{n}" for n in range(1, 255) if mock_record(f"1.0.0.{n}")['is_vpn'])
+    full = mock_record(vpn_ip)
+    cache = iptest.NetworkCache(policy='unknown')
+    cache.learn(mock_record('1.0.0.0'))
+    inherited = cache.lookup(vpn_ip)
+    other = cache.lookup('1.0.0.250')
+
+    store = iptest.RecordStore(str(tmp_path / 'store'))
+    try:
+        assert store.put(full) == 'added'
+        assert store.put(inherited) == 'unchanged'
+        assert store.get(vpn_ip) == full
+        assert store.put(other) == 'added'
+        assert store.put(mock_record('1.0.0.250')) == 'updated'
+        assert 'inherited_from' not in store.get('1.0.0.250')
+    finally:
+        store.close()
+
+    db = str(tmp_path / 'results.sqlite')
+    iptest.export_sqlite([full, other], db)
+    iptest.export_sqlite([inherited], db)
+    capsys.readouterr()
+    iptest.command_query([db, '--flags', 'vpn', '--format', 'ips'])
+    out, err = capsys.readouterr()
+    assert out.split() == [vpn_ip]
+    assert '另有 1 条记录' in err
+
+# ---------------------------------------------------------------- 异步引擎
+
+class ThreadRecordingSink:
+    """
+    记录每次写入所在线程的下游输出
+    """
+    def __init__(self):
+        self.threads = set()
+        self.ips = []
+
+    def add(self, ip, record):
+        self.threads.add(threading.current_thread().name)
+        self.ips.append(ip)
+
+    def fail(self, ip, error):
+        self.add(ip, None)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+@pytest.mark.parametrize('batch_size', [1, 10])
+def test_async_engine(api, batch_size):
+    pytest.importorskip('aiohttp')
+    api.reset_stats()
+    sink = ThreadRecordingSink()
+    classifier = iptest.IPClassifier(api_base_url=api.url)
+    try:
+        classified, failed = classifier.classify_ips_by_country_async(IPS, 16, batch_size=batch_size, sinks=[sink])
+    finally:
+        classifier.close()
+    assert failed == []
+    assert grouped_ips(classified) == expected_groups(IPS)
+    assert api.stats['ips'] == len(IPS)
+    # 下游输出在写入线程中执行，不在事件循环所在的主线程
+    assert sorted(sink.ips) == sorted(IPS)
+    assert threading.main_thread().name not in sink.threads
+
+@pytest.mark.parametrize('batch_size', [1, 10])
+def test_async_engine_answers_from_cache(api, tmp_path, batch_size):
+    pytest.importorskip('aiohttp')
+    cache = iptest.LookupCache(str(tmp_path / 'cache.db'))
+    classifier = iptest.IPClassifier(api_base_url=api.url, cache=cache)
+    try:
+        first, _ = classifier.classify_ips_by_country_async(IPS, 16, batch_size=batch_size)
+        api.reset_stats()
+        second, failed = classifier.classify_ips_by_country_async(IPS, 16, batch_size=batch_size)
+    finally:
+        classifier.close()
+        cache.close()
+    assert failed == []
+    assert api.stats['requests'] == 0
+    assert grouped_ips(second) == grouped_ips(first) == expected_groups(IPS)
+
+# ---------------------------------------------------------------- 限速与重试
+
+def test_parse_retry_after_is_clamped():
+    assert iptest.parse_retry_after(None) is None
+    assert iptest.parse_retry_after('soon') is None
+    assert iptest.parse_retry_after('nan') is None
+    assert iptest.parse_retry_after('2.5') == 2.5
+    assert iptest.parse_retry_after('-3') == 0.0
+    assert iptest.parse_retry_after('3600') == iptest.MAX_RETRY_DELAY
+    assert iptest.parse_retry_after('Fri, 31 Dec 9999 23:59:59 GMT') == iptest.MAX_RETRY_DELAY
+    assert iptest.parse_retry_after('Thu, 01 Jan 1970 00:00:00 GMT') == 0.0
+
+def test_backoff_delay_is_bounded_and_jittered():
+    classifier = iptest.IPClassifier()
+    try:
+        delays = {classifier._backoff_delay(0, 2.0) for _ in range(50)}
+        assert all(2.0 <= delay <= 2.2 for delay in delays) and len(delays) > 1
+        assert all(classifier._backoff_delay(0, 3600) <= iptest.MAX_RETRY_DELAY * 1.1 for _ in range(50))
+        assert all(classifier._backoff_delay(20) <= iptest.MAX_RETRY_DELAY for _ in range(50))
+    finally:
+        classifier.close()
+
+def test_rate_limiter_aimd():
+    limiter = iptest.AdaptiveRateLimiter(rate=100, min_rate=10, max_rate=120, increase=50)
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.rate == 120
+    # 同一批并发请求同时被限流时只降速一次
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.rate == 60
+    assert limiter.stats['throttled'] == 2
+    limiter.on_throttle(retry_after=5)
+    assert limiter.reserve() > 4
+
+def test_rate_limiter_spaces_requests():
+    limiter = iptest.AdaptiveRateLimiter(rate=10)
+    waits = [limiter.reserve() for _ in range(3)]
+    assert waits[0] == 0
+    assert waits[2] == pytest.approx(0.2, abs=0.02)
+
+def test_throttled_lookups_retry_without_honouring_huge_retry_after(monkeypatch):
+    monkeypatch.setattr(iptest, 'MAX_RETRY_DELAY', 0.05)
+    server = MockIPAPIServer(throttle_rate=0.3, retry_after=3600, seed=7)
+    server.start()
+    limiter = iptest.AdaptiveRateLimiter(rate=1000, max_rate=1000)
+    classifier = iptest.IPClassifier(api_base_url=server.url, rate_limiter=limiter, max_retries=20)
+    try:
+        classified, failed = classifier.classify_ips_by_country(IPS, 4)
+    finally:
+        classifier.close()
+        server.stop()
+    assert failed == []
+    assert grouped_ips(classified) == expected_groups(IPS)
+    assert server.stats['throttled'] > 0
+    assert limiter.stats['retries'] == server.stats['throttled']
+    assert limiter.rate < 1000
+
+# ---------------------------------------------------------------- 流式窗口
+
+STREAM_IPS = [f"2.{a}.{b}.9" for a in range(4) for b in range(60)]
+
+class CountingInput:
+    """
+    惰性产出IP，并记录读取时尚未完成的IP数的最大值
+    """
+    def __init__(self, ips):
+        self.ips = ips
+        self.pulled = 0
+        self.done = 0
+        self.max_in_flight = 0
+
+    def __iter__(self):
+        for ip in self.ips:
+            self.pulled += 1
+            self.max_in_flight = max(self.max_in_flight, self.pulled - self.done)
+            yield ip
+
+@pytest.mark.parametrize('batch_size', [1, 5])
+def test_thread_stream_keeps_a_bounded_window(api, batch_size):
+    source = CountingInput(STREAM_IPS)
+    classifier = iptest.IPClassifier(api_base_url=api.url)
+    try:
+        results = []
+        for ip, record, error in classifier.iter_classify(source, max_workers=2, batch_size=batch_size, window=3):
+            source.done += 1
+            results.append(record['ip'])
+    finally:
+        classifier.close()
+    assert sorted(results) == sorted(STREAM_IPS)
+    assert source.max_in_flight <= 3 * batch_size
+
+def test_async_stream_keeps_a_bounded_window(api):
+    pytest.importorskip('aiohttp')
+    source = CountingInput(STREAM_IPS)
+
+    class DoneSink(ThreadRecordingSink):
+        def add(self, ip, record):
+            super().add(ip, record)
+            source.done += 1
+
+    sink = DoneSink()
+    classifier = iptest.IPClassifier(api_base_url=api.url)
+    try:
+        success, failed = classifier.classify_stream(source, [sink], engine='async', concurrency=4, batch_size=5)
+    finally:
+        classifier.close()
+    assert (success, failed) == (len(STREAM_IPS), 0)
+    assert sorted(sink.ips) == sorted(STREAM_IPS)
+    assert source.max_in_flight <= 4 * 5
+
+# ---------------------------------------------------------------- 输入规范化与排序
+
+def test_normalize_ip_lines():
+    report = iptest.InputReport()
+    lines = ['1.2.3.4', '001.2.3.4', '2001:DB8:0:0::1', '2001:db8::1', '10.0.0.0/30', '10.0.0.2',
+             '10.0.1.0/31', 'example.com', '300.1.1.1', '10.0.0.0/8', '1.2.3.0/33']
+    assert list(iptest.normalize_ip_lines(lines, report, max_cidr_size=256)) == [
+        '1.2.3.4', '2001:db8::1', '10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.1.0', '10.0.1.1']
+    assert (report.total_lines, report.accepted, report.expanded_blocks) == (11, 8, 2)
+    assert (report.duplicates, report.rejected) == (2, 5)
+    assert [line for _, line, _ in report.rejected_examples] == [
+        '001.2.3.4', 'example.com', '300.1.1.1', '10.0.0.0/8', '1.2.3.0/33']
+
+def test_normalize_ip_lines_hosts_only():
+    assert list(iptest.normalize_ip_lines(['10.0.0.0/30'], hosts_only=True)) == ['10.0.0.1', '10.0.0.2']
+
+def test_normalize_ip_lines_bounded_dedupe():
+    report = iptest.InputReport()
+    lines = ['1.0.0.1', '1.0.0.2', '1.0.0.1', '1.0.0.3', '1.0.0.2', '1.0.0.4', '1.0.0.5', '1.0.0.1']
+    assert list(iptest.normalize_ip_lines(lines, report, dedupe_limit=2)) == [
+        '1.0.0.1', '1.0.0.2', '1.0.0.3', '1.0.0.4', '1.0.0.5', '1.0.0.1']
+    assert report.dedupe_rotations == 2
+    assert report.duplicates == 2
+
+def test_ip_sort_key_orders_v4_before_v6():
+    ips = ['2001:db8::', '10.0.0.1', '::1', '255.255.255.255', '9.255.255.255', '::ffff:1.2.3.4', '0.0.0.0']
+    assert sorted(ips, key=iptest.ip_sort_key) == [
+        '0.0.0.0', '9.255.255.255', '10.0.0.1', '255.255.255.255', '::1', '::ffff:1.2.3.4', '2001:db8::']
+    assert iptest.ip_sort_key('not-an-ip') == -1
+
+# ---------------------------------------------------------------- 记录库
+
+def make_record(ip, country, network=None, route=None):
+    return {
+        'ip': ip,
+        'company': {'name': f"Company {country}", 'network': network},
+        'asn': {'asn': 64512, 'route': route},
+        'location': {'country': country, 'country_code': country[:2].upper()},
+    }
+
+def test_record_store_round_trip(tmp_path):
+    directory = str(tmp_path / 'store')
+    store = iptest.RecordStore(directory)
+    assert store.put(make_record('1.1.1.1', 'Australia')) == 'added'
+    assert store.put(make_record('8.8.8.8', 'United States')) == 'added'
+    assert store.put(make_record('::1', 'Unknown')) == 'added'
+    assert store.put(make_record('1.1.1.1', 'Australia'), checked_at=1234.5) == 'unchanged'
+    assert store.put(make_record('8.8.8.8', 'Canada')) == 'updated'
+    store.close()
+
+    store = iptest.RecordStore(directory)
+    try:
+        assert len(store) == 3
+        assert store.get('8.8.8.8')['location']['country'] == 'Canada'
+        assert store.index['1.1.1.1'][5] == 1234.5
+        assert store.get('9.9.9.9') is None
+        assert [r['ip'] for r in store.iter_records(order='country')] == ['1.1.1.1', '8.8.8.8', '::1']
+    finally:
+        store.close()
+
+def test_record_store_unchanged_records_do_not_grow_index(tmp_path):
+    directory = str(tmp_path / 'store')
+    index_path = os.path.join(directory, iptest.RecordStore.INDEX_FILE)
+    for _ in range(3):
+        store = iptest.RecordStore(directory)
+        store.put_many(make_record(ip, 'Japan') for ip in ('1.0.0.1', '1.0.0.2'))
+        store.close()
+        with open(index_path, encoding='utf-8') as f:
+            assert len(f.readlines()) == 2
+
+def test_record_store_writes_index_after_segment(tmp_path):
+    directory = str(tmp_path / 'store')
+    index_path = os.path.join(directory, iptest.RecordStore.INDEX_FILE)
+    store = iptest.RecordStore(directory)
+    store.put(make_record('1.0.0.1', 'Japan'))
+    assert os.path.getsize(index_path) == 0
+    store.flush()
+    with open(index_path, encoding='utf-8') as f:
+        assert f.read().startswith('1.0.0.1\t')
+    store.close()
+
+def test_record_store_ignores_index_lines_past_segment_end(tmp_path):
+    directory = str(tmp_path / 'store')
+    store = iptest.RecordStore(directory)
+    store.put(make_record('1.0.0.1', 'Japan'))
+    store.put(make_record('1.0.0.1', 'Germany'))
+    store.close()
+    # 模拟中断：索引已写出，分段文件中的最后一条记录没有写完
+    segment = os.path.join(directory, 'seg-000001.ndjson')
+    with open(segment, 'rb+') as f:
+        f.truncate(os.path.getsize(segment) - 5)
+
+    store = iptest.RecordStore(directory)
+    try:
+        assert store.get('1.0.0.1')['location']['country'] == 'Japan'
+        assert store.put(make_record('1.0.0.1', 'Germany')) == 'updated'
+    finally:
+        store.close()
+
+def test_record_store_compact(tmp_path):
+    directory = str(tmp_path / 'store')
+    store = iptest.RecordStore(directory)
+    for version in range(3):
+        for ip in ('10.0.0.1', '10.0.0.2', '2001:db8::1'):
+            store.put(make_record(ip, 'Germany', network=f"10.0.{version}.0/24"))
+    expected = {ip: store.get(ip) for ip in store.index}
+    reclaimed = store.compact()
+    assert reclaimed > 0
+    assert {ip: store.get(ip) for ip in store.index} == expected
+    store.close()
+
+    segments = [name for name in os.listdir(directory) if name.startswith('seg-')]
+    assert len(segments) == 1
+    store = iptest.RecordStore(directory)
+    try:
+        assert {ip: store.get(ip) for ip in store.index} == expected
+        assert store.put(make_record('10.0.0.1', 'Germany', network='10.0.2.0/24')) == 'unchanged'
+    finally:
+        store.close()
+
+def run_cli(tmp_path, *args):
+    return subprocess.run([sys.executable, os.path.abspath(iptest.__file__), *args],
+                          cwd=tmp_path, check=True, capture_output=True, text=True)
+
+def test_cli_exports_json_by_default(api, tmp_path):
+    (tmp_path / 'ips.txt').write_text('\n'.join(IPS[:6]) + '\n', encoding='utf-8')
+    run_cli(tmp_path, 'ips.txt', '-o', 'out.json', '--api-url', api.url, '--no-interactive')
+    with open(tmp_path / 'out.json', encoding='utf-8') as f:
+        results = json.load(f)
+    assert sorted(record['IP地址'] for records in results.values() for record in records) == sorted(IPS[:6])
+
+    run_cli(tmp_path, 'ips.txt', '-o', 'skip.json', '--api-url', api.url, '--no-interactive', '--no-export')
+    assert not (tmp_path / 'skip.json').exists()
+    assert (tmp_path / 'skip.store' / iptest.RecordStore.INDEX_FILE).exists()
+
+# ---------------------------------------------------------------- 国家文件归并
+
+def read_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read().split()
+
+def test_merge_sorted_ip_file_streaming(tmp_path):
+    path = tmp_path / 'US.txt'
+    path.write_text('1.0.0.1\n1.0.0.1\n\n1.0.0.5\n::1\n', encoding='utf-8')
+    assert iptest.merge_sorted_ip_file(str(path), ['1.0.0.3', '1.0.0.5', '2001:db8::']) == (5, 3)
+    assert read_lines(path) == ['1.0.0.1', '1.0.0.3', '1.0.0.5', '::1', '2001:db8::']
+
+def test_merge_sorted_ip_file_unsorted_fallback(tmp_path, capsys):
+    path = tmp_path / 'US.txt'
+    path.write_text('1.0.0.9\n::1\n1.0.0.1\n1.0.0.9\n1.0.0.3\n', encoding='utf-8')
+    assert iptest.merge_sorted_ip_file(str(path), ['1.0.0.2', '1.0.0.3'], chunk_lines=2) == (5, 4)
+    assert read_lines(path) == ['1.0.0.1', '1.0.0.2', '1.0.0.3', '1.0.0.9', '::1']
+    assert '未按IP排序' in capsys.readouterr().out
+    assert os.listdir(tmp_path) == ['US.txt']
+
+def test_create_country_files_merge_mode(tmp_path):
+    classifier = iptest.IPClassifier()
+    output_dir = str(tmp_path / 'country_files')
+    try:
+        classifier.create_country_files({}, output_dir, merge_mode=True, code_groups={'JP': ['1.0.0.9', '1.0.0.1']})
+        classifier.create_country_files({}, output_dir, merge_mode=True, code_groups={'JP': ['1.0.0.5', '1.0.0.1']})
+    finally:
+        classifier.close()
+    assert read_lines(os.path.join(output_dir, 'merged', 'JP.txt')) == ['1.0.0.1', '1.0.0.5', '1.0.0.9']
+
+# ---------------------------------------------------------------- 离线网段库
+
+def test_offline_range_db_nested_ranges(tmp_path):
+    """嵌套范围以最小的范围为准，网段库缺少的字段按策略处理"""
+    records = [
+        make_record('10.200.0.1', 'Outer', network='10.0.0.0/8', route='10.0.0.0/8'),
+        make_record('10.1.2.3', 'Middle', network='10.1.0.0/16'),
+        make_record('10.1.2.200', 'Inner', network='10.1.2.128/25'),
+        make_record('2001:db8::1', 'Six', network='2001:db8::/32'),
+    ]
+    path = str(tmp_path / 'ranges.db')
+    range_count, record_count = iptest.OfflineRangeDB.compile(records, path)
+    assert record_count == 4
+    assert range_count > 0
+
+    db = iptest.OfflineRangeDB(path, policy='unknown')
+    try:
+        expected = {
+            '9.255.255.255': None,
+            '10.0.0.0': 'Outer',
+            '10.1.0.0': 'Middle',
+            '10.1.2.3': 'Middle',
+            '10.1.2.127': 'Middle',
+            '10.1.2.128': 'Inner',
+            '10.1.2.255': 'Inner',
+            '10.1.3.0': 'Middle',
+            '10.1.255.255': 'Middle',
+            '10.2.0.0': 'Outer',
+            '10.255.255.255': 'Outer',
+            '11.0.0.0': None,
+            '2001:db8::': 'Six',
+            '2001:db8:ffff::1': 'Six',
+            '2001:db9::': None,
+        }
+        for ip, country in expected.items():
+            result = db.lookup(ip)
+            assert (result and result['location']['country']) == country, ip
+        result = db.lookup('10.1.2.130')
+        assert result['ip'] == '10.1.2.130'
+        assert result['company']['network'] == '10.1.2.128/25'
+        # 未知字段取值为None，并注明来源网段
+        assert result['is_vpn'] is None
+        assert result['inherited_from'] == '10.1.2.128/25'
+        assert db.lookup('10.1.3.0')['inherited_from'] == '10.1.3.0 - 10.1.255.255'
+        assert db.lookup('2001:db8::5')['inherited_from'] == '2001:db8::/32'
+    finally:
+        db.close()
+
+    # lookup策略（默认）下网段库不含is_vpn等字段，命中也要逐IP查询
+    db = iptest.OfflineRangeDB(path)
+    try:
+        assert not db.answers_locally
+        assert db.lookup('10.1.2.3') is None
+        assert db.lookup('11.0.0.0') is None
+        assert db.stats == {'hits': 0, 'misses': 1, 'needs_lookup': 1}
+    finally:
+        db.close()
+
+def test_offline_db_lookup_policy_queries_api(api, tmp_path):
+    """lookup策略下命中网段的IP仍请求API，完整记录不会被离线应答替换"""
+    ips = IPS[:6]
+    path = str(tmp_path / 'ranges.db')
+    iptest.OfflineRangeDB.compile([mock_record(ip) for ip in ips], path)
+    api.reset_stats()
+    db = iptest.OfflineRangeDB(path)
+    classifier = iptest.IPClassifier(api_base_url=api.url, offline_db=db)
+    try:
+        classified, failed = classifier.classify_ips_by_country(ips, 4)
+    finally:
+        classifier.close()
+        db.close()
+    assert failed == []
+    assert grouped_ips(classified) == expected_groups(ips)
+    assert api.stats['ips'] == len(ips)
+    assert db.stats['needs_lookup'] == len(ips)
+
+    store = iptest.RecordStore(str(tmp_path / 'store'))
+    db = iptest.OfflineRangeDB(path, policy='unknown')
+    try:
+        assert store.put(mock_record(ips[0])) == 'added'
+        assert store.put(db.lookup(ips[0])) == 'unchanged'
+        assert store.get(ips[0]) == mock_record(ips[0])
+    finally:
+        db.close()
+        store.close()
+
+# ---------------------------------------------------------------- 检查点日志
+
+def test_checkpoint_journal_replay(tmp_path):
+    """回放时忽略失败记录和中断时写了一半的最后一行"""
+    path = str(tmp_path / 'run.journal')
+    assert iptest.CheckpointJournal.replay(path) == {}
+
+    journal = iptest.CheckpointJournal(path, flush_every=2)
+    for ip in ('1.0.0.1', '1.0.0.2', '1.0.0.3'):
+        journal.add(ip, mock_record(ip))
+    journal.fail('1.0.0.4', '查询失败')
+    journal.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"ip": "1.0.0.5", "rec')
+
+    done = iptest.CheckpointJournal.replay(path)
+    assert set(done) == {'1.0.0.1', '1.0.0.2', '1.0.0.3'}
+    assert done['1.0.0.2'] == mock_record('1.0.0.2')
+
+    journal = iptest.CheckpointJournal(path, append=True)
+    journal.add('1.0.0.6', mock_record('1.0.0.6'))
+    journal.remove()
+    assert not os.path.exists(path)
+
+def test_resume_skips_journaled_ips(api, tmp_path):
+    """--resume只查询日志中没有的IP，完成后删除日志"""
+    ips = IPS[:20]
+    (tmp_path / 'ips.txt').write_text('\n'.join(ips) + '\n', encoding='utf-8')
+    journal = iptest.CheckpointJournal(str(tmp_path / 'out.journal'))
+    for ip in ips[:12]:
+        journal.add(ip, mock_record(ip))
+    journal.close()
+
+    api.reset_stats()
+    run_cli(tmp_path, 'ips.txt', '-o', 'out.json', '--api-url', api.url, '--no-interactive', '--resume')
+    assert api.stats['ips'] == 8
+    assert not (tmp_path / 'out.journal').exists()
+    with open(tmp_path / 'out.json', encoding='utf-8') as f:
+        results = json.load(f)
+    assert sorted(record['IP地址'] for records in results.values() for record in records) == sorted(ips)
+
+# ---------------------------------------------------------------- 分片与合并
+
+def test_parse_shard():
+    assert iptest.parse_shard('0/4') == (0, 4)
+    assert iptest.parse_shard('3/4') == (3, 4)
+    for spec in ('4/4', '-1/4', '0/0', '1', 'a/b', '1/2/3'):
+        with pytest.raises(ValueError):
+            iptest.parse_shard(spec)
+    assert iptest.shard_path('out.json', 1, 4) == 'out.shard-1-of-4.json'
+    assert iptest.shard_path('country_files/', 0, 2) == 'country_files.shard-0-of-2'
+
+def test_shards_partition_input_by_network():
+    """每个IP恰好属于一个分片，同一网段的IP在同一分片"""
+    count = 3
+    shards = [list(iptest.filter_shard(IPS, index, count)) for index in range(count)]
+    assert sorted(ip for shard in shards for ip in shard) == sorted(IPS)
+    for ip in IPS:
+        shard = iptest.shard_of(ip, count)
+        assert ip in shards[shard]
+        assert iptest.shard_of(ip.rsplit('.', 1)[0] + '.9' if ':' not in ip else ip, count) == shard
+
+def test_cli_shards_then_merge(api, tmp_path):
+    """各分片分别运行后，merge得到与单次运行相同的结果文件和国家文件"""
+    (tmp_path / 'ips.txt').write_text('\n'.join(IPS) + '\n', encoding='utf-8')
+    api.reset_stats()
+    for index in range(2):
+        run_cli(tmp_path, 'ips.txt', '-o', 'out.json', '--api-url', api.url, '--no-interactive', '--shard', f"{index}/2")
+    assert api.stats['ips'] == len(IPS)
+
+    run_cli(tmp_path, 'merge', 'out.shard-0-of-2.store', 'out.shard-1-of-2.json', '-o', 'out.json', '-d', 'merged')
+    with open(tmp_path / 'out.json', encoding='utf-8') as f:
+        results = json.load(f)
+    assert {country: {record['IP地址'] for record in records} for country, records in results.items()} == \
+        expected_groups(IPS)
+
+    codes = {}
+    for ip in IPS:
+        codes.setdefault(mock_record(ip)['location']['country_code'], []).append(ip)
+    assert sorted(os.listdir(tmp_path / 'merged')) == sorted(f"{code}.txt" for code in codes)
+    for code, ips in codes.items():
+        assert read_lines(tmp_path / 'merged' / f"{code}.txt") == sorted(ips, key=iptest.ip_sort_key)
+
+# ---------------------------------------------------------------- 查询指标
+
+def test_metrics_endpoint_listens_on_localhost_by_default():
+    metrics = iptest.LookupMetrics()
+    metrics.count_lookup('cache')
+    server = metrics.serve(0)
+    try:
+        host, port = server.server_address[:2]
+        assert host == '127.0.0.1'
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            body = response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'iptest_lookups_total{source="cache"} 1' in body
+
+# ---------------------------------------------------------------- 进度与摘要
+
+def test_progress_reporter_throttles_output(monkeypatch, capsys):
+    """两次输出之间至少间隔interval秒，结束时输出平均速率"""
+    now = [100.0]
+    monkeypatch.setattr(iptest.time, 'monotonic', lambda: now[0])
+    progress = iptest.ProgressReporter(total=100, interval=0.5)
+    progress.overwrite = False
+    for i in range(100):
+        now[0] += 0.01
+        progress.update(f"1.0.0.{i}", success=i % 10 != 0)
+    progress.finish()
+    lines = capsys.readouterr().out.splitlines()
+    # 1秒内完成100个IP，每0.5秒输出一次
+    assert [line for line in lines if line.startswith('处理进度')] == [
+        '处理进度: 50/100 (50.0%)，失败 5，100.0 个/秒，预计剩余 00:00',
+        '处理进度: 100/100 (100.0%)，失败 10，100.0 个/秒，预计剩余 00:00']
+    assert lines[-1] == '查询完成: 100 个IP（失败 10 个），用时 00:01，平均 100.0 个/秒'
+
+    progress = iptest.ProgressReporter(interval=0)
+    progress.update('1.0.0.1')
+    progress.finish()
+    assert capsys.readouterr().out == '处理进度: 1 - 1.0.0.1\n'
+
+def test_record_summary_counts(capsys):
+    summary = iptest.RecordSummary()
+    ips = IPS[:6]
+    for ip in ips:
+        summary.add(ip, mock_record(ip))
+    unknown = dict(mock_record(ips[0]), is_vpn=None, inherited_from='1.0.0.0/24')
+    summary.add(ips[0], unknown)
+    summary.fail('1.0.0.9', '查询失败')
+
+    assert summary.total == len(ips) + 1
+    assert summary.failed == 1
+    countries = {}
+    for ip in ips + [ips[0]]:
+        country = mock_record(ip)['location']['country']
+        countries[country] = countries.get(country, 0) + 1
+    assert dict(summary.countries) == countries
+    assert sum(summary.asns.values()) == len(ips) + 1
+    assert summary.flags['is_vpn'] == sum(bool(mock_record(ip)['is_vpn']) for ip in ips)
+    assert dict(summary.unknown_flags) == {'is_vpn': 1}
+
+    summary.print_summary()
+    out = capsys.readouterr().out
+    assert f"共 {len(ips) + 1} 个IP，涉及 {len(countries)} 个国家/地区" in out
+    assert f"{iptest.FLAG_FIELDS['is_vpn']}: {summary.flags['is_vpn']} 个" in out
+    assert '，未知 1 个' in out
+
+# ---------------------------------------------------------------- 紧凑记录
+
+def test_compact_record_mapping_interface():
+    record = mock_record('1.2.3.4')
+    compact = iptest.CompactRecord.from_dict(record)
+    assert compact.to_dict() == record
+    assert dict(compact.items()) == dict(record.items())
+    assert isinstance(compact.items(), ItemsView)
+    assert isinstance(compact.values(), ValuesView)
+    assert list(compact['location'].values()) == list(record['location'].values())
+    assert ('ip', '1.2.3.4') in compact.items()
+    assert len(compact.values()) == len(record)
+    assert iptest.get_translator('zh').record(compact) == iptest.get_translator('zh').record(record)
+
+def test_compact_record_pool_is_bounded(monkeypatch):
+    """只有低基数字段进入取值池，且池的大小有上限"""
+    monkeypatch.setattr(iptest.CompactRecord, '_pool', {})
+    monkeypatch.setattr(iptest, 'COMPACT_POOL_SIZE', 3)
+    first = iptest.CompactRecord.from_dict({'country': ''.join(['Jap', 'an']), 'city': ''.join(['Tok', 'yo'])})
+    second = iptest.CompactRecord.from_dict({'country': ''.join(['Jap', 'an']), 'city': ''.join(['Tok', 'yo'])})
+    assert first['country'] is second['country']
+    assert first['city'] is not second['city']
+    for country in ('A', 'B', 'C', 'D'):
+        iptest.CompactRecord.from_dict({'country': country})
+    assert len(iptest.CompactRecord._pool) == 3
+
+# ---------------------------------------------------------------- 输出语言
+
+def test_translator_round_trips_through_canonical_record():
+    record = mock_record('1.2.3.4')
+    translated = iptest.get_translator('zh').record(record)
+    assert translated['IP地址'] == '1.2.3.4'
+    assert translated['是否为VPN'] == '否'
+    assert translated['位置信息']['国家'] == '日本'
+    assert iptest.canonicalize_record(translated)['location']['country'] == 'Japan'
+    assert iptest.get_translator('en').record(record) is record
+    assert iptest.get_translator('zh') is iptest.get_translator('zh')
+
+# ---------------------------------------------------------------- 常驻查询服务
+
+@pytest.fixture
+def slow_api():
+    server = MockIPAPIServer(latency_ms=200)
+    server.start()
+    yield server
+    server.stop()
+
+def api_record(ip):
+    """
+    分类器对模拟服务应答整理后的规范记录
+    """
+    return iptest.IPAPIProvider().build_record(mock_record(ip), ip)
+
+def run_concurrently(*calls):
+    """
+    在各自的线程中同时执行调用，返回各调用的结果；超时未完成视为死锁
+    """
+    results = [None] * len(calls)
+    def run(i, call):
+        results[i] = call()
+    threads = [threading.Thread(target=run, args=(i, call), daemon=True) for i, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive(), '查询未完成（可能死锁）'
+    return results
+
+def test_lookup_server_coalesces_concurrent_requests(slow_api):
+    classifier = iptest.IPClassifier(api_base_url=slow_api.url)
+    service = iptest.LookupServer(classifier)
+    try:
+        results = run_concurrently(*[lambda: service.lookup('1.2.3.4')] * 8)
+        assert results == [api_record('1.2.3.4')] * 8
+        assert slow_api.stats['ips'] == 1
+        assert service.stats['coalesced'] == 7
+        assert service.lookup('1.2.3.4') == api_record('1.2.3.4')
+        assert service.stats['lru_hits'] == 1
+        assert slow_api.stats['ips'] == 1
+    finally:
+        service.close()
+        classifier.close()
+
+def test_lookup_server_network_coalescing_does_not_deadlock(slow_api):
+    """两个请求各自发起一个网段的查询并等待对方的网段：先完成自己的查询再等待，不会互相等待"""
+    network_cache = iptest.NetworkCache(policy='unknown')
+    classifier = iptest.IPClassifier(api_base_url=slow_api.url, network_cache=network_cache)
+    service = iptest.LookupServer(classifier, max_workers=4)
+    try:
+        first, second = run_concurrently(
+            lambda: service.lookup_many(['1.0.0.1', '1.0.1.1']),
+            lambda: service.lookup_many(['1.0.1.2', '1.0.0.2']))
+        # 同一批中同一网段的IP也不会等待自己
+        (same,) = run_concurrently(lambda: service.lookup_many(['1.0.2.1', '1.0.2.2']))
+    finally:
+        service.close()
+        classifier.close()
+    results = {**first, **second, **same}
+    assert set(results) == {'1.0.0.1', '1.0.0.2', '1.0.1.1', '1.0.1.2', '1.0.2.1', '1.0.2.2'}
+    assert all(record is not None for record in results.values())
+    # 每个网段只查询一次上游，其余IP由网段缓存应答
+    assert slow_api.stats['ips'] == 3
+    assert results['1.0.0.2']['inherited_from'] == '1.0.0.0/24'
+
+def test_lookup_server_http_interface(api):
+    classifier = iptest.IPClassifier(api_base_url=api.url)
+    service = iptest.LookupServer(classifier)
+    server = iptest.ThreadingHTTPServer(('127.0.0.1', 0), service.make_handler(max_batch=3, default_lang='en'))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    def request(path, payload=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        try:
+            with urllib.request.urlopen(urllib.request.Request(base + path, data=data), timeout=5) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+    try:
+        assert request('/lookup/1.2.3.4') == (200, api_record('1.2.3.4'))
+        status, body = request('/lookup?ip=1.2.3.4&lang=zh')
+        assert status == 200 and body['IP地址'] == '1.2.3.4'
+        assert request('/lookup/not-an-ip')[0] == 400
+        status, body = request('/lookup', {'ips': ['1.2.3.4', '5.6.7.8', 'bad']})
+        assert status == 200
+        assert body['results'] == {'1.2.3.4': api_record('1.2.3.4'), '5.6.7.8': api_record('5.6.7.8')}
+        assert body['invalid'] == ['bad'] and body['failed'] == []
+        assert request('/lookup', ['1.1.1.1'] * 4)[0] == 413
+        status, body = request('/health')
+        assert status == 200 and body['lru_hits'] >= 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+        classifier.close()
+
+# ---------------------------------------------------------------- 多后端、对冲与故障切换
+
+def test_provider_health_trips_and_probation(monkeypatch):
+    now = [500.0]
+    monkeypatch.setattr(iptest.time, 'monotonic', lambda: now[0])
+    health = iptest.ProviderHealth(window=10, min_samples=4, error_threshold=0.5, cooldown=30)
+    for success in (True, False, True):
+        assert not health.record(success)
+    # 样本达到4个且错误率达到50%时暂停
+    assert health.record(False)
+    assert not health.available()
+    assert not health.record(False)  # 暂停前已发出的请求，不重复计算
+    now[0] += 31
+    assert health.available()
+    # 试用期内再次失败立即重新暂停
+    assert health.record(False)
+    assert health.stats['trips'] == 2
+    now[0] += 31
+    assert not health.record(True)
+    assert not health.record(False)
+    assert health.available()
+
+    for elapsed in range(1, 21):
+        health.record(True, elapsed / 100)
+    assert health.p95() == 0.19
+
+def test_failover_to_next_provider(api):
+    """首选后端持续出错时切换到下一个后端，错误率达到阈值后不再请求它"""
+    broken = MockIPAPIServer(error_rate=1.0)
+    broken.start()
+    providers = [iptest.IPAPIProvider(broken.url, health=iptest.ProviderHealth(min_samples=4)),
+                 iptest.IPAPIProvider(api.url)]
+    classifier = iptest.IPClassifier(providers=providers, max_retries=0)
+    try:
+        for ip in IPS[:10]:
+            assert classifier.get_ip_location(ip) == api_record(ip)
+    finally:
+        classifier.close()
+        broken.stop()
+    assert broken.stats['requests'] == 4
+    assert providers[0].health.stats['trips'] == 1
+    assert providers[1].health.stats['success'] == 10
+
+def test_offline_provider_answers_when_remote_fails(tmp_path):
+    broken = MockIPAPIServer(error_rate=1.0)
+    broken.start()
+    path = str(tmp_path / 'ranges.db')
+    iptest.OfflineRangeDB.compile([mock_record('1.0.0.1')], path)
+    providers = [iptest.IPAPIProvider(broken.url), iptest.parse_provider_spec(f"offline:{path}")]
+    classifier = iptest.IPClassifier(providers=providers, max_retries=0)
+    try:
+        record = classifier.get_ip_location('1.0.0.9')
+        assert classifier.get_ip_location('9.9.9.9') is None
+    finally:
+        classifier.close()
+        providers[1].db.close()
+        broken.stop()
+    assert record['location']['country'] == mock_record('1.0.0.1')['location']['country']
+    assert record['inherited_from'] == '1.0.0.0/24'
+    assert record['is_vpn'] is None
+
+def test_hedged_request_wins_on_slow_primary():
+    slow = MockIPAPIServer(latency_ms=1000)
+    fast = MockIPAPIServer()
+    slow.start()
+    fast.start()
+    providers = [iptest.IPAPIProvider(slow.url), iptest.IPAPIProvider(fast.url)]
+    classifier = iptest.IPClassifier(providers=providers, hedge=True, hedge_delay=0.05)
+    try:
+        start = iptest.time.perf_counter()
+        record = classifier.get_ip_location('1.2.3.4')
+        elapsed = iptest.time.perf_counter() - start
+    finally:
+        classifier.close()
+        slow.stop()
+        fast.stop()
+    assert record == api_record('1.2.3.4')
+    assert elapsed < 0.8
+    assert providers[0].health.stats['hedged'] == 1
+    assert providers[1].health.stats['hedge_wins'] == 1
+
+# ---------------------------------------------------------------- SQLite查询
+
+@pytest.fixture
+def results_db(tmp_path):
+    records = []
+    for i, ip in enumerate(['1.0.0.1', '1.0.1.1', '1.0.2.1', '2.0.0.1', '2001:db8::1', '2001:db9::1']):
+        record = mock_record(ip)
+        record['is_vpn'] = i % 2 == 0
+        record['is_proxy'] = i % 3 == 0
+        record['location']['country_code'] = 'HK' if i < 3 else 'JP'
+        record['asn']['asn'] = 64512 + i % 2
+        records.append(record)
+    path = str(tmp_path / 'results.sqlite')
+    assert iptest.export_sqlite(records, path) == len(records)
+    return path
+
+def query_ips(capsys, db, *args):
+    capsys.readouterr()
+    iptest.command_query([db, '--format', 'ips', *args])
+    return capsys.readouterr().out.split()
+
+def test_query_filters(results_db, capsys):
+    db = results_db
+    assert query_ips(capsys, db, '--cidr', '1.0.0.0/23') == ['1.0.0.1', '1.0.1.1']
+    assert query_ips(capsys, db, '--cidr', '1.0.2.0/24', '--cidr', '2001:db8::/32') == ['1.0.2.1', '2001:db8::1']
+    assert query_ips(capsys, db, '--cidr', '::/0') == ['2001:db8::1', '2001:db9::1']
+    assert query_ips(capsys, db, '--ip', '2.0.0.1', '--ip', '1.0.0.1') == ['1.0.0.1', '2.0.0.1']
+    assert query_ips(capsys, db, '--country', 'hk') == ['1.0.0.1', '1.0.1.1', '1.0.2.1']
+    assert query_ips(capsys, db, '--country', 'HK', '--asn', 'AS64513') == ['1.0.1.1']
+    assert query_ips(capsys, db, '--flags', 'vpn') == ['1.0.0.1', '1.0.2.1', '2001:db8::1']
+    assert query_ips(capsys, db, '--flags', 'vpn,is_proxy') == ['1.0.0.1', '1.0.2.1', '2.0.0.1', '2001:db8::1']
+    assert query_ips(capsys, db, '--flags', 'vpn,proxy', '--all-flags') == ['1.0.0.1']
+    assert query_ips(capsys, db, '--flags', 'vpn', '--limit', '2') == ['1.0.0.1', '1.0.2.1']
+
+    capsys.readouterr()
+    iptest.command_query([db, '--country', 'JP', '--count'])
+    assert capsys.readouterr().out.strip() == '3'
+    iptest.command_query([db, '--ip', '1.0.0.1', '--format', 'json', '--lang', 'zh'])
+    assert [record['IP地址'] for record in json.loads(capsys.readouterr().out)] == ['1.0.0.1']
+
+def test_query_uses_indexes_and_rejects_bad_filters(results_db, capsys):
+    capsys.readouterr()
+    iptest.command_query([results_db, '--cidr', '1.0.0.0/16', '--explain', '--count'])
+    assert 'INDEX results_ip ' in capsys.readouterr().out
+    iptest.command_query([results_db, '--flags', 'vpn', '--explain', '--count'])
+    assert 'INDEX results_is_vpn' in capsys.readouterr().out
+    iptest.command_query([results_db, '--cidr', '1.0.0.0/33'])
+    assert capsys.readouterr().out.startswith('错误：')
+    iptest.command_query([results_db, '--flags', 'unknown'])
+    assert '未知的标识' in capsys.readouterr().out
+
+# ---------------------------------------------------------------- 刷新
+
+@pytest.fixture
+def aged_store(tmp_path, clock):
+    """
+    按 (IP, 距上次查询的天数, 是否VPN) 写入记录的记录库
+    """
+    store = iptest.RecordStore(str(tmp_path / 'store'))
+    for ip, days, vpn in (('1.0.0.1', 10, False), ('1.0.0.2', 6, True), ('1.0.0.3', 3, True),
+                          ('1.0.0.4', 2, False), ('1.0.0.5', 1.5, False), ('1.0.0.6', 0.5, True)):
+        store.put(dict(api_record(ip), is_vpn=vpn), checked_at=clock[0] - days * 86400)
+    yield store
+    store.close()
+
+def test_select_refresh_candidates(aged_store):
+    def select(budget, strategy):
+        return [(ip, round(age / 86400, 1), volatile)
+                for ip, age, volatile in iptest.select_refresh_candidates(aged_store, budget, strategy)]
+
+    assert select(3, 'oldest') == [('1.0.0.1', 10, None), ('1.0.0.2', 6, None), ('1.0.0.3', 3, None)]
+    # 不足min_age（默认1天）的1.0.0.6不参与刷新
+    assert select(10, 'volatile') == [('1.0.0.2', 6, True), ('1.0.0.3', 3, True)]
+    # mixed：可变记录的已过时间乘以4，1.0.0.3（3天×4）排在1.0.0.1（10天）之前
+    assert select(3, 'mixed') == [('1.0.0.2', 6, True), ('1.0.0.3', 3, True), ('1.0.0.1', 10, False)]
+    assert select(10, 'mixed')[-1] == ('1.0.0.5', 1.5, False)
+    assert len(select(10, 'mixed')) == 5
+    assert select(0, 'mixed') == []
+    assert iptest.select_refresh_candidates(aged_store, 10, 'oldest', min_age=30 * 86400) == []
+
+def test_refresh_rewrites_changed_records(api, tmp_path, aged_store):
+    aged_store.close()
+    changes = tmp_path / 'changes.ndjson'
+    run_cli(tmp_path, 'refresh', '--store', 'store', '--budget', '2', '--strategy', 'volatile',
+            '--api-url', api.url, '--changes', str(changes))
+    store = iptest.RecordStore(str(tmp_path / 'store'))
+    try:
+        assert store.get('1.0.0.3') == api_record('1.0.0.3')
+        assert store.get('1.0.0.6')['is_vpn'] is True
+    finally:
+        store.close()
+    # 1.0.0.2查询结果没有变化，1.0.0.3不再是VPN
+    rows = [json.loads(line) for line in changes.read_text(encoding='utf-8').splitlines()]
+    assert rows == [{'ip': '1.0.0.3', 'field': 'is_vpn', 'old': True, 'new': False}]
+
+# ---------------------------------------------------------------- 日志提取
+
+def test_log_extractor_rejects_timestamps_macs_and_versions():
+    text = (b"2024-01-01T12:34:56.789+08:00 12:34:56 sshd[123]: from 1.2.3.4 port 22\n"
+            b"mac aa:bb:cc:dd:ee:ff AA-BB-CC-DD-EE-FF eui64 00:1a:2b:ff:fe:3c:4d:5e time 01:02:03:04 ratio 3:4\n"
+            b"version 1.2.3.4.5 v2.10.0 10.0.0.256 010.1.1.1 1.2.3 uuid 123e4567-e89b-12d3-a456-426614174000\n"
+            b"hash deadbeef:cafebabe 2001:db8:1:2:3\n")
+    assert list(iptest.LogIPExtractor().scan([text])) == ['1.2.3.4']
+
+def test_log_extractor_finds_addresses_in_context():
+    text = (b"11.22.33.44:8080 [2001:db8::1]:443 fe80::1%eth0 client=5.6.7.8, x9.9.9.9y\n"
+            b"2001:0DB8:0000:0000:0000:0000:0000:0002 a:b:c:d:e:f:1:2 ::1 1.2.3.4 1.2.3.4 2001:db8::1\n")
+    extractor = iptest.LogIPExtractor(count_hits=True)
+    # 输入块可以在任意行边界切分
+    chunks = [line + b'\n' for line in text.splitlines()]
+    assert list(extractor.scan(chunks)) == [
+        '11.22.33.44', '2001:db8::1', 'fe80::1', '5.6.7.8', '9.9.9.9',
+        '2001:db8::2', 'a:b:c:d:e:f:1:2', '::1', '1.2.3.4']
+    assert extractor.seen[b'1.2.3.4'] == 2
+    assert extractor.seen['2001:db8::1'] == 2
+    assert extractor.unique == {4: 4, 6: 5}
+
+def test_log_extractor_reads_compressed_input(tmp_path):
+    path = tmp_path / 'access.log.gz'
+    with gzip.open(path, 'wb') as f:
+        for i in range(2000):
+            f.write(f'10.0.{i % 7}.{i % 250} - - [01/Jan/2024:00:00:{i % 60:02d} +0000] "GET / HTTP/1.1"\n'.encode())
+    ips = list(iptest.extract_ips(str(path), iptest.LogIPExtractor()))
+    assert sorted(ips, key=iptest.ip_sort_key) == sorted(
+        {f"10.0.{i % 7}.{i % 250}" for i in range(2000)}, key=iptest.ip_sort_key)
+
+# ---------------------------------------------------------------- 抽样估计
+
+def sampled_record(ip, country, code):
+    record = mock_record(ip)
+    record['location'] = dict(record['location'], country=country, country_code=code)
+    return record
+
+def make_sampler(min_agree=2):
+    """
+    A层（1.0/16）100个IP，4个样本全部为日本；B层（2.0/16）50个IP，样本日本、美国各半；
+    C层（3.0/16）10个IP，只有1个成功样本；D层（4.0/16）5个IP，样本全部失败
+    """
+    sampler = iptest.StratifiedSampler(4, seed=1, min_agree=min_agree)
+    for prefix, size in (('1.0', 100), ('2.0', 50), ('3.0', 10), ('4.0', 5)):
+        for i in range(size):
+            sampler.add(f"{prefix}.{i // 250}.{i % 250 + 1}")
+    records = []
+    for key, (_, sample) in sampler.strata.items():
+        prefix = sample[0].rsplit('.', 2)[0]
+        if prefix == '1.0':
+            records += [sampled_record(ip, 'Japan', 'JP') for ip in sample]
+        elif prefix == '2.0':
+            records += [sampled_record(ip, *(('Japan', 'JP'), ('United States', 'US'))[i % 2]) for i, ip in enumerate(sample)]
+        elif prefix == '3.0':
+            records.append(sampled_record(sample[0], 'Hong Kong', 'HK'))
+    sampler.set_results(records)
+    return sampler
+
+def test_stratified_sampler_estimate():
+    sampler = make_sampler()
+    assert sampler.total == 165
+    assert len(sampler.sample_ips()) == 16
+    rows, covered = sampler.estimate(iptest.record_country)
+    assert covered == 160
+    z = NormalDist().inv_cdf(0.975)
+    # B层方差 50²·(1-4/50)·0.25/3，C层只有一个样本按 10²·(1-1/10)·0.25 计入
+    stratum_b = 50 * 50 * (1 - 4 / 50) * 0.25 / 3
+    singleton = 10 * 10 * (1 - 1 / 10) * 0.25
+    expected = {
+        'Japan': (125, 125 - z * (stratum_b + singleton) ** 0.5, 125 + z * (stratum_b + singleton) ** 0.5),
+        'United States': (25, 0.0, 25 + z * (stratum_b + singleton) ** 0.5),
+        'Hong Kong': (10, 10 - z * singleton ** 0.5, 10 + z * singleton ** 0.5),
+    }
+    assert [row[0] for row in rows] == ['Japan', 'United States', 'Hong Kong']
+    for country, total, low, high in rows:
+        assert (total, low, high) == pytest.approx(expected[country])
+
+def test_stratified_sampler_inherits_only_agreeing_strata():
+    sampler = make_sampler()
+    # 只有A层有至少2个一致的样本；C层只有一个成功样本，不继承
+    assert list(sampler.inherited.values()) == ['JP']
+    ips = [f"{prefix}.0.{i}" for prefix in ('1.0', '2.0', '3.0', '4.0') for i in range(1, 6)]
+    groups, inherited, unresolved = sampler.assign_countries(ips)
+    sampled = set(sampler.records)
+    assert {ip for ips in groups.values() for ip in ips} == sampled & set(ips)
+    assert inherited == {'JP': [ip for ip in ips if ip.startswith('1.0.') and ip not in sampled]}
+    assert set(unresolved) == {ip for ip in ips if not ip.startswith('1.0.') and ip not in sampled}
+
+    sampler = make_sampler(min_agree=1)
+    assert sorted(sampler.inherited.values()) == ['HK', 'JP']
+
+def test_cli_sample_writes_inherited_files(api, tmp_path):
+    """样本一致的层中未查询的IP写入单独标注的 .inherited.txt 文件，样本不一致的层写入unresolved"""
+    agreeing = [f"1.0.0.{c}" for c in range(1, 201)]
+    # 模拟服务按/24返回国家：1.1.0、1.1.1、1.1.2分属不同国家，任取3个样本都不一致
+    mixed = ['1.1.0.1', '1.1.1.1', '1.1.2.1', '1.1.2.2']
+    (tmp_path / 'ips.txt').write_text('\n'.join(agreeing + mixed) + '\n', encoding='utf-8')
+    api.reset_stats()
+    run_cli(tmp_path, 'ips.txt', '-o', 'out.json', '-d', 'countries', '--api-url', api.url,
+            '--no-interactive', '--sample', '3', '--sample-min-agree', '3')
+    assert api.stats['ips'] == 6
+
+    countries = tmp_path / 'countries'
+    code = mock_record(agreeing[0])['location']['country_code']
+    queried = [ip for name in os.listdir(countries) if not name.endswith('.inherited.txt')
+               for ip in read_lines(countries / name)]
+    assert len(queried) == 6
+    assert [name for name in os.listdir(countries) if name.endswith('.inherited.txt')] == [f"{code}.inherited.txt"]
+    assert read_lines(countries / f"{code}.inherited.txt") == [ip for ip in agreeing if ip not in queried]
+    assert read_lines(tmp_path / 'out.unresolved.txt') == [ip for ip in mixed if ip not in queried]
+
+# ---------------------------------------------------------------- 性能剖析
+
+def test_record_country_name():
+    assert iptest.record_country_name(mock_record('1.2.3.4')) == '日本'
+    assert iptest.record_country_name({'ip': '1.2.3.4'}) == iptest.translate_to_chinese('Unknown')
+
+def test_stage_profiler_accumulates_stages_and_sections(tmp_path, capsys):
+    profiler = iptest.StageProfiler(cprofile_dir=str(tmp_path / 'prof'))
+    try:
+        for _ in range(2):
+            with profiler.stage('load'):
+                data = [str(i) for i in range(100000)]
+                del data
+        run_concurrently(*[lambda: profiler.timed('work', sum)(range(1000))] * 4)
+        with profiler.section('wait', cpu=False):
+            pass
+        profiler.print_report()
+    finally:
+        profiler.close()
+    assert list(profiler.stages) == ['load']
+    assert profiler.stages['load']['wall'] > 0
+    assert profiler.stages['load']['peak'] > 1024 * 1024
+    assert profiler.sections['work'][0] == 4
+    assert profiler.sections['wait'][2] is None
+    assert (tmp_path / 'prof' / 'load.prof').exists()
+    out = capsys.readouterr().out
+    assert '=== 性能剖析 ===' in out and 'work' in out
+
+def test_classifier_profiles_http_sections(api):
+    profiler = iptest.StageProfiler(trace_memory=False)
+    classifier = iptest.IPClassifier(api_base_url=api.url, profiler=profiler)
+    try:
+        with profiler.stage('classify'):
+            classified, failed = classifier.classify_ips_by_country(IPS[:6], 2)
+    finally:
+        classifier.close()
+        profiler.close()
+    assert failed == []
+    assert profiler.sections['http'][0] == 6
+    assert profiler.sections['build_record'][0] == 6